@@ -0,0 +1,152 @@
+import threading
+import time
+import typing
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-size ring buffer of timestamped frames.
+
+    The storage is allocated once (at creation if the frame shape is known, on the first push otherwise)
+    and then reused, so acquiring does not allocate memory. When the consumer is too slow, the oldest
+    frames are overwritten and counted in `dropped`.
+    """
+    def __init__(self, capacity: int, frame_shape: typing.Optional[tuple] = None, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least 1.")
+        self.capacity = capacity
+        self.dtype = dtype
+        self.dropped = 0
+        self._frames = None
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self._written = 0  # total number of frames pushed
+        self._read = 0     # total number of frames drained
+        self._lock = threading.Lock()
+        if frame_shape is not None:
+            self._frames = np.zeros((capacity,) + tuple(frame_shape), dtype=dtype)
+
+    @property
+    def frame_shape(self) -> typing.Optional[tuple]:
+        """
+        The shape of the frames, None until the first push if it was not given.
+        """
+        return None if self._frames is None else self._frames.shape[1:]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._written - self._read
+
+    def push(self, frame: np.ndarray, timestamp: float) -> None:
+        """
+        Copy a frame in the next slot of the buffer.
+
+        :param frame: The frame to store, it must always have the same shape.
+        :param timestamp: The time at which the frame was acquired, from time.monotonic().
+        :type frame: np.ndarray
+        :type timestamp: float
+        """
+        frame = np.asarray(frame)
+        with self._lock:
+            if self._frames is None:
+                self._frames = np.zeros((self.capacity,) + frame.shape, dtype=self.dtype)
+            elif frame.shape != self._frames.shape[1:]:
+                raise ValueError("Frame shape " + str(frame.shape) + " does not match buffer shape " + str(self._frames.shape[1:]))
+
+            slot = self._written % self.capacity
+            self._frames[slot] = frame
+            self._timestamps[slot] = timestamp
+            self._written += 1
+
+            if self._written - self._read > self.capacity:
+                self.dropped += self._written - self._read - self.capacity
+                self._read = self._written - self.capacity
+
+    def drain(self, max_frames: int = -1) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Remove the oldest frames from the buffer and return them in acquisition order.
+
+        :param max_frames: The maximum number of frames to return, -1 to return all of them.
+        :type max_frames: int
+
+        :return: The timestamps (n,) and the frames (n, *frame_shape), both copied out of the buffer.
+        """
+        with self._lock:
+            n = self._written - self._read
+            if max_frames >= 0:
+                n = min(n, max_frames)
+            if self._frames is None or n == 0:
+                return np.zeros(0), np.zeros((0,) + (self.frame_shape or ()), dtype=self.dtype)
+            slots = (self._read + np.arange(n)) % self.capacity
+            timestamps = self._timestamps[slots]
+            frames = self._frames[slots]
+            self._read += n
+        return timestamps, frames
+
+    def clear(self) -> None:
+        """
+        Forget all the frames not drained yet.
+        """
+        with self._lock:
+            self._read = self._written
+
+
+def buffer_capacity(frame_shape: tuple, dtype, period: float, latency: float = 2, max_bytes: int = 64 * 2**20) -> int:
+    """
+    Number of frames to buffer so the consumer can be `latency` seconds late, without using more than max_bytes.
+
+    :param frame_shape: The shape of a frame.
+    :param period: The acquisition period, in seconds.
+
+    :return: The capacity of the ring buffer, at least 1.
+    """
+    frame_bytes = max(int(np.prod(frame_shape)) * np.dtype(dtype).itemsize, 1)
+    frames = int(np.ceil(latency / max(period, 1e-3))) + 1
+    return max(1, min(frames, max_bytes // frame_bytes))
+
+
+class AcquisitionThread(threading.Thread):
+    """
+    Producer thread reading one device at a fixed period.
+
+    Each frame returned by `grab` is stamped with time.monotonic() and pushed in the ring buffer.
+    The schedule is absolute, so the slow frames do not shift the following acquisitions.
+    If `grab` raises, the thread stops and keeps the exception in `error`.
+    """
+    def __init__(self, grab: typing.Callable[[], typing.Optional[np.ndarray]], buffer: RingBuffer, period: float, name: str = "acquisition"):
+        super().__init__(name=name, daemon=True)
+        self.grab = grab
+        self.buffer = buffer
+        self.period = period
+        self.error: typing.Optional[Exception] = None
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        next_acquisition = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                frame = self.grab()
+                if frame is not None:
+                    self.buffer.push(frame, time.monotonic())
+            except Exception as e:
+                self.error = e
+                break
+
+            next_acquisition += self.period
+            delay = next_acquisition - time.monotonic()
+            if delay < 0:
+                # Late, restart the schedule from now instead of acquiring in burst
+                next_acquisition = time.monotonic()
+            else:
+                self._stop_event.wait(delay)
+
+    def stop(self, timeout: float = 2) -> None:
+        """
+        Ask the thread to stop and wait for it to finish.
+
+        :param timeout: The maximum time to wait for the thread, in seconds.
+        :type timeout: float
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
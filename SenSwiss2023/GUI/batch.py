@@ -0,0 +1,119 @@
+"""
+Post-processing of the plots saved by the GUI, without the GUI.
+
+Every spectrometer_plot_*.csv and camera_plot_*.csv of a folder is smoothed, split in segments at its comments,
+fitted segment by segment and, for the spectrometer, the shift between the GFAP and STOP comments is computed.
+The files are processed in parallel on all the cores and the results are written in one summary table,
+a line per file, sorted by file name.
+
+Usage:
+    python batch.py plots_saved --output summary.csv --moving-average 20 --gfap GFAP --stop STOP
+"""
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import typing
+import warnings
+import numpy as np
+import pandas as pd
+import imgproc
+
+SUMMARY_COLUMNS = ["file", "type", "samples", "duration [s]", "segments", "shift min [nm]", "shift centroid [nm]", "fit parameters", "error"]
+
+
+def read_plot(file_path: str) -> typing.Tuple[str, pd.DataFrame]:
+    """
+    Read a plot saved by the GUI.
+
+    :param file_path: The path of the csv file.
+    :type file_path: str
+
+    :return: The type of plot ("spectrometer" or "camera") and its data, with the columns time, signal, comments
+        and centroids (spectrometer only).
+    """
+    if os.path.basename(file_path).startswith("spectrometer_plot_"):
+        data = pd.read_csv(file_path, usecols=["Time", "Wavelengths", "Comments", "Centroids"], dtype={"Time": np.float64, "Wavelengths": np.float64, "Comments": str, "Centroids": np.float64}, keep_default_na=False, na_values={"Time": ["", "nan"], "Wavelengths": ["", "nan"], "Centroids": ["", "nan"]})
+        data = data.rename(columns={"Time": "time", "Wavelengths": "signal", "Comments": "comments", "Centroids": "centroids"})
+        return "spectrometer", data
+
+    data = pd.read_csv(file_path, usecols=["Time", "Intensities"], dtype=np.float64)
+    data = data.rename(columns={"Time": "time", "Intensities": "signal"})
+    data["comments"] = ""
+    return "camera", data
+
+
+def process_plot(file_path: str, moving_average_size: int, gfap: str, stop: str) -> dict:
+    """
+    Smooth, split, fit and compute the shifts of one plot.
+
+    :return: The line of the summary table of the file.
+    """
+    summary = {name: "" for name in SUMMARY_COLUMNS}
+    summary["file"] = os.path.basename(file_path)
+    try:
+        plot_type, data = read_plot(file_path)
+        time = data["time"].to_numpy()
+        signal = data["signal"].to_numpy()
+        comments = list(data["comments"])
+        summary["type"] = plot_type
+        summary["samples"] = len(time)
+        summary["duration [s]"] = time[-1] - time[0] if len(time) > 0 else 0
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if plot_type == "spectrometer":
+                summary["shift min [nm]"] = imgproc.compute_shift(time, signal, comments, moving_average_size, gfap, stop)
+                summary["shift centroid [nm]"] = imgproc.compute_shift(time, data["centroids"].to_numpy(), comments, moving_average_size, gfap, stop)
+
+            # Same smoothing and segmentation as post_processing, keeping the parameters of each segment
+            time_segments, segments = imgproc.split_segments(time, signal, comments, moving_average_size)
+            params, _ = imgproc.fit_all_segments(time_segments, segments)
+
+        summary["segments"] = len(segments)
+        summary["fit parameters"] = " | ".join(", ".join("%.6g" % value for value in segment_params[0:2]) + (" (linear)" if segment_params[-1] is False else ", %.6g" % segment_params[2]) for segment_params in params)
+    except Exception as e:
+        summary["error"] = str(e)
+    return summary
+
+
+def process_folder(folder: str, output: str, moving_average_size: int = 20, gfap: str = "GFAP", stop: str = "STOP", processes: typing.Optional[int] = None) -> int:
+    """
+    Process all the plots of a folder in parallel and write the summary table.
+
+    :param folder: The folder of the plots, e.g. plots_saved.
+    :param output: The path of the summary csv file.
+    :param moving_average_size: The size of the moving average applied before fitting and computing the shifts.
+    :param gfap: The comment of the beginning of the shift.
+    :param stop: The comment of the end of the shift.
+    :param processes: The number of processes, all the cores by default.
+
+    :return: The number of files processed.
+    """
+    files = sorted(glob.glob(os.path.join(folder, "spectrometer_plot_*.csv")) + glob.glob(os.path.join(folder, "camera_plot_*.csv")))
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(process_plot, file_path, moving_average_size, gfap, stop) for file_path in files]
+            summaries = [future.result() for future in concurrent.futures.as_completed(futures)]
+        for summary in sorted(summaries, key=lambda summary: summary["file"]):
+            writer.writerow(summary)
+            if summary["error"] != "":
+                print("Error while processing " + summary["file"] + ": " + summary["error"])
+    return len(files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post-process the plots saved by the GUI.")
+    parser.add_argument("folder", help="folder of the spectrometer_plot_*.csv and camera_plot_*.csv files")
+    parser.add_argument("--output", default="summary.csv", help="summary table to write (default: summary.csv)")
+    parser.add_argument("--moving-average", type=int, default=20, help="size of the moving average (default: 20)")
+    parser.add_argument("--gfap", default="GFAP", help="comment of the beginning of the shift (default: GFAP)")
+    parser.add_argument("--stop", default="STOP", help="comment of the end of the shift (default: STOP)")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: all the cores)")
+    args = parser.parse_args()
+
+    n_files = process_folder(args.folder, args.output, args.moving_average, args.gfap, args.stop, args.processes)
+    print(str(n_files) + " files processed, summary written in " + args.output)
@@ -0,0 +1,119 @@
+import os
+import time
+import typing
+import numpy as np
+
+
+class FieldCapture:
+    """
+    Capture of a dark or flat field from n_frames spectra, stored in a buffer (n_frames x pixels) allocated once.
+
+    The spectra are added as they are acquired, by batches, and the statistics are computed per pixel
+    on the whole buffer when it is full.
+    """
+    def __init__(self, n_frames: int, pixels: int):
+        self.n_frames = n_frames
+        self.frames = np.zeros((n_frames, pixels), dtype=np.float64)
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def done(self) -> bool:
+        return self.n == self.n_frames
+
+    def add(self, spectra: np.ndarray) -> bool:
+        """
+        Copy spectra (frames x pixels) in the buffer, the ones beyond n_frames are ignored.
+
+        :return: If the capture is complete.
+        """
+        count = min(len(spectra), self.n_frames - self.n)
+        self.frames[self.n:self.n + count] = spectra[:count]
+        self.n += count
+        return self.done()
+
+    def mean(self) -> np.ndarray:
+        return np.mean(self.frames[:self.n], axis=0)
+
+    def variance(self) -> np.ndarray:
+        return np.var(self.frames[:self.n], axis=0, ddof=1 if self.n > 1 else 0)
+
+    def clipped_mean(self, n_sigma: float = 3, n_iterations: int = 3) -> np.ndarray:
+        """
+        Mean of each pixel without the outliers (e.g. cosmic rays, or a light turned on during the capture):
+        the values further than n_sigma standard deviations from the mean are rejected, and the mean and standard
+        deviation are computed again on the values kept, n_iterations times.
+        """
+        frames = self.frames[:self.n]
+        kept = np.ones(frames.shape, dtype=bool)
+        for _ in range(n_iterations):
+            count = np.maximum(np.sum(kept, axis=0), 1)
+            mean = np.sum(frames, axis=0, where=kept) / count
+            std = np.sqrt(np.sum((frames - mean) ** 2, axis=0, where=kept) / count)
+            new_kept = np.abs(frames - mean) <= n_sigma * std
+            if np.array_equal(new_kept, kept):
+                break
+            kept = new_kept
+        count = np.maximum(np.sum(kept, axis=0), 1)
+        return np.sum(frames, axis=0, where=kept) / count
+
+
+class CalibrationStore:
+    """
+    Dark and flat fields saved on disk, to normalize the spectra as soon as the GUI starts.
+
+    Each calibration is a .npz file named after what the fields depend on: the spectrometer serial number,
+    the integration time, the number of pixels trimmed at each end and the time of the capture. The fields are
+    smoothed, so the Savitzky-Golay window is saved in the file and checked too.
+    A calibration older than max_age hours is considered stale and is not loaded.
+    """
+    def __init__(self, directory: str, max_age: float = 12):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, serial: str, integration_time_us: int, trim: int, SG_window: int, dark_field: np.ndarray, flat_field: np.ndarray) -> str:
+        """
+        Save a calibration, the file is written under a temporary name and then renamed, so it is never read half written.
+
+        :return: The path of the file.
+        """
+        name = self._prefix(serial, integration_time_us, trim) + time.strftime("%Y%m%d_%H%M%S") + ".npz"
+        file_path = os.path.join(self.directory, name)
+        with open(file_path + ".tmp", "wb") as f:
+            np.savez(f, dark_field=dark_field, flat_field=flat_field, SG_window=SG_window, timestamp=time.time())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_path + ".tmp", file_path)
+        return file_path
+
+    def load(self, serial: str, integration_time_us: int, trim: int, SG_window: int, pixels: int) -> typing.Optional[typing.Tuple[np.ndarray, np.ndarray, float]]:
+        """
+        Load the most recent calibration of the spectrometer with these settings.
+
+        :return: The dark field, the flat field and the time of the capture (time.time()), or None if there is no valid calibration.
+        """
+        prefix = self._prefix(serial, integration_time_us, trim)
+        names = sorted([name for name in os.listdir(self.directory) if name.startswith(prefix) and name.endswith(".npz")], reverse=True)
+        for name in names:
+            try:
+                with np.load(os.path.join(self.directory, name)) as data:
+                    dark_field, flat_field = data["dark_field"], data["flat_field"]
+                    timestamp = float(data["timestamp"])
+                    saved_SG_window = int(data["SG_window"])
+            except Exception as e:
+                print("Error while loading calibration " + name + ": " + str(e))
+                continue
+
+            if time.time() - timestamp > self.max_age * 3600:
+                print("Calibration " + name + " is older than " + str(self.max_age) + " hours, it is not loaded")
+                return None
+            if saved_SG_window != SG_window or len(dark_field) != pixels or len(flat_field) != pixels:
+                print("Calibration " + name + " was captured with other settings, it is not loaded")
+                return None
+            return dark_field, flat_field, timestamp
+        return None
+
+    def _prefix(self, serial: str, integration_time_us: int, trim: int) -> str:
+        return str(serial) + "_" + str(integration_time_us) + "us_trim" + str(trim) + "_"
@@ -1,4 +1,5 @@
 import PySpin
+import numpy as np
 
 def init_camera(cam: PySpin.Camera) -> None:
     """
@@ -138,4 +139,30 @@ def reset_exposure(cam: PySpin.Camera) -> None:
         print("Automatic exposure enabled...")
 
     except PySpin.SpinnakerException as ex:
-        raise Exception("Error: %s" % ex)
\ No newline at end of file
+        raise Exception("Error: %s" % ex)
+
+
+def grab_frame(cam: PySpin.Camera, timeout_ms: int = 1000) -> np.ndarray:
+    """
+    Waits for the next image of the camera and returns a copy of its pixels.
+
+    :param cam: Camera to read from.
+    :param timeout_ms: Maximum time to wait for the image (in milliseconds).
+    :type cam: CameraPtr
+    :type timeout_ms: int
+
+    :return: The image, or None if it is incomplete or did not arrive in time.
+    """
+    try:
+        image_result = cam.GetNextImage(timeout_ms)
+    except PySpin.SpinnakerException as ex:
+        print("Error while getting image: %s" % ex)
+        return None
+
+    try:
+        if image_result.IsIncomplete():
+            print("Image incomplete with image status {} ...".format(image_result.GetImageStatus()))
+            return None
+        return np.array(image_result.GetNDArray(), copy=True)
+    finally:
+        image_result.Release()
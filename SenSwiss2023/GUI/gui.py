@@ -5,6 +5,8 @@ import PySpin
 import matplotlib.pyplot as plt
 import matplotlib.figure
 import os
+import concurrent.futures
+import threading
 import numpy as np
 import cv2
 import pandas as pd
@@ -12,11 +14,8 @@ import csv
 import serial
 import serial.tools.list_ports
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from io import BytesIO
-import base64
 import typing
 from seabreeze.spectrometers import Spectrometer
-from scipy import signal
 import time
 import sys
 
@@ -26,6 +25,18 @@ import microflu
 import imgproc
 import arduino_control
 import layout
+import acquisition
+import plotting
+import timeseries
+import recorder
+import spectrum
+import calibration
+import spectrum_archive
+import protocol
+import serial_io
+import scheduler
+import optimizer
+import timing
 
 # Used to display plot on interface
 class Canvas(FigureCanvasTkAgg):
@@ -119,52 +130,106 @@ def save_element_as_file(element, filename: str):
     grab = ImageGrab.grab(bbox=box)
     grab.save(filename)
 
-def get_new_image(cam: PySpin.Camera, data_to_plot: list, drawROI: bool, threshold, params, kernel_size, dilation_number, ROIblocked, ROIcenter) -> bool:
+class CameraPreview:
     """
-    Get a new image from the camera and display it
-    If required can save the image and add its average intensity to the plot
+    Display the camera images in a graph element without encoding them.
+    The image is reduced with INTER_AREA into a buffer allocated once, then pasted in place
+    in a persistent Tk PhotoImage drawn on the graph.
+    """
+    def __init__(self, graph: sg.Graph, camera_img_size: typing.Tuple[int, int], reducing_factor: float):
+        self.reducing_factor = reducing_factor
+        self.size = (int(camera_img_size[1] * reducing_factor), int(camera_img_size[0] * reducing_factor)) # (width, height)
+        self.buffer = np.zeros((self.size[1], self.size[0]), dtype=np.uint8)
+        self.photo = ImageTk.PhotoImage(Image.fromarray(self.buffer))
+        graph.TKCanvas.create_image(0, 0, image=self.photo, anchor="nw")
+
+    def update(self, image_data: np.ndarray, drawROI: bool = False, params: imgproc.ROIparams = None, center=(0, 0), roi_set: imgproc.ROISet = None) -> None:
+        """
+        Reduce the image, draw the ROI on the reduced image if required and display it
+        """
+        cv2.resize(image_data, self.size, dst=self.buffer, interpolation=cv2.INTER_AREA)
+
+        if drawROI:
+            cX, cY = [int(i * self.reducing_factor) for i in center]
+            thickness = max(1, int(10 * self.reducing_factor))
+            if params.shape_type == "circle":
+                cv2.circle(self.buffer, (cX, cY), int(params.radius * self.reducing_factor), 255, thickness)
+            elif params.shape_type == "rectangle":
+                half_width = int(params.width / 2 * self.reducing_factor)
+                half_height = int(params.height / 2 * self.reducing_factor)
+                cv2.rectangle(self.buffer, (cX - half_width, cY - half_height), (cX + half_width, cY + half_height), 255, thickness)
+            else:
+                raise ValueError("Invalid ROI shape type.")
+            if roi_set is not None:
+                roi_set.draw(self.buffer, self.reducing_factor, 255, thickness)
+
+        self.photo.paste(Image.fromarray(self.buffer))
+
+def get_new_image(image_data: np.ndarray, drawROI: bool, threshold, params, kernel_size, dilation_number, ROIblocked, ROIcenter, display: bool = True, tracker: imgproc.CentroidTracker = None, roi_set: imgproc.ROISet = None) -> typing.Tuple[bool, tuple, float, np.ndarray]:
+    """
+    Process a new image acquired from the camera and display it
+    Return if it succeeded, the ROI center, the average intensity and the average intensity in each of the fixed ROIs of roi_set
     """
 
     try:
-        image_result = cam.GetNextImage(100)
+        # Get average intensity
+        ave, center = imgproc.get_avg_intensity(image_data, threshold, params, kernel_size, dilation_number, ROIblocked, ROIcenter, tracker)
+        roi_aves = np.zeros(0)
+        if roi_set is not None and len(roi_set) > 0:
+            roi_aves, _ = roi_set.measure(image_data)
 
-        if image_result.IsIncomplete():
-            raise Exception("Image incomplete with image status {} ...".format(image_result.GetImageStatus()))
+        if display:
+            camera_preview.update(image_data, drawROI, params, center, roi_set)
 
-        else:
-            image_data = image_result.GetNDArray()
-            image_result.Release()
-            # Get average intensity
-            ave, center = imgproc.get_avg_intensity(image_data, threshold, params, kernel_size, dilation_number, ROIblocked, ROIcenter)
-            data_to_plot.append(ave)
-            if drawROI:
-                cX, cY = center
-                if params.shape_type == "circle":
-                    cv2.circle(image_data, (cX, cY), params.radius, 255, 10)
-                elif params.shape_type == "rectangle":
-                    cv2.rectangle(image_data, (cX - int(params.width/2), cY - int(params.height/2)), (cX + int(params.width/2), cY + int(params.height/2)), 255, 10)
-                else:
-                    raise ValueError("Invalid ROI shape type.")
-
-            # Reduce image to display
-            resized_width, resized_height = [
-                int(i * reducing_factor) for i in image_data.shape
-            ]
-            image_data = cv2.resize(image_data, (resized_height, resized_width))
-            # To display img after
-            buffered = BytesIO()
-            Image.fromarray(image_data).save(buffered, format="PNG", compress_level=0) 
-            img_str = base64.b64encode(buffered.getvalue())
-            buffered.close()
-            window["cameraGraph"].erase()
-            window["cameraGraph"].DrawImage(data=img_str, location=(0,0))
-            window.refresh()
-
-            return True, center
+        return True, center, ave, roi_aves
     except:
-        print("Error while getting image or processing it, nice weather today")
+        print("Error while processing image, nice weather today")
         pass
-    return False, ROIcenter
+    return False, ROIcenter, 0, np.zeros(0)
+
+def start_run_recorder(path: str, device: str, columns: typing.List[str]) -> recorder.RunRecorder:
+    """
+    Start recording a new run of the device in plots_saved/runs, the samples are written as they are acquired
+    """
+    directory = path + "/plots_saved/runs/" + device + "_" + time.strftime("%Y%m%d_%H%M%S")
+    # A run started in the same second as the previous one, e.g. after clearing the plot, gets its own folder
+    unique_directory = directory
+    count = 1
+    while os.path.exists(unique_directory):
+        count += 1
+        unique_directory = directory + "_" + str(count)
+    run_recorder = recorder.RunRecorder(unique_directory, columns)
+    run_recorder.start()
+    return run_recorder
+
+def set_pump_position(position: int) -> None:
+    """
+    Follow the plunger position as the chunks of a protocol are finished, see scheduler.PumpScheduler
+    """
+    microflu.pump_position = position
+
+def export_plot(run_directory: str, flushed: threading.Event, file_path: str, device: str) -> None:
+    """
+    Write a run as the csv of the plot saved before the runs were recorded, read by the analysis scripts (see batch.py).
+    It reads the whole run, so it is run on the export thread once the recorder has synced the files.
+    """
+    try:
+        if not flushed.wait(10):
+            print("The run is not synced, " + file_path + " is written with the samples already on disk")
+        columns, comments = recorder.load_run(run_directory)
+        if device == "camera":
+            fixed_names = [name for name in columns if name.startswith("fixed_roi_")]
+            header = ["Time", "Intensities"] + ["Intensities fixed ROI " + name[len("fixed_roi_"):] for name in fixed_names]
+            to_save = np.array([columns[name].astype(str) for name in ["time", "intensity"] + fixed_names]).transpose()
+        else:
+            comment_list = [""] * len(columns["time"])
+            for index, text in comments:
+                comment_list[index] = text
+            header = ["Time", "Wavelengths", "Comments", "Centroids"]
+            to_save = np.array([columns["time"].astype(str), columns["min_peak"].astype(str), comment_list, columns["centroid"].astype(str)]).transpose()
+        np.savetxt(file_path, np.insert(to_save.reshape(-1, len(header)), 0, header, axis=0), delimiter=",", fmt="%s")
+    except Exception as e:
+        print("Error while exporting " + file_path + ": " + str(e))
 
 # Init commands list
 protocol_list = []
@@ -194,11 +259,16 @@ if __name__ == "__main__":
     print("Connection with pump")
     pump_connected: bool = False
     lsp, pump_connected = microflu.connect_pump()
+    # The serial ports are read and written by background threads, so the GUI never waits for them
+    if pump_connected:
+        lsp = serial_io.SerialTransport(lsp, "pump")
     
     # Init arduino
     print("Connection with arduino")
     arduino_connected: bool = False
     arduino, arduino_connected = arduino_control.connect_arduino()
+    if arduino_connected:
+        arduino = serial_io.SerialTransport(arduino, "arduino")
 
     # Init camera / spectrometer, only one or the other
     print("Connection with camera")
@@ -270,6 +340,7 @@ if __name__ == "__main__":
 
     # acquire the exposure time and the gain value of the camera
     if camera_connected == True:
+        camera_preview = CameraPreview(window["cameraGraph"], camera_img_size, reducing_factor)
         control_flir_camera.configure_exposure(cam, float(window["exposureTime"].get()))
         control_flir_camera.configure_gain(cam, window["gainValue"].get())
 
@@ -284,11 +355,22 @@ if __name__ == "__main__":
     kernel_size = 3
     dilation_number = 2
     filter_threshold = 90
+    # Fixed ROIs measured in addition to the main one, each one has its column in the camera history
+    fixed_ROIs = imgproc.ROISet()
+    # Find the ROI center on a 4x reduced image, and only in the previous window while it moves less than 10 pixels
+    # Same center as on the full frame, checked by running imgproc.py
+    ROI_tracker = imgproc.CentroidTracker(pyramid_levels=2, max_motion=10)
 
-    # Pandas dataframe to store the commands
+    # The programs are streamed to the pump in chunks by the scheduler
     # Used to follow the protocol and be able able to automatically add comments
-    commands_df = pd.DataFrame(columns=["port", "action", "volume", "speed", "title"])
-    current_command = -1
+    pump_scheduler = scheduler.PumpScheduler(on_position=set_pump_position)
+    pump_progress: str = ""
+    # Tubing of the ports, to place the titles when the liquid reaches the chip
+    try:
+        dead_volumes = timing.load_tubing("tubing.csv")
+    except Exception as e:
+        print("Error while reading tubing.csv, the titles are added when the dispense starts: " + str(e))
+        dead_volumes = {}
 
     # Create the fig and ax and link them to the window for the intensity plot
     intensity_fig, intensity_ax = plt.subplots(figsize=(5,4))
@@ -297,64 +379,96 @@ if __name__ == "__main__":
         spectrometer_fig, spectrometer_ax = plt.subplots(figsize=(5,4))
         linkFigToWindow(window["cameraGraph"], spectrometer_fig)
     
-    # Store the intensities to plot
+    # Store the intensities to plot, the run is also recorded on disk while it is acquired
+    run_recorder: typing.Optional[recorder.RunRecorder] = None
+    # The csv of the saved plots are written from the run on disk, out of the GUI loop
+    export_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    spec_archive: typing.Optional[spectrum_archive.SpectrumArchive] = None
     if camera_connected == True and spec_connected == False:
-        intensities: typing.List[float] = []
-        time_of_intensities: typing.List[float] = []
-        clear_time: float = time.time()
+        camera_history = timeseries.TimeSeriesStore(["time", "intensity"])
+        run_recorder = start_run_recorder(path, "camera", camera_history.columns)
+        clear_time: float = time.monotonic()
         auto_scale: bool = False
         min_y: int = 0
         max_y: int = 260 # max value of the camera is 255 for an 8bit value, but we add a bit of margin
-        updatePlot(intensity_fig, intensity_ax, intensities, time_of_intensities, auto_scale, min_y, max_y, "Real time measurement of average intensity", "Time [s]", "Intensity [a.u.]")
+        intensity_plot = plotting.LivePlot(intensity_fig, intensity_ax, "Real time measurement of average intensity", "Time [s]", "Intensity [a.u.]")
+        intensity_plot.set_y_limits(auto_scale, min_y, max_y)
 
     if spec_connected == True and camera_connected == False:
         wavelengths: typing.List[float] = []
         intensities_spec: typing.List[float] = []
-        comments: typing.List[str] = []
         comment_added: bool = False
         comment_to_add: str = ""
 
-        title_delay: float = -1
-        title_add_time: float = 0
+        # time.monotonic() when the liquid of the title reaches the chip, -1 if there is no title to add
+        title_time: float = -1
         title_to_add: str = ""
 
         normalized_intensities_spec: typing.List[float] = []
-        normalize_gain: float = 1
 
-        min_peak_wavelength: typing.List[float] = []
-        time_of_intensities_spec: typing.List[float] = []
-        clear_time: float = time.time()
+        # The prefix sums of the peaks are kept to compute the shifts between comments in constant time
+        spec_history = timeseries.TimeSeriesStore(["time", "min_peak", "centroid"], summed_columns=["min_peak", "centroid"])
+        run_recorder = start_run_recorder(path, "spectrometer", spec_history.columns)
+        clear_time: float = time.monotonic()
         auto_scale: bool = False
         min_y: int = 500
         max_y: int = 900
 
         flat_field: typing.List[float] = []
-        flat_field_saving: bool = False
-        flat_field_counter: int = 0
+        flat_capture: typing.Optional[calibration.FieldCapture] = None
         dark_field: typing.List[float] = []
-        dark_field_saving: bool = False
-        dark_field_counter: int = 0
+        dark_capture: typing.Optional[calibration.FieldCapture] = None
         num_frames_for_save: int = 50
+        # Integration time keying the saved calibrations, 0 keeps the default integration time of the spectrometer
+        integration_time_us: int = 0
 
         wavelength_min: int = 500
         wavelength_max: int = 900
 
         moving_average_size: int = 20
-        SG_window: int = 100
+        SG_window: int = 101 # odd, so the smoothing does not shift the spectrum
 
         updatePlot(spectrometer_fig, spectrometer_ax, intensities_spec, wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]")
-        updatePlot(intensity_fig, intensity_ax, min_peak_wavelength, time_of_intensities_spec, auto_scale, min_y, max_y, "Shift of the absorption peak over time", "Time [s]", "Wavelength [nm]")
+        # The current segment of the protocol is fitted with an exponential as the samples arrive
+        segment_fit = imgproc.OnlineExponentialFitter()
+        intensity_plot = plotting.LivePlot(intensity_fig, intensity_ax, "Shift of the absorption peak over time", "Time [s]", "Wavelength [nm]", legends=["Raw", "Average", "Centroids"], mov_avg_size=moving_average_size, second_line=True)
+        intensity_plot.set_y_limits(auto_scale, min_y, max_y)
         
     # Variables to find and save centroid of intensities around minimum peak
     centroid_window_size: int = 250
-    window_fixed: bool = False
-    index_min: int = 0
-    centroids: typing.List[float] = []
 
     # Variables to control the acquisition period
-    last_acquisition_time: float = 0
     acqPeriod: float = 0.5 # in seconds
 
+    # Acquisition runs on its own thread, the loop drains the frames acquired since the last iteration
+    if camera_connected == True and spec_connected == False:
+        acquisition_buffer = acquisition.RingBuffer(acquisition.buffer_capacity(camera_img_size, np.uint8, acqPeriod), camera_img_size, np.uint8)
+        acquisition_thread = acquisition.AcquisitionThread(lambda: control_flir_camera.grab_frame(cam), acquisition_buffer, acqPeriod, "camera")
+        acquisition_thread.start()
+    if spec_connected == True and camera_connected == False:
+        wavelengths = spec.wavelengths()
+        acquisition_buffer = acquisition.RingBuffer(acquisition.buffer_capacity(wavelengths.shape, np.float64, acqPeriod), wavelengths.shape, np.float64)
+        spectrum_processor = spectrum.SpectrumProcessor(wavelengths, 100, SG_window, 2, wavelength_min, wavelength_max, centroid_window_size)
+        # Every raw spectrum of the run is archived next to its samples, to be processed again later if needed
+        spec_archive = spectrum_archive.SpectrumArchive(run_recorder.directory + "/spectra", wavelengths, trim=100)
+        wavelengths = spectrum_processor.wavelengths # The first and last 100 values are removed, the spectrum is too noisy at the extremities
+        if integration_time_us > 0:
+            spec.integration_time_micros(integration_time_us)
+
+        # Start with the last dark and flat fields saved for this spectrometer, if they are recent enough
+        calibration_store = calibration.CalibrationStore(path + "/calibration")
+        saved_calibration = calibration_store.load(spec.serial_number, integration_time_us, 100, SG_window, len(wavelengths))
+        if saved_calibration is not None:
+            dark_field, flat_field, calibration_time = saved_calibration
+            spectrum_processor.set_fields(dark_field, flat_field)
+            spec_archive.set_dark_field(dark_field)
+            spec_archive.set_flat_field(flat_field)
+            window["darkFieldStatus"].update("Dark field loaded")
+            window["flatFieldStatus"].update("Flat field loaded")
+            print("Dark and flat fields loaded, captured on " + time.strftime("%Y-%m-%d %H:%M", time.localtime(calibration_time)))
+        acquisition_thread = acquisition.AcquisitionThread(spec.intensities, acquisition_buffer, acqPeriod, "spectrometer")
+        acquisition_thread.start()
+
     # Variable to control amount of commands
     command_number: int = 0
 
@@ -362,168 +476,138 @@ if __name__ == "__main__":
     while True:
 
         if pump_connected:
-            try:
-                bytesToRead = lsp.inWaiting()
-            except:
-                print("Error while reading from pump")
+            if lsp.error is not None:
+                print("Error while communicating with pump: " + str(lsp.error))
                 pump_connected = False
                 print("Check pump connection and reboot")
-            if pump_connected and bytesToRead > 0:
-                try:
-                    message = lsp.readline()
-                except:
-                    print("Error while reading from pump")
-                    pump_connected = False
-                    print("Check pump connection and reboot")
-                #print(message)
-                if (pump_connected and message == b'/0`12\x03\r\n'):
-                    current_command += 1
+            for message in lsp.messages():
+                #print(message.data)
+                current_command = pump_scheduler.on_message(message.data)
+                if current_command >= 0:
                     # As a test, display the infos of the current command
-                    # print(commands_df.iloc[current_command])
-                    try:
-                        if commands_df.iloc[current_command]["action"] == "Dispense" or commands_df.iloc[current_command]["action"] == "Pick":
-                            title_delay = microflu.get_dispense_time(commands_df.iloc[current_command]["speed"])
-                            title_add_time = time.time()
-                            title_to_add = commands_df.iloc[current_command]["title"]
-                    except:
-                        print("Error while getting dispense time")
-
-        if spec_connected and dark_field_saving:
-            if len(dark_field) == 0:
-                dark_field = intensities_spec
-            else:
-                dark_field = dark_field + intensities_spec
-                
-            dark_field_counter += 1
-
-            if dark_field_counter == num_frames_for_save:
-                dark_field = dark_field / num_frames_for_save
-                dark_field_saving = False
-                dark_field_counter = 0
-                
-                if window["darkFieldStatus"].get() == "Dark field saved":
-                    window["darkFieldStatus"].update("Dark field updated")
-                else:
-                    window["darkFieldStatus"].update("Dark field saved")
-                if len(flat_field) > 0:
-                    normalize_gain = np.mean(flat_field - dark_field)
-
-        if spec_connected and flat_field_saving:
-            if len(flat_field) == 0:
-                flat_field = intensities_spec
-
-            else:
-                flat_field = flat_field + intensities_spec
-                
-            flat_field_counter += 1
-
-            if flat_field_counter == num_frames_for_save:
-                flat_field = flat_field / num_frames_for_save
-                flat_field_saving = False
-                flat_field_counter = 0
-                if window["flatFieldStatus"].get() == "Flat field saved":
-                    window["flatFieldStatus"].update("Flat field updated")
-                else:
-                    window["flatFieldStatus"].update("Flat field saved")
-                if len(dark_field) > 0:
-                    normalize_gain = np.mean(flat_field - dark_field)
-
-        # Acquisition of a new image
-        if camera_connected == True and (time.time() - last_acquisition_time) > acqPeriod and spec_connected == False:
-            success, ROI_center = get_new_image(cam, intensities, drawROI, filter_threshold, ROI_params, kernel_size, dilation_number, blockROI, ROI_center)
-            if success:
-                time_of_intensities.append(time.time() - clear_time)    
-                updatePlot(intensity_fig, intensity_ax, intensities, time_of_intensities, auto_scale, min_y, max_y, "Real time measurement of average intensity", "Time [s]", "Intensity [a.u.]")
-            
-            last_acquisition_time = time.time()
-
-        if spec_connected == True and (time.time() - last_acquisition_time) > acqPeriod and camera_connected == False:
-
-            # Get the spectrum
-            try:
-                wavelengths = spec.wavelengths()
-                wavelengths = wavelengths[100:-100] # Remove the first and last 100 values if the spectrum is too noisy at the extremities
-                intensities_spec = spec.intensities()
-                intensities_spec = intensities_spec[100:-100] # Remove the first and last 100 values if the spectrum is too noisy at the extremities
-            except:
+                    # print(pump_scheduler.program.commands[current_command])
+                    command = pump_scheduler.program.commands[current_command]
+                    if command.title != "":
+                        # The pump answers when the plunger starts, the liquid then goes through the tubing of the port
+                        title_time = message.timestamp + timing.marker_delay(pump_scheduler.timeline[current_command])
+                        title_to_add = command.title
+            pump_connected = pump_connected and pump_scheduler.update()
+
+            done, total, time_left = pump_scheduler.progress()
+            progress = "" if total == 0 else str(done) + "/" + str(total) + " commands, " + str(round(time_left / 60)) + " min left" + (" (paused)" if pump_scheduler.paused else "")
+            if progress != pump_progress:
+                window["pumpProgress"].update(progress)
+                pump_progress = progress
+
+        if arduino_connected:
+            if arduino.error is not None:
+                print("Error while communicating with arduino: " + str(arduino.error))
+                arduino_connected = False
+            for message in arduino.messages():
+                print("Arduino: " + message.data.decode(errors="replace").strip())
+
+        # Process the images acquired since the last iteration
+        if camera_connected == True and spec_connected == False:
+            if acquisition_thread.error is not None:
+                camera_connected = False
+                print("Error while getting image: " + str(acquisition_thread.error))
+                print("Check camera connection and reboot")
+            timestamps, frames = acquisition_buffer.drain()
+            for k in range(len(frames)):
+                # Only the most recent image is displayed
+                success, ROI_center, ave, roi_aves = get_new_image(frames[k], drawROI, filter_threshold, ROI_params, kernel_size, dilation_number, blockROI, ROI_center, display=(k == len(frames)-1), tracker=ROI_tracker, roi_set=fixed_ROIs)
+                if success:
+                    fixed_values = {"fixed_roi_" + str(i+1): roi_aves[i] for i in range(len(roi_aves))}
+                    camera_history.append(time=timestamps[k] - clear_time, intensity=ave, **fixed_values)
+                    run_recorder.record(time=timestamps[k] - clear_time, intensity=ave, **fixed_values)
+            if len(frames) > 0:
+                fixed_columns = ["fixed_roi_" + str(i+1) for i in range(len(fixed_ROIs))]
+                intensity_plot.update(camera_history["intensity"], camera_history["time"], extra_data_y=[camera_history[name] for name in fixed_columns])
+
+        # Process the spectra acquired since the last iteration
+        if spec_connected == True and camera_connected == False:
+            if acquisition_thread.error is not None:
                 spec_connected = False
                 print("Error while getting spectrum")
                 print("Check spectrometer connection and reboot")
-
-            # Low pass filter to smooth the spectrum
-            intensities_spec = signal.savgol_filter(intensities_spec, window_length=SG_window, polyorder=2, mode="nearest")
-            
-            if len(dark_field) > 0 and len(flat_field) > 0:
-                normalized_intensities_spec = (intensities_spec - dark_field) / (flat_field - dark_field) * normalize_gain
-            else:
-                normalized_intensities_spec = intensities_spec
-
-            # Remove all values if wavelength is not in the range
-            ranged_intensities_spec = intensities_spec[np.logical_and(wavelengths > wavelength_min, wavelengths < wavelength_max)]
-            ranged_wavelengths = wavelengths[np.logical_and(wavelengths > wavelength_min, wavelengths < wavelength_max)]
-            ranged_normalized_intensities_spec = normalized_intensities_spec[np.logical_and(wavelengths > wavelength_min, wavelengths < wavelength_max)]
-            
-            index_min_normalized = np.argmin(ranged_normalized_intensities_spec)
-
-            wavelength_min_peak = ranged_wavelengths[index_min_normalized]
-
-            if len(dark_field) > 0 and len(flat_field) > 0 and (not window_fixed):
-                print("Position of min peak: " + str(wavelength_min_peak) + " nm")
-
-                # Get index at same wavelength in the original spectrum
-                index_min = np.where(wavelengths == ranged_wavelengths[index_min_normalized])[0][0]
-
-                window_limits = (index_min - centroid_window_size, index_min + centroid_window_size)
-                if window_limits[0] < 0:
-                    window_limits = (0, index_min + centroid_window_size)
-                if window_limits[1] > len(wavelengths):
-                    window_limits = (index_min - centroid_window_size, len(wavelengths)-1)
-
-                print("Min and max wavelength: " + str(wavelengths[window_limits[0]]) + " nm, " + str(wavelengths[window_limits[1]]) + " nm")
-                window["minPeakStatus"].update("Min : " + str(wavelengths[window_limits[0]]) + " nm, Max : " + str(wavelengths[window_limits[1]]) + " nm")
-                window_fixed = True
-
-            if window_fixed:
-                # Get x centroid of intensities around minimum peak
-
-                window_limits = (index_min - centroid_window_size, index_min + centroid_window_size)
-                if window_limits[0] < 0:
-                    window_limits = (0, index_min + centroid_window_size)
-                if window_limits[1] > len(wavelengths):
-                    window_limits = (index_min - centroid_window_size, len(wavelengths))
-                
-                reversed_intensities_spec = np.max(normalized_intensities_spec) - normalized_intensities_spec
-
-                centroid = np.sum(wavelengths[window_limits[0]:window_limits[1]] * reversed_intensities_spec[window_limits[0]:window_limits[1]]) / np.sum(reversed_intensities_spec[window_limits[0]:window_limits[1]])
-                centroids.append(centroid)
-            else:
-                centroids.append(wavelength_min_peak)
-
-            min_peak_wavelength.append(wavelength_min_peak)
-            time_of_intensities_spec.append(time.time() - clear_time)
-            if title_delay > 0 and time.time() - title_add_time > title_delay:
-                comments.append(title_to_add)
-                title_delay = -1
-                title_add_time = 0
-                title_to_add = ""
-            elif comment_added == True:
-                comments.append(window["plotComment"].get())
-                comment_added = False
-                layout.activateButton(window["addComment"], True)
-                layout.activateInput(window["plotComment"], True)
-            else:
-                comments.append("")
-
-            if window["plotRaw"].get() == True:
-                if window["plotNormalized"].get() == True:
-                    updatePlot(spectrometer_fig, spectrometer_ax, ranged_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Spectrometer", "Normalized"], ranged_normalized_intensities_spec)
+            timestamps, spectra = acquisition_buffer.drain()
+            if len(spectra) > 0:
+                spec_archive.append(spectra, timestamps - clear_time)
+
+            if len(spectra) > 0:
+                window_fixed = spectrum_processor.window_limits is not None
+                smoothed_spec, normalized_spec, min_peaks, centroids = spectrum_processor.process(spectra)
+
+                # The dark and flat fields are captured from the smoothed spectra, outliers rejected
+                if dark_capture is not None and dark_capture.add(smoothed_spec):
+                    window["darkFieldStatus"].update("Dark field updated" if len(dark_field) > 0 else "Dark field saved")
+                    dark_field = dark_capture.clipped_mean()
+                    dark_capture = None
+                    spec_archive.set_dark_field(dark_field)
+                    spectrum_processor.set_fields(dark_field, flat_field)
+                    if len(dark_field) > 0 and len(flat_field) > 0:
+                        calibration_store.save(spec.serial_number, integration_time_us, 100, SG_window, dark_field, flat_field)
+                if flat_capture is not None and flat_capture.add(smoothed_spec):
+                    window["flatFieldStatus"].update("Flat field updated" if len(flat_field) > 0 else "Flat field saved")
+                    flat_field = flat_capture.clipped_mean()
+                    flat_capture = None
+                    spec_archive.set_flat_field(flat_field)
+                    spectrum_processor.set_fields(dark_field, flat_field)
+                    if len(dark_field) > 0 and len(flat_field) > 0:
+                        calibration_store.save(spec.serial_number, integration_time_us, 100, SG_window, dark_field, flat_field)
+                # Keep the last spectrum to display it, save it and capture the dark and flat fields
+                # The smoothed spectra are overwritten by the next batch, so they are copied
+                intensities_spec = smoothed_spec[-1].copy()
+                normalized_intensities_spec = normalized_spec[-1].copy()
+                ranged_wavelengths = wavelengths[spectrum_processor.range]
+                ranged_intensities_spec = intensities_spec[spectrum_processor.range]
+                ranged_normalized_intensities_spec = normalized_intensities_spec[spectrum_processor.range]
+
+                if not window_fixed and spectrum_processor.window_limits is not None:
+                    window_limits = (spectrum_processor.window_limits[0], spectrum_processor.window_limits[1] - 1)
+                    print("Position of min peak: " + str(wavelengths[spectrum_processor.index_min]) + " nm")
+                    print("Min and max wavelength: " + str(wavelengths[window_limits[0]]) + " nm, " + str(wavelengths[window_limits[1]]) + " nm")
+                    window["minPeakStatus"].update("Min : " + str(wavelengths[window_limits[0]]) + " nm, Max : " + str(wavelengths[window_limits[1]]) + " nm")
+
+                spec_history.extend(time=timestamps - clear_time, min_peak=min_peaks, centroid=centroids)
+                run_recorder.extend(time=timestamps - clear_time, min_peak=min_peaks, centroid=centroids)
+                # A comment goes on the first spectrum acquired after it was added
+                first_new = len(spec_history) - len(spectra)
+                if title_time >= 0 and timestamps[-1] >= title_time:
+                    # The title goes on the first spectrum acquired once the liquid reached the chip
+                    title_index = first_new + int(np.searchsorted(timestamps, title_time))
+                    spec_history.add_comment(title_to_add, title_index)
+                    run_recorder.add_comment(title_to_add, title_index)
+                    segment_fit.reset()
+                    title_time = -1
+                    title_to_add = ""
+                elif comment_added == True:
+                    spec_history.add_comment(window["plotComment"].get(), first_new)
+                    run_recorder.add_comment(window["plotComment"].get(), first_new)
+                    segment_fit.reset()
+                    comment_added = False
+                    layout.activateButton(window["addComment"], True)
+                    layout.activateInput(window["plotComment"], True)
+
+                # A comment starts a new segment, its fit is shown over the segment with its parameters
+                segment_fit.extend(timestamps - clear_time, centroids)
+                fit_params = segment_fit.params()
+                if fit_params is not None:
+                    fit_time = np.linspace(segment_fit.t0, timestamps[-1] - clear_time, 100)
+                    intensity_plot.set_fit(fit_time, segment_fit.fitted(fit_time), "a = %.3f nm, b = %.2e 1/s, c = %.3f nm" % fit_params)
                 else:
-                    updatePlot(spectrometer_fig, spectrometer_ax, ranged_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Spectrometer"])
-            elif window["plotNormalized"].get() == True:
-                updatePlot(spectrometer_fig, spectrometer_ax, ranged_normalized_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Normalized"])
+                    intensity_plot.set_fit([], [])
+
+            if len(spectra) > 0:
+                if window["plotRaw"].get() == True:
+                    if window["plotNormalized"].get() == True:
+                        updatePlot(spectrometer_fig, spectrometer_ax, ranged_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Spectrometer", "Normalized"], ranged_normalized_intensities_spec)
+                    else:
+                        updatePlot(spectrometer_fig, spectrometer_ax, ranged_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Spectrometer"])
+                elif window["plotNormalized"].get() == True:
+                    updatePlot(spectrometer_fig, spectrometer_ax, ranged_normalized_intensities_spec, ranged_wavelengths, True, min_y, max_y, "Real time measurement of average intensity", "Wavelength [nm]", "Intensity [a.u.]", ["Normalized"])
             
-            updatePlot(intensity_fig, intensity_ax, min_peak_wavelength, time_of_intensities_spec, auto_scale, min_y, max_y, "Shift of the absorption peak over time", "Time [s]", "Wavelength [nm]", legends=["Raw", "Average", "Centroids"], data_y_2=centroids, comments=comments, mov_avg_size=moving_average_size)
-            last_acquisition_time = time.time()
+                intensity_plot.update(spec_history["min_peak"], spec_history["time"], data_y_2=spec_history["centroid"], comments=spec_history.comments)
         
         # Read the Event Loop
         event, values = window.read(timeout=10)
@@ -533,12 +617,19 @@ if __name__ == "__main__":
         
         elif event == "reconnectPump":
             if not pump_connected:
+                if isinstance(lsp, serial_io.SerialTransport):
+                    lsp.close()
                 lsp, pump_connected = microflu.connect_pump()
+                if pump_connected:
+                    lsp = serial_io.SerialTransport(lsp, "pump")
             else:
                 print("Pump already connected!")
         
         elif event == "kickOutBubble":
-            if pump_connected == True:
+            if pump_scheduler.active():
+                # The protocol relies on the valve, speed and plunger position it left
+                print("A protocol is running, abort it first")
+            elif pump_connected == True:
                 seq = microflu.get_kick_bubble_seq(window["inputPickupValve"].get(), window["inputDispenseValve"].get())
                 pump_connected = microflu.write_sequence_to_pump(lsp, seq)
             else:
@@ -549,8 +640,11 @@ if __name__ == "__main__":
                 channel_chosen = window["functionalizeChannel"].get()
                 if channel_chosen == "Channel 1" or channel_chosen == "Channel 2":
                     channel_1_chosen = True if channel_chosen == "Channel 1" else False
-                    seq = microflu.get_functionalize_seq(channel_1_chosen)
-                    pump_connected = microflu.write_sequence_to_pump(lsp, seq)
+                    program, saved = optimizer.optimize(protocol.compile_rows(microflu.get_functionalize_commands(channel_1_chosen), microflu.pump_position))
+                    if pump_scheduler.active():
+                        print("A protocol is already running")
+                    else:
+                        pump_connected = pump_scheduler.start(lsp, program, timing.timeline(program, dead_volumes))
                 else:
                     print("Choose a channel")
             else:
@@ -559,10 +653,27 @@ if __name__ == "__main__":
         elif event == "goToZero":
             if pump_connected == True:
                 print("Going to zero")
+                pump_scheduler.abort()
                 pump_connected = microflu.go_to_zero(lsp)
             else:
                 print("Check pump connection")
 
+        elif event == "pauseProtocol":
+            pump_scheduler.pause()
+
+        elif event == "resumeProtocol":
+            if pump_connected == True:
+                pump_connected = pump_scheduler.resume()
+            else:
+                print("Check pump connection")
+
+        elif event == "abortProtocol":
+            if pump_connected == True:
+                if pump_scheduler.program is not None and layout.yesNoPopup("Abort protocol?", "Abort protocol"):
+                    pump_connected = pump_scheduler.abort()
+            else:
+                print("Check pump connection")
+
         elif event == "reinit":
             if pump_connected == True:
                 pump_connected = microflu.initialize_LSPOne(lsp)
@@ -570,14 +681,20 @@ if __name__ == "__main__":
                 print("Check pump connection")
 
         elif event == "switchValve":
-            if pump_connected == True:
+            if pump_scheduler.active():
+                # The protocol relies on the valve, speed and plunger position it left
+                print("A protocol is running, abort it first")
+            elif pump_connected == True:
                 seq = microflu.change_to_valve_fastest(values['inputChosenValve'])
                 pump_connected = microflu.write_sequence_to_pump(lsp, seq)
             else:
                 print("Check pump connection")
 
         elif event == "setSpeed":
-            if pump_connected == True:
+            if pump_scheduler.active():
+                # The protocol relies on the valve, speed and plunger position it left
+                print("A protocol is running, abort it first")
+            elif pump_connected == True:
                 try:
                     seq = microflu.peak_speed_uL_min(window["inputChosenSpeed"].get())
                     pump_connected = microflu.write_sequence_to_pump(lsp, seq)
@@ -588,7 +705,10 @@ if __name__ == "__main__":
                 print("Check pump connection")
 
         elif event == "pickupVolume":
-            if pump_connected == True:
+            if pump_scheduler.active():
+                # The protocol relies on the valve, speed and plunger position it left
+                print("A protocol is running, abort it first")
+            elif pump_connected == True:
                 seq = microflu.pickup_uL(float(values['inputChosenPickUpVolume']))
                 print(seq)
                 pump_connected = microflu.write_sequence_to_pump(lsp, seq)
@@ -596,7 +716,10 @@ if __name__ == "__main__":
                 print("Check pump connection")
 
         elif event == "dispenseVolume":
-            if pump_connected == True:
+            if pump_scheduler.active():
+                # The protocol relies on the valve, speed and plunger position it left
+                print("A protocol is running, abort it first")
+            elif pump_connected == True:
                 seq = microflu.dispense_uL(float(values['inputChosenDispenseVolume']))
                 print(seq)
                 pump_connected = microflu.write_sequence_to_pump(lsp, seq)
@@ -677,93 +800,26 @@ if __name__ == "__main__":
         elif event == "sendProtocol":
             protocol_name = window["protocolAuto"].get()
             if protocol_name != "":
-                try:
-                    if pump_connected == True:
-                        commands_valid: bool = True
-                        seq: str = ""
-                        commands_seq = pd.read_csv("protocols/" + protocol_name)
-                        # iterate through the commands_seq
-                        for k in range(len(commands_seq)):
-                            port: str = str(commands_seq.iloc[k]["port"])
-                            action: str = commands_seq.iloc[k]["action"]
-                            volume: str = str(commands_seq.iloc[k]["volume"])
-                            speed: str = str(commands_seq.iloc[k]["speed"])
-                            title: str  = commands_seq.iloc[k]["title"]
-                            wait: str = commands_seq.iloc[k]["wait"]
-                                                        
-                            if port == "" and volume == "" and speed == "":
-                                # Empty commands are ignored
-                                continue
-                            else:
-                                # Check if all fields are filled correctly
-                                try:
-                                    # Port should be an int between 1 and 12
-                                    if port in ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12"]:
-                                        port = int(port)
-                                    else:
-                                        raise Exception
-                                except:
-                                    print("Invalid port, command " + str(k))
-                                    window[f'port_{k}'].update("")
-                                    commands_valid = False
-                                    break
-
-                                if action != "Pick" and action != "Dispense":
-                                    print("Invalid action, command " + str(k))
-                                    window[f'action_{k}'].update("Pick")
-                                    commands_valid = False
-                                    break
-
-                                try:
-                                    volume = float(volume)
-                                    if volume < 3 or volume > 200:
-                                        raise Exception
-                                except:
-                                    print("Invalid volume, command " + str(k))
-                                    window[f'volume_{k}'].update("")
-                                    commands_valid = False
-                                    break
-
-                                try:
-                                    speed = float(speed)
-                                    if (speed < 5) or (speed > 8000):
-                                        raise Exception
-                                except:
-                                    print("Invalid speed, command " + str(k))
-                                    window[f'speed_{k}'].update("")
-                                    commands_valid = False
-                                    break
-                                
-                                try:
-                                    if wait != "":
-                                        wait = int(wait)
-                                        if wait < 0 or wait > 86400000:
-                                            raise Exception
-                                    else:
-                                        wait = 0
-                                except:
-                                    print("Invalid wait, command " + str(k))
-                                    window[f'wait_{k}'].update("")
-                                    commands_valid = False
-                                    break
-
-                                # If all fields are valid, add the command to the sequence
-                                seq += microflu.seq_from_command(port, action, volume, speed, title, wait)
-                                   
-                        if commands_valid:
-                            if command_number > 0:
-                                if layout.yesNoPopup("Send commands?", "Send commands"):
-                                    # If all commands are valid, send the sequence to the pump
-                                    pump_connected = microflu.write_sequence_to_pump(lsp, seq)
-                                    current_command = -1
-
-                        else:
-                            print("At least one command is invalid")
+                if pump_connected == True:
+                    try:
+                        program, saved = optimizer.optimize(protocol.load_protocol("protocols/" + protocol_name, microflu.pump_position))
+                    except protocol.ProtocolError as e:
+                        print(str(e))
+                        print("At least one command is invalid")
+                    except Exception as e:
+                        print("Error while reading protocol: " + str(e))
                     else:
-                        print("Check pump connection")
-                    
-                except:
-                    print("Error while reading protocol")
+                        for warning in program.warnings:
+                            print(warning)
+                        print("Optimized protocol, " + str(round(saved, 1)) + " s saved")
+                        if len(program.commands) > 0:
+                            timeline = timing.timeline(program, dead_volumes)
+                            if pump_scheduler.active():
+                                print("A protocol is already running")
+                            elif layout.yesNoPopup("Send protocol? (" + str(round(timeline[-1].end / 60)) + " min)", "Send protocol"):
+                                pump_connected = pump_scheduler.start(lsp, program, timeline)
+                else:
+                    print("Check pump connection")
 
         elif event == "loadProtocol":
             protocol_name = window["protocolLoad"].get()
@@ -834,29 +890,14 @@ if __name__ == "__main__":
 
         elif event == "saveDarkField":
             if spec_connected == True:
-                dark_field_saving = True
-                dark_field_counter = 0
-                dark_field = []
-                dark_field = intensities_spec
-                if window["darkFieldStatus"].get() == "Dark field saved":
-                    window["darkFieldStatus"].update("Dark field updated")
-                else:
-                    window["darkFieldStatus"].update("Dark field saved")
-                if len(flat_field) > 0:
-                    normalize_gain = np.mean(flat_field - dark_field)
+                # The next spectra acquired are captured, the field is set once they are all there
+                dark_capture = calibration.FieldCapture(num_frames_for_save, len(wavelengths))
+                window["darkFieldStatus"].update("Capturing dark field")
 
         elif event == "saveFlatField":
             if spec_connected == True:
-                flat_field_saving = True
-                flat_field_counter = 0
-                flat_field = []
-                flat_field = intensities_spec
-                if window["flatFieldStatus"].get() == "Flat field saved":
-                    window["flatFieldStatus"].update("Flat field updated")
-                else:
-                    window["flatFieldStatus"].update("Flat field saved")
-                if len(dark_field) > 0:
-                    normalize_gain = np.mean(flat_field - dark_field)
+                flat_capture = calibration.FieldCapture(num_frames_for_save, len(wavelengths))
+                window["flatFieldStatus"].update("Capturing flat field")
 
         elif event == "setMovingAverage":
             if spec_connected == True:
@@ -866,6 +907,7 @@ if __name__ == "__main__":
                     moving_average_size = 100
                     window["movingAverage"].update("100")
                     print("Error while getting moving average input, moving average set to 100")
+                intensity_plot.set_mov_avg_size(moving_average_size)
 
         elif event == "setSGwindow":
             if spec_connected == True:
@@ -876,9 +918,15 @@ if __name__ == "__main__":
                         window["SavGol"].update("3")
                         print("Savitzky-Golay window set to 3")
                 except:
-                    SG_window = 100
-                    window["SavGol"].update("100")
-                    print("Savitzky-Golay window set to 100")
+                    SG_window = 101
+                    window["SavGol"].update("101")
+                    print("Savitzky-Golay window set to 101")
+                # The coefficients are only computed here, not for every spectrum
+                spectrum_processor.SG_filter.set_window(SG_window)
+                if spectrum_processor.SG_filter.window_length != SG_window:
+                    SG_window = spectrum_processor.SG_filter.window_length
+                    window["SavGol"].update(str(SG_window))
+                    print("Savitzky-Golay window must be odd, set to " + str(SG_window))
 
         elif event == "resetMinPeak":
             try:
@@ -895,48 +943,65 @@ if __name__ == "__main__":
             # Convert between nanometers and pixels, with 2068 pixels for 498-941 nm
             centroid_window_size = int(centroid_window_size * 2068 / (941 - 498))
 
-            window_fixed = False
+            if spec_connected == True:
+                spectrum_processor.reset_window(centroid_window_size)
 
         elif event == "saveCameraPlot":
+            # The run is already on disk, make sure it is synced, the csv is written from it on the export thread
+            flushed = run_recorder.flush()
+            if run_recorder.error is not None:
+                print("Error while recording the run: " + str(run_recorder.error))
             end_of_name = time.strftime("%Y%m%d_%H%M%S") + "_" + window["plotName"].get()
-            to_save = np.array([time_of_intensities, intensities]).astype(str).transpose()
-            to_save = np.insert(to_save, 0, ["Time", "Intensities"], axis=0)
-            np.savetxt(path + "/plots_saved/camera_plot_" + end_of_name + ".csv", to_save, delimiter=",", fmt="%s")
+            export_executor.submit(export_plot, run_recorder.directory, flushed, path + "/plots_saved/camera_plot_" + end_of_name + ".csv", "camera")
             intensity_fig.savefig(path + "/plots_saved/camera_plot_" + end_of_name + ".png", dpi=300)
 
         elif event == "saveSpecPlot":
+            # The run is already on disk, make sure it is synced, the csv is written from it on the export thread
+            flushed = run_recorder.flush()
+            if run_recorder.error is not None:
+                print("Error while recording the run: " + str(run_recorder.error))
             end_of_name = time.strftime("%Y%m%d_%H%M%S") + "_" + window["specPlotName"].get()
-            to_save = np.array([time_of_intensities_spec, min_peak_wavelength, comments, centroids]).astype(str).transpose()
-            to_save = np.insert(to_save, 0, ["Time", "Wavelengths", "Comments", "Centroids"], axis=0)
-            np.savetxt(path + "/plots_saved/spectrometer_plot_" + end_of_name + ".csv", to_save, delimiter=",", fmt="%s")
+            export_executor.submit(export_plot, run_recorder.directory, flushed, path + "/plots_saved/spectrometer_plot_" + end_of_name + ".csv", "spectrometer")
             intensity_fig.savefig(path + "/plots_saved/spectrometer_plot_" + end_of_name + ".png", dpi=300)
 
         elif event == "reconnectSpectrometer":
             if not spec_connected:
                 spec, spec_connected = connect_spectrometer()
+                if spec_connected:
+                    acquisition_thread.stop()
+                    acquisition_buffer.clear()
+                    acquisition_thread = acquisition.AcquisitionThread(spec.intensities, acquisition_buffer, acqPeriod, "spectrometer")
+                    acquisition_thread.start()
 
         elif event == "clearPlot":
             if layout.yesNoPopup("Clear the plot?", "Clearing plot"):
-                intensities = []
-                time_of_intensities = []
-                clear_time = time.time()
-                updatePlot(intensity_fig, intensity_ax, intensities, time_of_intensities, auto_scale, min_y, max_y, "Real time measurement of average intensity", "Time [s]", "Intensity [a.u.]")
+                camera_history.clear()
+                run_recorder.stop()
+                run_recorder = start_run_recorder(path, "camera", camera_history.columns)
+                clear_time = time.monotonic()
+                intensity_plot.reset()
 
         elif event == "clearSpecPlot":
             if layout.yesNoPopup("Clear the plot?", "Clearing plot"):
-                time_of_intensities_spec = []
-                min_peak_wavelength = []
-                comments = []
-                centroids = []
-                clear_time = time.time()
-                updatePlot(intensity_fig, intensity_ax, min_peak_wavelength, time_of_intensities_spec, auto_scale, min_y, max_y, "Shift of the absorption peak over time", "Time [s]", "Wavelength [nm]")
+                spec_history.clear()
+                segment_fit.reset()
+                run_recorder.stop()
+                run_recorder = start_run_recorder(path, "spectrometer", spec_history.columns)
+                spec_archive.close()
+                spec_archive = spectrum_archive.SpectrumArchive(run_recorder.directory + "/spectra", spec_archive.wavelengths, trim=100)
+                if len(dark_field) > 0:
+                    spec_archive.set_dark_field(dark_field)
+                if len(flat_field) > 0:
+                    spec_archive.set_flat_field(flat_field)
+                clear_time = time.monotonic()
+                intensity_plot.reset()
 
         elif event == "computeShift":
             if spec_connected:
                 gfapKey = window["gfapShiftKey"].get()
                 stopKey = window["stopShiftKey"].get()
-                shift_min = imgproc.compute_shift(time_of_intensities_spec, min_peak_wavelength, comments, moving_average_size, gfapKey, stopKey)
-                shift_cen = imgproc.compute_shift(time_of_intensities_spec, centroids, comments, moving_average_size, gfapKey, stopKey)
+                shift_min = spec_history.shift("min_peak", gfapKey, stopKey, moving_average_size)
+                shift_cen = spec_history.shift("centroid", gfapKey, stopKey, moving_average_size)
                 window['shiftTxt'].update("Shifts computed: min = " + str(shift_min) + "; centroid = " + str(shift_cen))
                 print("Shifts computed: min = " + str(shift_min) + "; centroid = " + str(shift_cen))
 
@@ -947,6 +1012,13 @@ if __name__ == "__main__":
                 print("Invalid acquisition period")
                 window["acquistionPeriodInput"].update("0.5")
                 acqPeriod = 0.5
+            if camera_connected or spec_connected:
+                acquisition_thread.period = acqPeriod
+                capacity = acquisition.buffer_capacity(acquisition_buffer.frame_shape or (), acquisition_buffer.dtype, acqPeriod)
+                if capacity != acquisition_buffer.capacity:
+                    # The frames not drained yet are lost, as when the buffer is full
+                    acquisition_buffer = acquisition.RingBuffer(capacity, acquisition_buffer.frame_shape, acquisition_buffer.dtype)
+                    acquisition_thread.buffer = acquisition_buffer
 
         elif event == "displayROI":
             # inverts the boolean each time
@@ -980,6 +1052,22 @@ if __name__ == "__main__":
             else:
                 window["ROIcenter"].update("Block ROI")
 
+        elif event == "addFixedROI":
+            # Add a fixed ROI with the current shape at the current ROI center, its trace starts now
+            if camera_connected == True:
+                fixed_ROIs.add_roi(ROI_params, ROI_center)
+                camera_history.add_column("fixed_roi_" + str(len(fixed_ROIs)))
+                run_recorder.set_columns(camera_history.columns)
+                intensity_plot.set_legends(["ROI"] + ["Fixed ROI " + str(k+1) for k in range(len(fixed_ROIs))])
+
+        elif event == "clearFixedROIs":
+            if camera_connected == True:
+                for k in range(len(fixed_ROIs)):
+                    camera_history.remove_column("fixed_roi_" + str(k+1))
+                fixed_ROIs.clear()
+                run_recorder.set_columns(camera_history.columns)
+                intensity_plot.set_legends([])
+
         elif event == "cameraGraph":
             if blockROI:
                 ROI_center = values[event]
@@ -988,17 +1076,15 @@ if __name__ == "__main__":
             kernel_size = int(window["IPparamKernelSize"].get())
             dilation_number = int(window["IPparamDilationNumber"].get())
             filter_threshold = int(window["IPparamThreshold"].get())
+            ROI_tracker.reset()
         
         elif event == "autoYAxis":
             auto_scale = window["autoYAxis"].get()
             layout.activateButton(window["applyYAxis"], not window["autoYAxis"].get())
             layout.activateInput(window["yAxisMin"], not window["autoYAxis"].get())
             layout.activateInput(window["yAxisMax"], not window["autoYAxis"].get())
-            if camera_connected:
-                updatePlot(intensity_fig, intensity_ax, intensities, time_of_intensities, auto_scale, min_y, max_y)
-                window.refresh()
-            elif spec_connected:
-                updatePlot(intensity_fig, intensity_ax, min_peak_wavelength, time_of_intensities_spec, auto_scale, min_y, max_y)
+            if camera_connected or spec_connected:
+                intensity_plot.set_y_limits(auto_scale, min_y, max_y)
                 window.refresh()
 
         elif event == "applyYAxis" or event == "applyYAxisSpec":
@@ -1025,6 +1111,8 @@ if __name__ == "__main__":
                 min_y = extrema[0]
                 window["yAxisMin"].update(str(min_y))
 
+            intensity_plot.set_y_limits(auto_scale, min_y, max_y)
+
         elif event == "applyWavelength":
             try:
                 wavelength_min = int(window["wavelengthMin"].get())
@@ -1046,10 +1134,16 @@ if __name__ == "__main__":
                 window["wavelengthMin"].update("500")
                 window["wavelengthMax"].update("900")
                 print("Invalid wavelength")
+            if spec_connected == True:
+                spectrum_processor.set_wavelength_range(wavelength_min, wavelength_max)
 
         elif event == "reconnectArduino":
             if not arduino_connected:
+                if isinstance(arduino, serial_io.SerialTransport):
+                    arduino.close()
                 arduino, arduino_connected = arduino_control.connect_arduino()
+                if arduino_connected:
+                    arduino = serial_io.SerialTransport(arduino, "arduino")
         
         elif event == "openChamber":
             if arduino_connected:
@@ -1065,86 +1159,23 @@ if __name__ == "__main__":
         
         elif event == "sendCommands":
             if pump_connected == True:
-                commands_valid: bool = True
-                seq: str = ""
-                commands_df = pd.DataFrame(columns=["port", "action", "volume", "speed", "title", "wait"])
-                for k in range(command_number):
-                    port: str = window[f'port_{k}'].get()
-                    action: str = window[f'action_{k}'].get()
-                    volume: str = window[f'volume_{k}'].get()
-                    speed: str = window[f'speed_{k}'].get()
-                    title: str  = window[f'title_{k}'].get()
-                    wait: str = window[f'wait_{k}'].get()
-                    
-                    if port == "" and volume == "" and speed == "":
-                        # Empty commands are ignored
-                        continue
-                    else:
-                        # Check if all fields are filled correctly
-                        try:
-                            # Port should be an int between 1 and 12
-                            if port in ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12"]:
-                                port = int(port)
-                            else:
-                                raise Exception
-                        except:
-                            print("Invalid port, command " + str(k))
-                            window[f'port_{k}'].update("")
-                            commands_valid = False
-                            break
-
-                        if action != "Pick" and action != "Dispense":
-                            print("Invalid action, command " + str(k))
-                            window[f'action_{k}'].update("Pick")
-                            commands_valid = False
-                            break
-
-                        try:
-                            volume = float(volume)
-                            if volume < 3 or volume > 200:
-                                raise Exception
-                        except:
-                            print("Invalid volume, command " + str(k))
-                            window[f'volume_{k}'].update("")
-                            commands_valid = False
-                            break
-
-                        try:
-                            speed = float(speed)
-                            if (speed < 5) or (speed > 8000):
-                                raise Exception
-                        except:
-                            print("Invalid speed, command " + str(k))
-                            window[f'speed_{k}'].update("")
-                            commands_valid = False
-                            break
-                        
-                        try:
-                            if wait != "":
-                                wait = int(wait)
-                                if wait < 0 or wait > 86400000:
-                                    raise Exception
-                            else:
-                                wait = 0
-                        except:
-                            print("Invalid wait, command " + str(k))
-                            window[f'wait_{k}'].update("")
-                            commands_valid = False
-                            break
-
-                        # If all fields are valid, add the command to the sequence
-                        seq += microflu.seq_from_command(port, action, volume, speed, title, wait)
-                        # Append the command to the dataframe
-                        commands_df = pd.concat([commands_df, pd.DataFrame([[port, action, volume, speed, title, wait]], columns=["port", "action", "volume", "speed", "title", "wait"])], ignore_index=True)
-                if commands_valid:
-                    if command_number > 0:
-                        if layout.yesNoPopup("Send commands?", "Send commands"):
-                            # If all commands are valid, send the sequence to the pump
-                            pump_connected = microflu.write_sequence_to_pump(lsp, seq)
-                            current_command = -1
-                
-                else:
+                rows = [[window[f'{name}_{k}'].get() for name in protocol.FIELDS] for k in range(command_number)]
+                try:
+                    program, saved = optimizer.optimize(protocol.compile_rows(rows, microflu.pump_position))
+                except protocol.ProtocolError as e:
+                    print(str(e))
+                    window[f'{e.field}_{e.index}'].update(protocol.RESET_VALUES[e.field])
                     print("At least one command is invalid")
+                else:
+                    for warning in program.warnings:
+                        print(warning)
+                    print("Optimized commands, " + str(round(saved, 1)) + " s saved")
+                    if pump_scheduler.active():
+                        print("A protocol is already running")
+                    elif command_number > 0:
+                        if layout.yesNoPopup("Send commands?", "Send commands"):
+                            # If all commands are valid, send the program to the pump
+                            pump_connected = pump_scheduler.start(lsp, program, timing.timeline(program, dead_volumes))
             else:
                 print("Check pump connection")
 
@@ -1162,9 +1193,21 @@ if __name__ == "__main__":
                     break
 
     # Stop the software
+    # Stop the acquisition before releasing the devices
+    if camera_connected or spec_connected:
+        acquisition_thread.stop()
+    if run_recorder is not None:
+        run_recorder.stop()
+    # Finish writing the csv of the plots saved
+    export_executor.shutdown(wait=True)
+    if spec_archive is not None:
+        spec_archive.close()
+
     # Pump go to zero
     if pump_connected == True:
         pump_connected = microflu.go_to_zero(lsp)
+    if isinstance(lsp, serial_io.SerialTransport):
+        lsp.close()
 
     # Turn off the camera
     if camera_connected == True:
@@ -1,5 +1,7 @@
+import time
 import numpy as np
 import cv2
+import functools
 from scipy.optimize import curve_fit
 
 class ROIparams:
@@ -10,7 +12,190 @@ class ROIparams:
         self.shape_type = shape_type
 
 
-def get_avg_intensity(img: np.ndarray, thr: float, params: ROIparams, kernel_size: int, dilation_number: int, ROIblocked: bool, center) -> float:
+class CentroidTracker:
+    """
+    Find the centroid of the bright spot used to place the automatic ROI without processing the full frame.
+
+    The spot is first detected on an image reduced `pyramid_levels` times by cv2.pyrDown (2 levels = 4x, 3 levels = 8x),
+    then the centroid is computed at full resolution in a window around the detected spot only.
+    When all the pixels above the threshold are inside this window, the centroid is the same as the one found on the full frame.
+    If `max_motion` is above 0, the detection is skipped as long as the centroid found in the previous window
+    moved by less than `max_motion` pixels and the spot did not reach the border of the window.
+    """
+    def __init__(self, pyramid_levels: int = 2, max_motion: float = 0):
+        self.pyramid_levels = pyramid_levels
+        self.max_motion = max_motion
+        self.window = None  # (top, bottom, left, right) of the full resolution window
+        self.center = None
+
+    def reset(self) -> None:
+        """
+        Force a new detection on the next frame, to be called when the image processing parameters change.
+        """
+        self.window = None
+        self.center = None
+
+    def locate(self, img: np.ndarray, thr: float, kernel_size: int, dilation_number: int, center):
+        """
+        Get the centroid of the pixels above the threshold.
+
+        :param img: The image to be processed.
+        :param thr: The threshold to be used for the mask.
+        :param kernel_size: The size of the kernel used for dilation.
+        :param dilation_number: The number of times the mask is dilated.
+        :param center: The centroid returned if no pixel is above the threshold.
+
+        :return: The centroid (cX, cY).
+        """
+        if self.max_motion > 0 and self.window is not None:
+            refined = self._refine(img, thr, kernel_size, dilation_number, self.window)
+            if refined is not None:
+                cX, cY, touches_border = refined
+                if not touches_border and np.hypot(cX - self.center[0], cY - self.center[1]) < self.max_motion:
+                    return cX, cY
+
+        self.window = self._detect(img, thr, kernel_size, dilation_number)
+        if self.window is None:
+            self.center = None
+            return center
+
+        refined = self._refine(img, thr, kernel_size, dilation_number, self.window)
+        while refined is not None and refined[2]:
+            # The spot is bigger than what was seen on the reduced image, grow the window
+            self.window = self._grow(img, self.window)
+            refined = self._refine(img, thr, kernel_size, dilation_number, self.window)
+        if refined is None:
+            self.window = None
+            self.center = None
+            return center
+        cX, cY, _ = refined
+        self.center = (cX, cY)
+        return cX, cY
+
+    def _detect(self, img: np.ndarray, thr: float, kernel_size: int, dilation_number: int):
+        """
+        Get the full resolution window containing the spot, found on the reduced image.
+        """
+        factor = 2**self.pyramid_levels
+        reduced = img
+        for _ in range(self.pyramid_levels):
+            reduced = cv2.pyrDown(reduced)
+
+        blur_size = max(3, (15 // factor) | 1)
+        smoothed = cv2.GaussianBlur(reduced, (blur_size, blur_size), 0)
+        mask = cv2.threshold(smoothed, thr, 255, cv2.THRESH_BINARY)[1]
+        dilated = cv2.dilate(mask, np.ones((kernel_size, kernel_size), np.uint8), iterations=dilation_number)
+        x, y, w, h = cv2.boundingRect(dilated)
+        if w == 0 or h == 0:
+            return None
+
+        # Margin for the pixels lost by the reduction, the blur and the dilation at full resolution
+        margin = 2*factor + 2*7 + dilation_number*(kernel_size//2)
+        top = max(y*factor - margin, 0)
+        bottom = min((y + h)*factor + margin, img.shape[0])
+        left = max(x*factor - margin, 0)
+        right = min((x + w)*factor + margin, img.shape[1])
+        return top, bottom, left, right
+
+    def _grow(self, img: np.ndarray, window):
+        """
+        Double the size of the window, without going out of the image.
+        """
+        top, bottom, left, right = window
+        half_height, half_width = (bottom - top) // 2 + 1, (right - left) // 2 + 1
+        return (max(top - half_height, 0), min(bottom + half_height, img.shape[0]),
+                max(left - half_width, 0), min(right + half_width, img.shape[1]))
+
+    def _refine(self, img: np.ndarray, thr: float, kernel_size: int, dilation_number: int, window):
+        """
+        Get the centroid at full resolution in the window, and whether the spot touches the border of the window.
+        """
+        top, bottom, left, right = window
+        crop = img[top:bottom, left:right]
+        smoothed = cv2.GaussianBlur(crop, (15, 15), 0)
+        mask = cv2.threshold(smoothed, thr, 255, cv2.THRESH_BINARY)[1]
+        dilated = cv2.dilate(mask, np.ones((kernel_size, kernel_size), np.uint8), iterations=dilation_number)
+        M = cv2.moments(dilated)
+        if M["m00"] == 0:
+            return None
+
+        # The border is only a problem where the window does not stop at the border of the image
+        touches_border = ((top > 0 and dilated[0, :].any()) or (bottom < img.shape[0] and dilated[-1, :].any())
+                          or (left > 0 and dilated[:, 0].any()) or (right < img.shape[1] and dilated[:, -1].any()))
+        cX = int(M["m10"] / M["m00"]) + left
+        cY = int(M["m01"] / M["m00"]) + top
+        return cX, cY, touches_border
+
+
+@functools.lru_cache(maxsize=16)
+def get_roi_stencil(shape_type: str, radius: int, width: int, height: int):
+    """
+    Get the mask of the ROI drawn in its own bounding box.
+    It is cached, so the mask is only drawn again when the geometry of the ROI changes.
+
+    :param shape_type: "circle" or "rectangle".
+    :param radius: The radius of the circle.
+    :param width: The width of the rectangle.
+    :param height: The height of the rectangle.
+    :type shape_type: str
+    :type radius: int
+    :type width: int
+    :type height: int
+
+    :return: The boolean mask of the bounding box and the position (x, y) of the ROI center in it.
+    """
+    if shape_type == "circle":
+        radius = int(radius)
+        center = (radius, radius)
+        stencil = np.zeros((2*radius + 1, 2*radius + 1), dtype=np.uint8)
+        cv2.circle(stencil, center, radius, 255, -1)
+    elif shape_type == "rectangle":
+        half_width, half_height = int(width/2), int(height/2)
+        center = (half_width, half_height)
+        stencil = np.zeros((2*half_height + 1, 2*half_width + 1), dtype=np.uint8)
+        cv2.rectangle(stencil, (0, 0), (2*half_width, 2*half_height), 255, -1)
+    else:
+        raise ValueError("Invalid ROI shape type.")
+
+    stencil = stencil == 255
+    stencil.setflags(write=False)
+    return stencil, center
+
+
+def masked_mean(img: np.ndarray, stencil: np.ndarray, x0: int, y0: int) -> float:
+    """
+    Get the mean of the image under a mask whose top left corner is at (x0, y0).
+    Only the part of the image covered by the mask is read, the mask is clipped at the borders of the image.
+
+    :param img: The image to be processed.
+    :param stencil: The boolean mask.
+    :param x0: The column of the image where the mask starts.
+    :param y0: The row of the image where the mask starts.
+    :type img: np.ndarray
+    :type stencil: np.ndarray
+    :type x0: int
+    :type y0: int
+
+    :return: The mean intensity under the mask, nan if the mask is outside of the image.
+    """
+    top, left = max(y0, 0), max(x0, 0)
+    bottom, right = min(y0 + stencil.shape[0], img.shape[0]), min(x0 + stencil.shape[1], img.shape[1])
+    if top >= bottom or left >= right:
+        return np.nan
+
+    crop = img[top:bottom, left:right]
+    stencil = stencil[top - y0:bottom - y0, left - x0:right - x0]
+
+    count = np.count_nonzero(stencil)
+    if count == 0:
+        return np.nan
+    if np.issubdtype(crop.dtype, np.integer):
+        # Integer sums are exact, so the mean is the same as on the full frame
+        return np.float64(int(crop.sum(where=stencil, dtype=np.int64)) / count)
+    return np.float64(crop.sum(where=stencil, dtype=np.float64) / count)
+
+
+def get_avg_intensity(img: np.ndarray, thr: float, params: ROIparams, kernel_size: int, dilation_number: int, ROIblocked: bool, center, tracker: CentroidTracker = None) -> float:
     """
     Get the average intensity of the image in the region of interest.
 
@@ -20,15 +205,19 @@ def get_avg_intensity(img: np.ndarray, thr: float, params: ROIparams, kernel_siz
     :param radius: The radius of the circular mask.
     :param kernel_size: The size of the kernel used for dilation.
     :param dilation_number: The number of times the mask is dilated.
+    :param tracker: If given, used to find the center of the ROI instead of processing the full frame.
     :type img: np.ndarray
     :type thr: float
     :type radius: float
     :type kernel_size: int
     :type dilation_number: int
+    :type tracker: CentroidTracker
 
     :return: The average intensity of the image in the region of interest.
     """
-    if not ROIblocked:
+    if not ROIblocked and tracker is not None:
+        cX, cY = tracker.locate(img, thr, kernel_size, dilation_number, center)
+    elif not ROIblocked:
         smoothed = cv2.GaussianBlur(img, (15, 15), 0)
         #I would change the Kernel size to 15, 15 from 201, 201 => and then try 
         mask = cv2.threshold(smoothed, thr, 255, cv2.THRESH_BINARY)[1]
@@ -43,18 +232,124 @@ def get_avg_intensity(img: np.ndarray, thr: float, params: ROIparams, kernel_siz
     else:
         cX, cY = center
         
-    mask = np.zeros_like(img, dtype=np.uint8)
+    stencil, (offset_x, offset_y) = get_roi_stencil(params.shape_type, params.radius, params.width, params.height)
+    ave = masked_mean(img, stencil, cX - offset_x, cY - offset_y)
 
-    if params.shape_type == "circle":
-        cv2.circle(mask, (cX, cY), params.radius, 255, -1)
-    elif params.shape_type == "rectangle":
-        cv2.rectangle(mask, (cX - int(params.width/2), cY - int(params.height/2)), (cX + int(params.width/2), cY + int(params.height/2)), 255, -1)
-    else:
-        raise ValueError("Invalid ROI shape type.")
+    return ave, (cX, cY)
 
-    ave = np.mean(img[mask == 255])
 
-    return ave, (cX, cY)
+class ROISet:
+    """
+    Several fixed ROIs (circles, rectangles or polygons) measured together in one pass over the frame.
+
+    The ROIs are drawn once in a labelled mask (0 for the background, k + 1 for the ROI k), from which only the
+    labels and the positions of the pixels inside the ROIs are kept until the ROIs or the image size change.
+    Where ROIs overlap, the pixels belong to the ROI added last.
+    """
+    def __init__(self):
+        self.rois = []  # list of (shape_type, geometry)
+        self._labels = None
+        self._pixels = None
+        self._labels_key = None
+
+    def __len__(self) -> int:
+        return len(self.rois)
+
+    def add_roi(self, params: ROIparams, center) -> None:
+        """
+        Add a circle or a rectangle described by ROI parameters.
+
+        :param params: The shape of the ROI.
+        :param center: The center (cX, cY) of the ROI in the image.
+        """
+        cX, cY = int(center[0]), int(center[1])
+        if params.shape_type == "circle":
+            self.rois.append(("circle", (cX, cY, int(params.radius))))
+        elif params.shape_type == "rectangle":
+            half_width, half_height = int(params.width/2), int(params.height/2)
+            self.rois.append(("rectangle", (cX - half_width, cY - half_height, cX + half_width, cY + half_height)))
+        else:
+            raise ValueError("Invalid ROI shape type.")
+
+    def add_polygon(self, points) -> None:
+        """
+        Add a polygon ROI.
+
+        :param points: The vertices [(x, y), ...] of the polygon in the image.
+        """
+        points = tuple((int(x), int(y)) for x, y in points)
+        if len(points) < 3:
+            raise ValueError("A polygon ROI needs at least 3 points.")
+        self.rois.append(("polygon", points))
+
+    def clear(self) -> None:
+        """
+        Remove all the ROIs.
+        """
+        self.rois = []
+
+    def _get_labels(self, shape: tuple):
+        """
+        Get the label and the flat index in the image of every pixel inside a ROI, computed again only if the geometry changed.
+        """
+        key = (tuple(self.rois), shape[:2])
+        if key == self._labels_key:
+            return self._labels, self._pixels
+
+        labels = np.zeros(shape[:2], dtype=np.int32)
+        for k, (shape_type, geometry) in enumerate(self.rois):
+            if shape_type == "circle":
+                cv2.circle(labels, geometry[:2], geometry[2], k + 1, -1)
+            elif shape_type == "rectangle":
+                cv2.rectangle(labels, geometry[:2], geometry[2:], k + 1, -1)
+            else:
+                cv2.fillPoly(labels, [np.array(geometry, dtype=np.int32)], k + 1)
+
+        labels = labels.ravel()
+        self._pixels = np.flatnonzero(labels)
+        self._labels = labels[self._pixels]
+        self._labels_key = key
+        return self._labels, self._pixels
+
+    def measure(self, img: np.ndarray):
+        """
+        Get the average and the standard deviation of the intensity in every ROI.
+
+        :param img: The image to be processed.
+        :type img: np.ndarray
+
+        :return: The means and the standard deviations, arrays with one value per ROI (nan if a ROI is outside of the image).
+        """
+        n = len(self.rois)
+        labels, pixels = self._get_labels(img.shape)
+        values = np.ascontiguousarray(img).reshape(-1)[pixels].astype(np.float64)
+
+        counts = np.bincount(labels, minlength=n + 1)[1:]
+        sums = np.bincount(labels, weights=values, minlength=n + 1)[1:]
+        sums_of_squares = np.bincount(labels, weights=values*values, minlength=n + 1)[1:]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+            stds = np.sqrt(np.maximum(sums_of_squares / counts - means*means, 0))
+        return means, stds
+
+    def draw(self, img: np.ndarray, scale: float = 1, color=255, thickness: int = 1) -> None:
+        """
+        Draw the outline of the ROIs on an image, which can be a reduced version of the measured image.
+
+        :param img: The image to draw on.
+        :param scale: The size of the image to draw on relative to the measured image.
+        :param color: The color of the outlines.
+        :param thickness: The thickness of the outlines.
+        """
+        for shape_type, geometry in self.rois:
+            scaled = [int(i * scale) for i in np.ravel(geometry)]
+            if shape_type == "circle":
+                cv2.circle(img, (scaled[0], scaled[1]), scaled[2], color, thickness)
+            elif shape_type == "rectangle":
+                cv2.rectangle(img, (scaled[0], scaled[1]), (scaled[2], scaled[3]), color, thickness)
+            else:
+                cv2.polylines(img, [np.array(scaled, dtype=np.int32).reshape(-1, 2)], True, color, thickness)
 
 
 def exponential(x, a, b, c):
@@ -74,39 +369,106 @@ def exponential(x, a, b, c):
     """
     return a * np.exp(-b * (x - x[0])) + c
 
+def exponential_jacobian(x, a, b, c):
+    """
+    Jacobian of the exponential function with respect to (a, b, c).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    e = np.exp(-b * (x - x[0]))
+    return np.column_stack((e, -a * (x - x[0]) * e, np.ones_like(x)))
+
 def linear_function(x, a, b):
     return a * x + b
-    
-def fit_segment(time_segment, segment):
+
+def linear_jacobian(x, a, b):
+    x = np.asarray(x, dtype=np.float64)
+    return np.column_stack((x, np.ones_like(x)))
+
+def exponential_initial_guess(x, y):
+    """
+    Initial parameters of the exponential function from a log-linear fit: with c a bit beyond the last value,
+    log(|y - c|) is linear in x with a slope of -b.
+
+    :param x: The independent variable.
+    :param y: The values to fit.
+    :type x: np.array(float)
+    :type y: np.array(float)
+
+    :return: The parameters (a, b, c).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    duration = max(x[-1] - x[0], 1e-9)
+    span = np.max(y) - np.min(y)
+    if span == 0:
+        return 0.0, 1 / duration, y[-1]
+
+    direction = np.sign(y[0] - y[-1]) if y[0] != y[-1] else 1.0
+    c = y[-1] - direction * 0.05 * span
+    distance = direction * (y - c)
+    valid = distance > 0
+    if np.count_nonzero(valid) >= 2:
+        slope, intercept = np.polyfit(x[valid] - x[0], np.log(distance[valid]), 1)
+        if slope < 0:
+            return direction * np.exp(intercept), -slope, c
+    return y[0] - c, 1 / duration, c
+
+def _fit_exponential(time_segment, segment, p0=None):
+    """
+    Fit a segment with the exponential function, anchored on its first point, with the analytic Jacobian.
+    Fall back on a linear fit, marked by False as last parameter, if the exponential fit fails.
+    """
+    time_segment = np.asarray(time_segment, dtype=np.float64)
+    segment = np.asarray(segment, dtype=np.float64)
+    sigma = np.ones(len(segment))
+    sigma[0] = 0.0001
+
+    if p0 is None:
+        p0 = exponential_initial_guess(time_segment, segment)
+    try:
+        params, _ = curve_fit(exponential, time_segment, segment, p0=p0, sigma=sigma, jac=exponential_jacobian)
+        return list(params)
+    except (RuntimeError, ValueError, TypeError):
+        try:
+            params, _ = curve_fit(linear_function, time_segment, segment, sigma=sigma, jac=linear_jacobian)
+        except (RuntimeError, ValueError, TypeError):
+            params = [0.0, segment[0]]
+        return list(params) + [False]
+
+def fit_segment(time_segment, segment, p0=None):
     """
     Fit a segment with the exponential function.
     It will enforce the curve to pass through the first point of the segment.
 
     :param time_segment: The time segment of the data.
     :param segment: The segment of the data.
+    :param p0: The initial parameters (a, b, c), guessed from a log-linear fit if not given.
 
     :type time_segment: list
     :type segment: list
+    :type p0: tuple
 
-    :return: The parameters of the exponential function.
+    :return: The parameters of the exponential function, or of the linear function followed by False if the exponential fit failed.
     """
-    sigma = np.ones(len(segment))
-    sigma[0] = 0.0001
-
-    try:
-        params, _ = curve_fit(exponential, time_segment, segment, sigma=sigma)
+    return _fit_exponential(time_segment, segment, p0)
 
-    except RuntimeError:
-        params = curve_fit(linear_function, time_segment, segment, sigma=sigma)
-        expo = False
-        params.append(expo)
-    return params
+def fit_value(time_segment, params):
+    """
+    Evaluate the fit of a segment, exponential or linear (marked by False as last parameter).
+    """
+    if params[-1] is False:
+        return linear_function(np.asarray(time_segment, dtype=np.float64), *params[0:2])
+    return exponential(np.asarray(time_segment, dtype=np.float64), *params)
 
 def fit_all_segments(time_segments, segments):
 
     """
     Fit all the segments with the exponential function.
 
+    Each segment is anchored on the last value of the fit of the previous segment, which makes the fits sequential.
+    So the segments are first fitted independently and these fits are the initial parameters of the anchored fits,
+    which then converge in a few iterations.
+
     :param time_segments: The time segments of the data.
     :param segments: The segments of the data.
 
@@ -115,53 +477,49 @@ def fit_all_segments(time_segments, segments):
 
     :return: The parameters of the exponential function for each segment.
     """
+    independent = [_fit_exponential(t, y) for t, y in zip(time_segments[1:], segments[1:])]
+
     params = []
     params_clean = []
-    
+
     # Fit the first segment
     params.append(fit_segment(time_segments[0], segments[0]))
 
-    # Fit the rest of the segments
+    # Anchor the rest of the segments
     for i in range(1, len(time_segments)):
-        # The first point of the segment is the last point of the previous fit
-        if params[i-1][-1] == False: #if the last fit was linear
+        if params[i-1][-1] is False: #if the last fit was linear
             #take only the linear function parameters
-            params4 = params[i-1][0:2]
-            params_clean.append(params4)
-            last_fit = linear_function(time_segments[i-1], *params4)
-        else: #if the last fit was exponential
-            last_fit = exponential(time_segments[i-1], *params[i-1])
+            params_clean.append(params[i-1][0:2])
 
-        # last_fit = exponential(time_segments[i-1], *params[i-1])
+        # The first point of the segment is the last point of the previous fit
+        last_fit = fit_value(time_segments[i-1], params[i-1])
         time_segment = np.concatenate(([time_segments[i-1][-1]], time_segments[i]))
         segment = np.concatenate(([last_fit[-1]], segments[i]))
 
-        params.append(fit_segment(time_segment, segment))
-    
-    if params[-1][-1] == False:
-        params4 = params[-1][0:2]
-        params_clean.append(params4)
-    
+        # The independent fit starts at the first point of the segment, move its amplitude to the anchor point
+        p0 = None
+        if independent[i-1][-1] is not False:
+            a, b, c = independent[i-1]
+            p0 = (a * np.exp(b * (time_segments[i][0] - time_segment[0])), b, c)
+        params.append(fit_segment(time_segment, segment, p0))
+
+    if params[-1][-1] is False:
+        params_clean.append(params[-1][0:2])
+
     return params, params_clean
 #params  parameters for the exponential function
 
-def post_processing(time, data_to_fit, titles, mov_avg_size):
+def split_segments(time, data_to_fit, titles, mov_avg_size):
     """
-    Perform post-processing on the data to fit. It assumes that the data to fit is exponential.
-    The titles list should be same length as the data_to_fit list. Everytime it contains
-    anything else than "", it considers that the data to fit is a new set of data.
+    Smooth the data with a moving average and split it in segments, a segment ending at each title.
 
     :param time: The time data.
     :param data_to_fit: The data to fit.
-    :param titles: The titles of the data to fit.
-
-    :type time: list
-    :type data_to_fit: list
-    :type titles: list
+    :param titles: The titles of the data, "" where there is none.
+    :param mov_avg_size: The size of the moving average, 1 if it is invalid.
 
-    :return: A vector being the concatenation of all fitted exponential functions.
+    :return: The time segments and the segments of the smoothed data.
     """
-
     try:
         mov_avg_size = int(mov_avg_size)
         if mov_avg_size < 1 or mov_avg_size > len(data_to_fit):
@@ -180,19 +538,38 @@ def post_processing(time, data_to_fit, titles, mov_avg_size):
     current_segment = []
     time_segments = []
     current_time_segment = []
-    segment_titles = ["Start"]
     for i in range(len(time_moving_avg)):
         current_segment.append(wavelength_moving_avg[i])
         current_time_segment.append(time_moving_avg[i])
         if titles[i] != "":
-            segment_titles.append(titles[i])
             segments.append(current_segment)
             time_segments.append(current_time_segment)
             current_segment = []
             current_time_segment = []
 
-    segments.append(current_segment)
-    time_segments.append(current_time_segment)
+    # A title on the last sample leaves nothing to fit after it
+    if len(current_segment) > 0 or len(segments) == 0:
+        segments.append(current_segment)
+        time_segments.append(current_time_segment)
+    return time_segments, segments
+
+def post_processing(time, data_to_fit, titles, mov_avg_size):
+    """
+    Perform post-processing on the data to fit. It assumes that the data to fit is exponential.
+    The titles list should be same length as the data_to_fit list. Everytime it contains
+    anything else than "", it considers that the data to fit is a new set of data.
+
+    :param time: The time data.
+    :param data_to_fit: The data to fit.
+    :param titles: The titles of the data to fit.
+
+    :type time: list
+    :type data_to_fit: list
+    :type titles: list
+
+    :return: A vector being the concatenation of all fitted exponential functions.
+    """
+    time_segments, segments = split_segments(time, data_to_fit, titles, mov_avg_size)
 
     # Fit the segments
     params, p_clean = fit_all_segments(time_segments, segments)
@@ -202,7 +579,7 @@ def post_processing(time, data_to_fit, titles, mov_avg_size):
     # here correct the plot 
     fitted_data = []
     for i in range(len(segments)):
-        fitted_data.append(exponential(time_segments[i], *params[i]))
+        fitted_data.append(fit_value(time_segments[i], params[i]))
 
     # Concatenate the fitted data
     fitted_data = np.concatenate(fitted_data)
@@ -212,12 +589,109 @@ def post_processing(time, data_to_fit, titles, mov_avg_size):
     return fitted_data, time_concat
 
 
+class OnlineExponentialFitter:
+    """
+    Fit of the current segment with the exponential function a * exp(-b * (t - t0)) + c, updated at each new sample.
+
+    For a given decay constant b the model is linear in a and c, so its least squares fit only needs a few sums over the
+    samples. These sums are kept for a fixed grid of decay constants and updated with each new sample, so adding a sample
+    costs the same whatever the length of the segment. The best decay constant of the grid is refined by a parabola
+    through the residuals of its neighbours.
+    """
+    def __init__(self, b_min: float = 1e-4, b_max: float = 1, n_rates: int = 96):
+        self.rates = np.geomspace(b_min, b_max, n_rates)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Start a new segment at the next sample.
+        """
+        self.n = 0
+        self.t0 = 0.0
+        self.y0 = 0.0
+        # Sums of y, y^2 (scalars) and of e, e^2, y * e with e = exp(-b * (t - t0)) (one per decay constant)
+        # y is taken relative to the first sample of the segment, for the precision of the sums
+        self.sum_y = 0.0
+        self.sum_yy = 0.0
+        self.sum_e = np.zeros(len(self.rates))
+        self.sum_ee = np.zeros(len(self.rates))
+        self.sum_ye = np.zeros(len(self.rates))
+
+    def add(self, t: float, y: float) -> None:
+        self.extend([t], [y])
+
+    def extend(self, t, y) -> None:
+        """
+        Add several samples of the segment.
+        """
+        t = np.asarray(t, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        keep = np.isfinite(t) & np.isfinite(y)
+        t, y = t[keep], y[keep]
+        if len(t) == 0:
+            return
+        if self.n == 0:
+            self.t0, self.y0 = t[0], y[0]
+        y = y - self.y0
+        e = np.exp(-np.outer(self.rates, t - self.t0))
+        self.n += len(t)
+        self.sum_y += np.sum(y)
+        self.sum_yy += np.sum(y * y)
+        self.sum_e += np.sum(e, axis=1)
+        self.sum_ee += np.sum(e * e, axis=1)
+        self.sum_ye += e @ y
+
+    def params(self):
+        """
+        :return: The parameters (a, b, c) of the exponential function, None if there are less than 3 samples or if the
+            segment is not long enough to tell the decay from the offset.
+        """
+        if self.n < 3:
+            return None
+        det = self.sum_ee * self.n - self.sum_e * self.sum_e
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = (self.n * self.sum_ye - self.sum_e * self.sum_y) / det
+            c = (self.sum_ee * self.sum_y - self.sum_e * self.sum_ye) / det
+        residuals = self.sum_yy - a * self.sum_ye - c * self.sum_y
+        residuals[~np.isfinite(residuals) | (det <= 1e-12 * self.n * self.n)] = np.inf
+        k = int(np.argmin(residuals))
+        if not np.isfinite(residuals[k]):
+            return None
+
+        b = self.rates[k]
+        if 0 < k < len(self.rates) - 1 and np.all(np.isfinite(residuals[k-1:k+2])):
+            left, center, right = residuals[k-1:k+2]
+            curvature = left - 2 * center + right
+            if curvature > 0:
+                offset = 0.5 * (left - right) / curvature
+                # Interpolate the parameters at the refined decay constant, on the logarithmic grid
+                weights = np.array([offset * (offset - 1) / 2, 1 - offset * offset, offset * (offset + 1) / 2])
+                b = np.exp(weights @ np.log(self.rates[k-1:k+2]))
+                return weights @ a[k-1:k+2], b, weights @ c[k-1:k+2] + self.y0
+        return a[k], b, c[k] + self.y0
+
+    def fitted(self, t):
+        """
+        :return: The fitted exponential function at the times t, None if there is no fit yet.
+        """
+        params = self.params()
+        if params is None:
+            return None
+        a, b, c = params
+        return a * np.exp(-b * (np.asarray(t) - self.t0)) + c
+
+
 ### POST PROCESSING - SECOND METHOD
 
 # Define the decaying exponential function
 def decaying_exponential_func(x, a, b, c):
     return a * np.exp(-b * x) + c
 
+def decaying_exponential_jacobian(x, a, b, c):
+    x = np.asarray(x, dtype=np.float64)
+    e = np.exp(-b * x)
+    return np.column_stack((e, -a * x * e, np.ones_like(x)))
+
 # Define the segment for fitting
 begin_instant = 2
 end_instant = 7
@@ -246,8 +720,12 @@ def fit_exponential_segment(x_data, y_data, begin_instant, end_instant):
     x_segment = x_data[begin_index:end_index+1]
     y_segment = y_data[begin_index:end_index+1]
 
-    # Fit the decaying exponential function to the segment data
-    params, covariance = curve_fit(decaying_exponential_func, x_segment, y_segment)
+    # Fit the decaying exponential function to the segment data, from a log-linear guess moved to the origin of x
+    a_guess, b_guess, c_guess = exponential_initial_guess(x_segment, y_segment)
+    with np.errstate(over="ignore"):
+        a_guess = a_guess * np.exp(b_guess * x_segment[0])
+    p0 = (a_guess, b_guess, c_guess) if np.isfinite(a_guess) else None
+    params, covariance = curve_fit(decaying_exponential_func, x_segment, y_segment, p0=p0, jac=decaying_exponential_jacobian)
 
     # Extract the fitted parameters
     a_fit, b_fit, c_fit = params
@@ -289,11 +767,40 @@ def compute_shift(time, wavelenght, comments, window_size, gfap="GFAP", stop="ST
     return shift
 
 
+def benchmark(n_frames: int = 40, shape: tuple = (3648, 5472), max_error: float = 1, seed: int = 0) -> bool:
+    """
+    Compare the CentroidTracker of the GUI (2 pyramid levels, max motion of 10 pixels) with the centroid of the full frame,
+    on synthetic frames of the camera with a Gaussian spot drifting by a few pixels per frame and jumping every 10 frames.
+    Print the time per frame of both and the error of the tracker, in pixels.
 
-
-
-
-
-
-
-
+    :return: True if the error of the tracker is at most max_error pixels on every frame.
+    """
+    rng = np.random.default_rng(seed)
+    rows, columns = np.arange(shape[0])[:, np.newaxis], np.arange(shape[1])[np.newaxis, :]
+    position = np.array([shape[0] / 2, shape[1] / 2])
+    frames = []
+    for k in range(n_frames):
+        position += rng.normal(0, 3, 2) if k % 10 != 0 else rng.uniform(-300, 300, 2)
+        spot = 200 * np.exp(-((rows - position[0])**2 + (columns - position[1])**2) / (2 * rng.uniform(30, 60)**2))
+        frames.append(np.clip(20 + spot + rng.normal(0, 5, shape), 0, 255).astype(np.uint8))
+
+    params = ROIparams(500, 1000, 1000, "circle")
+    tracker = CentroidTracker(pyramid_levels=2, max_motion=10)
+    full_time, tracker_time, errors = 0.0, 0.0, []
+    for frame in frames:
+        start = time.perf_counter()
+        _, full_center = get_avg_intensity(frame, 90, params, 3, 2, False, (0, 0))
+        full_time += time.perf_counter() - start
+        start = time.perf_counter()
+        _, tracker_center = get_avg_intensity(frame, 90, params, 3, 2, False, (0, 0), tracker)
+        tracker_time += time.perf_counter() - start
+        errors.append(np.hypot(tracker_center[0] - full_center[0], tracker_center[1] - full_center[1]))
+
+    print("full frame: %.1f ms/frame, tracker: %.1f ms/frame" % (full_time / n_frames * 1000, tracker_time / n_frames * 1000))
+    print("tracker error: max %.2f px, mean %.2f px (bound %.2f px)" % (max(errors), np.mean(errors), max_error))
+    return max(errors) <= max_error
+
+
+if __name__ == "__main__":
+    if not benchmark():
+        raise SystemExit("The tracker does not find the centroid of the full frame")
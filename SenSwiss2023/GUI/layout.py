@@ -131,6 +131,10 @@ def create_layout(logo_size: typing.Tuple[int, int], camera_img_size: typing.Tup
             sg.Input("1000", key="ROIwidthInput", size=(6, 1), background_color="#424242"),
             sg.Button("Set ROI params", key="ROIparams"),
         ],
+        [
+            sg.Button("Add fixed ROI", key="addFixedROI"),
+            sg.Button("Clear fixed ROIs", key="clearFixedROIs"),
+        ],
         [
             sg.Button("Set", key="IPparameters"),
             sg.Text("Kernel size:"),
@@ -183,7 +187,7 @@ def create_layout(logo_size: typing.Tuple[int, int], camera_img_size: typing.Tup
             sg.Button("Set moving average", key="setMovingAverage"),
         ],
         [
-            sg.Input("100", key="SavGol", size=(8, 1)),
+            sg.Input("101", key="SavGol", size=(8, 1)),
             sg.Button("Set SG window", key="setSGwindow"),
         ],
         [
@@ -250,6 +254,12 @@ def create_layout(logo_size: typing.Tuple[int, int], camera_img_size: typing.Tup
             sg.Button("Stop and trash", key="goToZero"),
             sg.Button("Reinitialize", key="reinit"),
         ],
+        [
+            sg.Button("Pause protocol", key="pauseProtocol"),
+            sg.Button("Resume", key="resumeProtocol"),
+            sg.Button("Abort", key="abortProtocol"),
+            sg.Text("", key="pumpProgress", size=(30, 1)),
+        ],
         [
             sg.Button("Kick out bubble", key="kickOutBubble"),
             sg.Text("Pick from: "),
@@ -14,6 +14,9 @@ wait_long: int = 2000       # ms
 wait_very_long: int = 5000  # ms
 wait_forever: int = 120000  # ms
 
+# Answer of the pump when a command is done
+command_done_message: bytes = b'/0`12\x03\r\n'
+
 # Sleep for the GUI
 sleep_short: float = 0.1    # s
 sleep_long: float = 20      # s
@@ -50,22 +53,30 @@ disp_buffer_speed: int = 50     # uL/min
 
 ###################### BASE FUNCTIONS ######################
 
+def find_pumps() -> list:
+    """
+    Finds the pumps connected to the computer.
+
+    Returns:
+        list of the serial devices of the pumps
+    """
+    ports = serial.tools.list_ports.comports(include_links=False)
+    # specific ID of Matilda
+    return sorted([port.device for port in ports if port.vid == 1027 and port.pid == 24597])
+
+
 def connect_pump() -> (serial.Serial, bool):
     """
-    Connects the pump to the computer.
+    Connects the first pump found to the computer.
 
     Returns:
         serial port of the pump, and a boolean that indicates if the pump is connected
     """
     try:
-        ports = serial.tools.list_ports.comports(include_links=False)
-        serial_port = ""
-        for port in ports :
-            if port.vid == 1027 and port.pid == 24597: # specific ID of Matilda
-                serial_port = port.device
-                break
-
-        lsp: serial.Serial = serial.Serial(serial_port, 9600, timeout=1000)
+        devices = find_pumps()
+        serial_port = devices[0] if len(devices) > 0 else ""
+
+        lsp: serial.Serial = serial.Serial(serial_port, 9600, timeout=1)
         initialize_LSPOne(lsp)
         print("Pump connected")
         pump_connected = True
@@ -492,6 +503,26 @@ def halt(lsp: serial.Serial) -> bool:
         return False
     
 
+def query_status(lsp: serial.Serial) -> bool:
+    """
+    Ask the status of the pump, it answers "/0" followed by the status byte.
+
+    Args:
+        lsp (serial.Serial): Serial port to write to.
+
+    Returns:
+        True if the query was sent successfully, False otherwise.
+    """
+    seq = "/1Q\r"
+
+    try:
+        lsp.write(seq.encode())
+        return True
+    except:
+        print("Error writing sequence to pump, check connection")
+        return False
+
+
 def get_heat_seq(temp: float = 37.5) -> str:
     """
     Get the heating sequence for the LSP-One pump.
@@ -528,77 +559,74 @@ def go_to_zero(lsp: serial.Serial) -> bool:
     success2 = write_sequence_to_pump(lsp, final_sequence) 
     return success1 and success2
 
-def get_fill_seq() -> str:
+def get_fill_commands() -> list:
     """
     Fill the tubes with the correct contents to remove air bubbles.
+    Given as commands to compile (see protocol.py), like get_functionalize_commands.
 
     Returns:
-        str: Sequence to send to the pump.
+        list: Commands (port, action, volume, speed, title, wait).
     """
 
-    seq = ""
+    commands = []
     # First pick up big_tube_volume from each buffer channel (2, 3, 7, 8 and 12) at 50 uL/min. 
     # For PBS (7) do it last and do 200 uL
     # Each time dispense it into the waste channel (1) at trash_speed
     # Fill tube 2
-    seq += seq_from_command(edc_nhs_valve, "Pick", big_tube_volume, pick_speed)
+    commands.append([edc_nhs_valve, "Pick", big_tube_volume, pick_speed, "", ""])
     # Trash
-    seq += seq_from_command(trash_valve, "Dispense", big_tube_volume, trash_speed)
+    commands.append([trash_valve, "Dispense", big_tube_volume, trash_speed, "", ""])
     # Fill tube 3
-    seq += seq_from_command(bsa_valve, "Pick", big_tube_volume, pick_speed)
+    commands.append([bsa_valve, "Pick", big_tube_volume, pick_speed, "", ""])
     # Trash
-    seq += seq_from_command(trash_valve, "Dispense", big_tube_volume, trash_speed)
+    commands.append([trash_valve, "Dispense", big_tube_volume, trash_speed, "", ""])
     # Fill tube 8
-    seq += seq_from_command(ethanolamine_valve, "Pick", big_tube_volume, pick_speed)
+    commands.append([ethanolamine_valve, "Pick", big_tube_volume, pick_speed, "", ""])
     # Trash
-    seq += seq_from_command(trash_valve, "Dispense", big_tube_volume, trash_speed)
+    commands.append([trash_valve, "Dispense", big_tube_volume, trash_speed, "", ""])
     # Fill tube 12
-    seq += seq_from_command(hcl_valve, "Pick", big_tube_volume, pick_speed)
+    commands.append([hcl_valve, "Pick", big_tube_volume, pick_speed, "", ""])
     # Trash
-    seq += seq_from_command(trash_valve, "Dispense", big_tube_volume, trash_speed)
+    commands.append([trash_valve, "Dispense", big_tube_volume, trash_speed, "", ""])
     # Fill tube 7
-    seq += seq_from_command(running_buffer_valve, "Pick", 200, pick_speed)
+    commands.append([running_buffer_valve, "Pick", 200, pick_speed, "", ""])
     # Trash
-    seq += seq_from_command(trash_valve, "Dispense", 200, trash_speed)
+    commands.append([trash_valve, "Dispense", 200, trash_speed, "", ""])
 
     # Then pick up 4*small_tube_volume of PBS (7) at 50 uL/min and dispense small_tube_volule uL into valve 5 (channel 1) at 50 uL/min then
     # Same for valve 6 (channel 2)
     # Same for sample (valve 4) and antibodies (valve 9)
     # Fill syringe of PBS
-    seq += seq_from_command(running_buffer_valve, "Pick", 4*small_tube_volume, pick_speed)
+    commands.append([running_buffer_valve, "Pick", 4*small_tube_volume, pick_speed, "", ""])
     # Dispense 30 uL into each valve
-    seq += seq_from_command(channel_1_valve, "Dispense", small_tube_volume, disp_buffer_speed)
-    seq += seq_from_command(channel_2_valve, "Dispense", small_tube_volume, disp_buffer_speed)
-    seq += seq_from_command(sample_valve, "Dispense", small_tube_volume, disp_buffer_speed)
-    seq += seq_from_command(antibody_valve, "Dispense", small_tube_volume, disp_buffer_speed)
+    commands.append([channel_1_valve, "Dispense", small_tube_volume, disp_buffer_speed, "", ""])
+    commands.append([channel_2_valve, "Dispense", small_tube_volume, disp_buffer_speed, "", ""])
+    commands.append([sample_valve, "Dispense", small_tube_volume, disp_buffer_speed, "", ""])
+    commands.append([antibody_valve, "Dispense", small_tube_volume, disp_buffer_speed, "", ""])
 
-    return seq
+    return commands
 
-def get_functionalize_seq(use_channel_1: bool) -> str:
+def get_functionalize_commands(use_channel_1: bool) -> list:
     """
     Functionalize the surface of the chip.
+    The protocol is long, so it is given as commands to compile (see protocol.py) and stream to the pump in chunks.
 
     Returns:
-        str: Sequence to send to the pump.
+        list: Commands (port, action, volume, speed, title, wait).
     """
-    seq = ""
-
     channel = channel_1_valve if use_channel_1 else channel_2_valve
 
-    seq += seq_from_command(edc_nhs_valve, "Pick", 200, pick_speed)
-    seq += seq_from_command(channel, "Dispense", 200, disp_buffer_speed)
-    seq += seq_from_command(edc_nhs_valve, "Pick", 200, pick_speed)
-    seq += seq_from_command(channel, "Dispense", 200, disp_buffer_speed)
-    seq += seq_from_command(edc_nhs_valve, "Pick", 200, pick_speed)
-    seq += seq_from_command(channel, "Dispense", 200, disp_buffer_speed)
+    commands = []
+    for _ in range(3):
+        commands.append([edc_nhs_valve, "Pick", 200, pick_speed, "", ""])
+        commands.append([channel, "Dispense", 200, disp_buffer_speed, "", ""])
 
-    seq += seq_from_command(antibody_valve, "Pick", 200, 500)
-    seq += seq_from_command(channel, "Dispense", 200, disp_sample_speed)
-    seq += wait(30000)
-    seq += seq_from_command(antibody_valve, "Pick", 200, 500)
-    seq += seq_from_command(channel, "Dispense", 200, disp_sample_speed)
+    commands.append([antibody_valve, "Pick", 200, 500, "", ""])
+    commands.append([channel, "Dispense", 200, disp_sample_speed, "", 30000])
+    commands.append([antibody_valve, "Pick", 200, 500, "", ""])
+    commands.append([channel, "Dispense", 200, disp_sample_speed, "", ""])
 
-    return seq
+    return commands
 
 def get_kick_bubble_seq(pick_channel: int, dispense_channel: int) -> str:
     """
@@ -0,0 +1,115 @@
+import re
+import typing
+import microflu
+import protocol
+
+_TOKEN = re.compile(r"(\?|[A-Za-z])(\d*)")
+
+
+def optimize(program: protocol.Program, merge: bool = True) -> typing.Tuple[protocol.Program, float]:
+    """
+    Remove the motions of the pump that do not change the fluidic result of a compiled protocol.
+
+    Each command of microflu.seq_from_command moves the valve, waits, sets the speed and waits again.
+    The valve move and its wait are removed when the valve is already on the port, the speed is set only when
+    it changes and the wait after the speed set is removed. With merge, consecutive commands on the same port,
+    with the same action and speed, no wait between them and no title on the second one, are merged in one move;
+    the moves stay within the syringe since the plunger only goes one way.
+
+    Both sequences are then simulated (see simulate()) and the optimized program is only used if the liquid
+    moved, port by port and in the same order, is identical.
+
+    :return: The optimized program, or the program itself if it could not be proven identical, and the estimated time saved in seconds.
+    """
+    commands = list(program.commands)
+    if merge:
+        commands = _merge(commands)
+
+    optimized = []
+    valve = None
+    speed = None
+    elapsed = 0.0
+    for command in commands:
+        sequence = ""
+        waits = 0
+        if command.port != valve:
+            sequence += microflu.change_to_valve_fastest(command.port) + microflu.wait(microflu.wait_medium)
+            waits += microflu.wait_medium
+            valve = command.port
+        if microflu.peak_speed_uL_min(command.speed) != speed:
+            speed = microflu.peak_speed_uL_min(command.speed)
+            sequence += speed
+        # The query makes the pump answer when the plunger starts, it is kept for each command
+        sequence += "?801" + ("P" if command.action == "Pick" else "D") + str(command.steps)
+        if command.wait > 0:
+            sequence += microflu.wait(command.wait)
+        duration = (waits + command.wait) / 1000 + command.steps / protocol.pulses_per_second(command.speed)
+        optimized.append(command._replace(start_time=elapsed, duration=duration, sequence=sequence))
+        elapsed += duration
+
+    result = program._replace(
+        commands=tuple(optimized),
+        sequence="".join(command.sequence for command in optimized),
+        trajectory=(program.trajectory[0],) + tuple(command.position for command in optimized),
+        duration=elapsed,
+    )
+    if simulate(result.sequence, program.trajectory[0]) != simulate(program.sequence, program.trajectory[0]):
+        print("The optimized protocol does not move the same liquid, the protocol is not optimized")
+        return program, 0
+    return result, program.duration - result.duration
+
+
+def simulate(sequence: str, start_position: int = 0) -> typing.Tuple[typing.Tuple[typing.Tuple[int, int, int], ...], int]:
+    """
+    Run a pump sequence on a model of the pump and list the liquid it moves.
+
+    :param sequence: The commands, without the "/1" and "R" around them.
+    :param start_position: The plunger position before the sequence, in steps.
+
+    :return: The moves as (port, steps, speed in pulses/s), negative steps for a dispense, where the consecutive moves
+        on the same port in the same direction and at the same speed are summed, and the final plunger position.
+    :raise ValueError: If the sequence has a command the model does not know.
+    """
+    valve = None
+    speed = None
+    position = start_position
+    moves: typing.List[typing.List[int]] = []
+    for name, value in tokenize(sequence):
+        if name in ("B", "O"):
+            valve = int(value)
+        elif name == "V":
+            speed = int(value)
+        elif name in ("P", "D", "A"):
+            target = {"P": position + int(value), "D": position - int(value), "A": int(value)}[name]
+            target = min(max(target, 0), microflu.max_position)
+            steps = target - position
+            position = target
+            if steps == 0:
+                continue
+            if len(moves) > 0 and moves[-1][0] == valve and moves[-1][2] == speed and (moves[-1][1] > 0) == (steps > 0):
+                moves[-1][1] += steps
+            else:
+                moves.append([valve, steps, speed])
+        elif name not in ("M", "?"):
+            raise ValueError("Unknown pump command " + name + value)
+    return tuple(tuple(move) for move in moves), position
+
+
+def tokenize(sequence: str) -> typing.List[typing.Tuple[str, str]]:
+    """
+    Split a pump sequence in commands, as (letter, value), e.g. "B2M200" gives [("B", "2"), ("M", "200")].
+    """
+    return _TOKEN.findall(sequence)
+
+
+def _merge(commands: typing.List[protocol.Command]) -> typing.List[protocol.Command]:
+    merged: typing.List[protocol.Command] = []
+    for command in commands:
+        previous = merged[-1] if len(merged) > 0 else None
+        if (previous is not None and previous.port == command.port and previous.action == command.action
+                and protocol.pulses_per_second(previous.speed) == protocol.pulses_per_second(command.speed)
+                and previous.wait == 0 and command.title == ""):
+            merged[-1] = previous._replace(volume=previous.volume + command.volume, wait=command.wait, steps=previous.steps + command.steps, position=command.position)
+        else:
+            merged.append(command)
+    return merged
@@ -0,0 +1,171 @@
+import time
+import typing
+import numpy as np
+import spectrum
+
+
+class ParabolicEstimator:
+    """
+    Sub-pixel position of the minimum from the parabola through the minimum pixel and its two neighbours.
+    """
+    def estimate(self, spectra: np.ndarray, wavelengths: np.ndarray, index_min: np.ndarray) -> np.ndarray:
+        """
+        :param spectra: The spectra (frames x pixels).
+        :param wavelengths: The wavelength of each pixel.
+        :param index_min: The pixel of the minimum of each spectrum.
+        :type spectra: np.ndarray
+        :type wavelengths: np.ndarray
+        :type index_min: np.ndarray
+
+        :return: The wavelength of the minimum of each spectrum.
+        """
+        index, left, center, right = _neighbours(spectra, index_min)
+        return _to_wavelength(wavelengths, index + _vertex(left, center, right))
+
+
+class GaussianEstimator:
+    """
+    Sub-pixel position of the minimum from the Gaussian through the minimum pixel and its two neighbours,
+    i.e. the parabola through the logarithm of the dip depth. Exact for a Gaussian dip without noise.
+    """
+    def estimate(self, spectra: np.ndarray, wavelengths: np.ndarray, index_min: np.ndarray) -> np.ndarray:
+        index, left, center, right = _neighbours(spectra, index_min)
+        # Depth of the dip below the spectrum maximum, it has to be positive for the logarithm
+        top = np.max(spectra, axis=1)
+        tiny = np.finfo(np.float64).tiny
+        left, center, right = [np.log(np.maximum(top - values, tiny)) for values in (left, center, right)]
+        return _to_wavelength(wavelengths, index + _vertex(left, center, right))
+
+
+class LorentzianEstimator:
+    """
+    Least-squares fit of a Lorentzian dip offset - amplitude / (1 + ((x - x0) / gamma)^2) in a window around the
+    minimum pixel, with Gauss-Newton iterations on the analytic Jacobian.
+
+    The fit of a frame starts from the parameters of the previous frame, so it usually converges in one or two
+    iterations. If it fails, the parabolic estimate is used and the next fit starts from scratch.
+    """
+    def __init__(self, half_window: int = 20, max_iterations: int = 10, tolerance: float = 1e-4):
+        self.half_window = half_window
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.params: typing.Optional[np.ndarray] = None  # x0 (pixel), gamma (pixels), amplitude, offset
+
+    def reset(self) -> None:
+        self.params = None
+
+    def estimate(self, spectra: np.ndarray, wavelengths: np.ndarray, index_min: np.ndarray) -> np.ndarray:
+        positions = np.zeros(len(spectra))
+        for k in range(len(spectra)):
+            positions[k] = self._fit(spectra[k], int(index_min[k]))
+        return _to_wavelength(wavelengths, positions)
+
+    def _fit(self, spectrum: np.ndarray, index_min: int) -> float:
+        start = max(index_min - self.half_window, 0)
+        stop = min(index_min + self.half_window + 1, len(spectrum))
+        x = np.arange(start, stop, dtype=np.float64)
+        y = spectrum[start:stop]
+
+        params = self.params
+        if params is None or not start <= params[0] < stop:
+            params = np.array([index_min, self.half_window / 2, np.max(y) - np.min(y), np.max(y)], dtype=np.float64)
+        else:
+            params = params.copy()
+
+        for _ in range(self.max_iterations):
+            x0, gamma, amplitude, offset = params
+            u = (x - x0) / gamma
+            lorentz = 1 / (1 + u * u)
+            residuals = y - (offset - amplitude * lorentz)
+            jacobian = np.column_stack((
+                -amplitude * 2 * u * lorentz * lorentz / gamma,
+                -amplitude * 2 * u * u * lorentz * lorentz / gamma,
+                -lorentz,
+                np.ones_like(x),
+            ))
+            step = np.linalg.lstsq(jacobian, residuals, rcond=None)[0]
+            params += step
+            if not np.all(np.isfinite(params)) or params[1] <= 0 or not start <= params[0] < stop:
+                break
+            if abs(step[0]) < self.tolerance:
+                self.params = params
+                return params[0]
+
+        # Not converged, fall back on the parabola and start the next fit from scratch
+        self.params = None
+        index, left, center, right = _neighbours(spectrum[np.newaxis], np.array([index_min]))
+        return (index + _vertex(left, center, right))[0]
+
+
+class CentroidEstimator:
+    """
+    Centroid of the dip depth (window maximum - spectrum) in a window around the minimum pixel of each spectrum,
+    computed for all the spectra at once.
+    """
+    def __init__(self, half_window: int = 20):
+        self.half_window = half_window
+
+    def estimate(self, spectra: np.ndarray, wavelengths: np.ndarray, index_min: np.ndarray) -> np.ndarray:
+        # Keep the windows inside the spectra so they all have the same width
+        start = np.clip(index_min - self.half_window, 0, spectra.shape[1] - 2 * self.half_window - 1)
+        columns = start[:, np.newaxis] + np.arange(2 * self.half_window + 1)
+        windows = np.take_along_axis(spectra, columns, axis=1)
+        depth = np.max(windows, axis=1, keepdims=True) - windows
+        return np.sum(depth * wavelengths[columns], axis=1) / np.sum(depth, axis=1)
+
+
+def _neighbours(spectra: np.ndarray, index_min: np.ndarray):
+    # The minimum is moved away from the edges so it always has two neighbours
+    index = np.clip(index_min, 1, spectra.shape[1] - 2)
+    rows = np.arange(len(spectra))
+    return index, spectra[rows, index - 1], spectra[rows, index], spectra[rows, index + 1]
+
+
+def _vertex(left: np.ndarray, center: np.ndarray, right: np.ndarray) -> np.ndarray:
+    # Offset of the vertex of the parabola through (-1, left), (0, center), (1, right), in pixels
+    curvature = left - 2 * center + right
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = 0.5 * (left - right) / curvature
+    return np.where(np.isfinite(offset) & (np.abs(offset) <= 1), offset, 0)
+
+
+def _to_wavelength(wavelengths: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    return np.interp(positions, np.arange(len(wavelengths)), wavelengths)
+
+
+def benchmark(n_spectra: int = 500, noise: float = 0.002, shift: float = 0.05, seed: int = 0) -> None:
+    """
+    Compare the estimators on synthetic normalized spectra with a Lorentzian dip drifting by `shift` nm over the run,
+    with the pixel mapping of the MAYA2000PRO (2068 pixels for 498-941 nm) and Gaussian noise of relative std `noise`.
+    The spectra are smoothed with the Savitzky-Golay filter of the GUI before the estimation.
+    Print the time per spectrum and the noise floor, the std of the error to the true position, in pm.
+    """
+    rng = np.random.default_rng(seed)
+    wavelengths = np.linspace(498, 941, 2068)
+    true_positions = 650 + np.linspace(0, shift, n_spectra) + rng.uniform(0, 0.2)
+    spectra = 1 - 0.3 / (1 + ((wavelengths - true_positions[:, np.newaxis]) / 15) ** 2)
+    spectra += rng.normal(0, noise, spectra.shape)
+    spectra = spectrum.SpectrumProcessor(wavelengths, trim=0).smooth(spectra)
+    index_min = np.argmin(spectra, axis=1)
+
+    estimators = {
+        "argmin": None,
+        "parabolic": ParabolicEstimator(),
+        "gaussian": GaussianEstimator(),
+        "lorentzian": LorentzianEstimator(half_window=60),
+        "centroid": CentroidEstimator(half_window=60),
+    }
+    print("estimator    time [us/spectrum]    noise floor [pm]    bias [pm]")
+    for name, estimator in estimators.items():
+        start = time.perf_counter()
+        if estimator is None:
+            positions = wavelengths[index_min]
+        else:
+            positions = estimator.estimate(spectra, wavelengths, index_min)
+        duration = (time.perf_counter() - start) / n_spectra
+        error = (positions - true_positions) * 1000
+        print(name.ljust(13) + ("%.1f" % (duration * 1e6)).rjust(18) + ("%.1f" % np.std(error)).rjust(20) + ("%.1f" % np.mean(error)).rjust(13))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,408 @@
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.figure
+
+
+def _grow(array: np.ndarray, size: int) -> np.ndarray:
+    """
+    Return an array of at least `size` elements starting with the content of `array`, reallocated by doubling.
+    """
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2*len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class MinMaxPyramid:
+    """
+    Min/max envelope of a time series at every power of 2 resolution, kept up to date as samples are appended.
+
+    Level k stores, for each bucket of 2**k consecutive samples, the index of its minimum and of its maximum.
+    Appending samples only updates the buckets containing them. To draw a range, the finest level giving at most
+    `max_points` points is used: each bucket gives its minimum and its maximum in time order, so the peaks are never lost.
+    If the range has less than `max_points` samples, they are returned at full resolution.
+    """
+    def __init__(self):
+        self.clear()
+
+    def __len__(self) -> int:
+        return self.n
+
+    def clear(self) -> None:
+        self.n = 0
+        self.x = np.zeros(1024)
+        self.y = np.zeros(1024)
+        self.min_idx = []  # min_idx[k - 1] for level k
+        self.max_idx = []
+
+    def append(self, x, y) -> None:
+        """
+        Add samples at the end of the series, x has to be increasing.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) == 0:
+            return
+        start = self.n
+        self.n += len(x)
+        self.x = _grow(self.x, self.n)
+        self.y = _grow(self.y, self.n)
+        self.x[start:self.n] = x
+        self.y[start:self.n] = y
+
+        level = 1
+        while (self.n - 1) >> (level - 1) > 0:
+            # Buckets of this level containing new samples
+            first, last = start >> level, (self.n - 1) >> level
+            if level > len(self.min_idx):
+                self.min_idx.append(np.zeros(0, dtype=np.int64))
+                self.max_idx.append(np.zeros(0, dtype=np.int64))
+            self.min_idx[level - 1] = _grow(self.min_idx[level - 1], last + 1)
+            self.max_idx[level - 1] = _grow(self.max_idx[level - 1], last + 1)
+
+            # Children of the buckets in the level below, the right one may not exist yet for the last bucket
+            n_children = ((self.n - 1) >> (level - 1)) + 1
+            left = 2*np.arange(first, last + 1)
+            right = np.minimum(left + 1, n_children - 1)
+            if level == 1:
+                left_min, right_min, left_max, right_max = left, right, left, right
+            else:
+                child_min, child_max = self.min_idx[level - 2], self.max_idx[level - 2]
+                left_min, right_min, left_max, right_max = child_min[left], child_min[right], child_max[left], child_max[right]
+
+            # nan values are only kept if the whole bucket is nan
+            take_right = (self.y[right_min] < self.y[left_min]) | np.isnan(self.y[left_min])
+            self.min_idx[level - 1][first:last + 1] = np.where(take_right, right_min, left_min)
+            take_right = (self.y[right_max] > self.y[left_max]) | np.isnan(self.y[left_max])
+            self.max_idx[level - 1][first:last + 1] = np.where(take_right, right_max, left_max)
+            level += 1
+
+    def get(self, x_min: float, x_max: float, max_points: int):
+        """
+        Get the points to draw between x_min and x_max.
+
+        :param x_min: The beginning of the visible range.
+        :param x_max: The end of the visible range.
+        :param max_points: The maximum number of points to return (approximately).
+
+        :return: The x and y of the points to draw, views on the data if they are not decimated.
+        """
+        if self.n == 0:
+            return self.x[:0], self.y[:0]
+        x = self.x[:self.n]
+        # Keep one point on each side so the line goes to the border of the plot
+        first = max(np.searchsorted(x, x_min, side="left") - 1, 0)
+        last = min(np.searchsorted(x, x_max, side="right") + 1, self.n)
+        count = last - first
+        if count <= max_points:
+            return self.x[first:last], self.y[first:last]
+
+        level = min(int(np.ceil(np.log2(2*count / max(max_points, 2)))), len(self.min_idx))
+        if level == 0:
+            return self.x[first:last], self.y[first:last]
+        mins = self.min_idx[level - 1][first >> level:((last - 1) >> level) + 1]
+        maxs = self.max_idx[level - 1][first >> level:((last - 1) >> level) + 1]
+        indices = np.empty(2*len(mins), dtype=np.int64)
+        indices[0::2] = np.minimum(mins, maxs)
+        indices[1::2] = np.maximum(mins, maxs)
+        return self.x[indices], self.y[indices]
+
+
+class LivePlot:
+    """
+    Plot of values over time updated incrementally.
+
+    The axes, titles, grid, legend and comments are drawn once in a background which is only redrawn when they change
+    (new comment, new limits, new traces). The lines, the last value and its text are animated artists: for each update
+    the new samples are appended to them with set_data and only these artists are drawn again on top of the background (blitting).
+    The samples of each line are kept in a MinMaxPyramid, so at most about twice the width of the axes in pixels are drawn
+    per line, and changing the x limits (zoom) fetches the full resolution of the visible range only.
+    """
+    def __init__(self, fig: matplotlib.figure.Figure, ax: plt.Axes, title="Default Title", x_axis_title="Default axis", y_axis_title="Default axis", legends: list = [], mov_avg_size: int = -1, second_line: bool = False):
+        self.fig = fig
+        self.ax = ax
+        self.legends = legends
+        self.mov_avg_size = mov_avg_size
+        self.second_line = second_line
+
+        self.auto_y = True
+        self.min_y, self.max_y = 0, 1
+
+        ax.cla()
+        ax.set_title(title)
+        ax.set_xlabel(x_axis_title)
+        ax.set_ylabel(y_axis_title)
+        ax.grid()
+
+        self.line = ax.plot([], [], color='blue', animated=True)[0]
+        self.avg_line = ax.plot([], [], color='red', animated=True)[0]
+        self.line_2 = ax.plot([], [], color='green', animated=True)[0]
+        self.extra_lines = []
+        self.last_marker = ax.plot([], [], 'rx', animated=True)[0]
+        self.last_text = ax.text(0, 0, "", animated=True)
+        self.fit_line = ax.plot([], [], color='black', linestyle='--', animated=True)[0]
+        self.fit_text = ax.text(0.02, 0.98, "", transform=ax.transAxes, verticalalignment='top', animated=True)
+        self.comment_artists = []
+
+        self.pyramid = MinMaxPyramid()
+        self.avg_pyramid = MinMaxPyramid()
+        self.pyramid_2 = MinMaxPyramid()
+        self.extra_pyramids = []
+
+        self.background = None
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+        self.ax.callbacks.connect("xlim_changed", self._on_xlim_changed)
+        self._set_legend()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget all the samples, to be called when the data is cleared.
+        """
+        self.n = 0
+        self.n_comments = 0
+        self.data_x = []
+        self.data_y = []
+        for pyramid in [self.pyramid, self.avg_pyramid, self.pyramid_2] + self.extra_pyramids:
+            pyramid.clear()
+        self.x_range = None
+        self.y_range = None
+        for artist in self.comment_artists:
+            artist.remove()
+        self.comment_artists = []
+        for line in [self.line, self.avg_line, self.line_2, self.last_marker, self.fit_line] + self.extra_lines:
+            line.set_data([], [])
+        self.last_text.set_text("")
+        self.fit_text.set_text("")
+        self._set_limits()
+        self.redraw()
+
+    def set_y_limits(self, auto: bool, min_y: float, max_y: float) -> None:
+        """
+        Set the limits of the y axis, or let them follow the data.
+        """
+        self.auto_y = auto
+        self.min_y, self.max_y = min_y, max_y
+        if auto:
+            # The range of the data was not followed while the limits were fixed
+            self.y_range = None
+            self._extend_ranges([], [pyramid.y[:pyramid.n] for pyramid in [self.pyramid, self.avg_pyramid, self.pyramid_2] + self.extra_pyramids])
+        self._set_limits()
+        self.redraw()
+
+    def set_legends(self, legends: list) -> None:
+        """
+        Change the legends, in the order: main line, moving average, second line, extra lines.
+        """
+        self.legends = legends
+        self._set_legend()
+        self.redraw()
+
+    def set_fit(self, x, y, text: str = "") -> None:
+        """
+        Show a fitted curve and its parameters, drawn with the next update.
+
+        :param x: The times of the fitted curve.
+        :param y: The values of the fitted curve.
+        :param text: The parameters of the fit, written in the top left corner.
+        """
+        self.fit_line.set_data(x, y)
+        self.fit_text.set_text(text)
+
+    def set_mov_avg_size(self, mov_avg_size: int) -> None:
+        """
+        Change the size of the moving average, it is computed again over all the samples.
+        """
+        self.mov_avg_size = mov_avg_size
+        self.avg_pyramid.clear()
+        self._update_average(0)
+        self._set_lines()
+        self._set_legend()
+        self.redraw()
+
+    def update(self, data_y: list, data_x: list, data_y_2: list = [], comments: list = [], extra_data_y: list = []) -> None:
+        """
+        Add the samples not plotted yet. The lists are the complete histories, only their new elements are processed.
+
+        :param data_y: The values of the main line.
+        :param data_x: The times of the samples.
+        :param data_y_2: The values of the second line (optional).
+        :param comments: The comments, as (sample index, text) in the order they were added (optional).
+        :param extra_data_y: More lines, each one with a value per sample (optional).
+        """
+        if len(data_x) < self.n:
+            # The data was cleared
+            self.reset()
+        start = self.n
+        self.n = len(data_x)
+        self.data_x, self.data_y = data_x, data_y
+        full_redraw = False
+
+        if len(extra_data_y) != len(self.extra_lines):
+            self._set_extra_lines(len(extra_data_y))
+            full_redraw = True
+
+        # A new extra line also gets the samples before it was added
+        self.pyramid.append(data_x[start:], data_y[start:])
+        self.pyramid_2.append(data_x[len(self.pyramid_2):len(data_y_2)], data_y_2[len(self.pyramid_2):])
+        for pyramid, trace in zip(self.extra_pyramids, extra_data_y):
+            pyramid.append(data_x[len(pyramid):len(trace)], trace[len(pyramid):])
+        new_avg = self._update_average(start)
+
+        for index, text in comments[self.n_comments:]:
+            self.comment_artists.append(self.ax.axvline(x=data_x[index], color='r', linestyle='--'))
+            self.comment_artists.append(self.ax.text(data_x[index], 0, text, rotation=90))
+            full_redraw = True
+        self.n_comments = len(comments)
+
+        if self.n > 0:
+            self.last_marker.set_data([data_x[-1]], [data_y[-1]])
+            self.last_text.set_position((data_x[-1], data_y[-1]))
+            self.last_text.set_text(str(data_y[-1]))
+
+        if self.n > start:
+            new_y = [data_y[start:], data_y_2[start:], new_avg] + [trace[start:] for trace in extra_data_y]
+            full_redraw = self._extend_ranges(data_x[start:], new_y) or full_redraw
+
+        if full_redraw:
+            # The lines are set by the xlim_changed callback if the limits change
+            self._set_limits()
+            self._set_lines()
+            self.redraw()
+        else:
+            self._set_lines()
+            self.blit()
+
+    def redraw(self) -> None:
+        """
+        Draw the full figure, the background is saved again by the draw event.
+        """
+        self.fig.canvas.draw()
+
+    def blit(self) -> None:
+        """
+        Draw only the animated artists on top of the saved background.
+        """
+        if self.background is None:
+            self.redraw()
+            return
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.fig.bbox)
+
+    def _on_xlim_changed(self, ax) -> None:
+        self._set_lines()
+
+    def _set_lines(self) -> None:
+        """
+        Give to each line the points of the visible range, decimated to about twice the width of the axes in pixels.
+        """
+        x_min, x_max = self.ax.get_xlim()
+        max_points = max(2 * int(self.ax.bbox.width), 100)
+        for line, pyramid in zip([self.line, self.line_2] + self.extra_lines, [self.pyramid, self.pyramid_2] + self.extra_pyramids):
+            line.set_data(*pyramid.get(x_min, x_max, max_points))
+        # As before, the average is only shown once there are more samples than its size
+        if self.mov_avg_size > 0 and self.n > self.mov_avg_size:
+            self.avg_line.set_data(*self.avg_pyramid.get(x_min, x_max, max_points))
+        else:
+            self.avg_line.set_data([], [])
+
+    def _on_draw(self, event) -> None:
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self) -> None:
+        for artist in [self.line, self.avg_line, self.line_2] + self.extra_lines + [self.last_marker, self.last_text, self.fit_line, self.fit_text]:
+            self.fig.draw_artist(artist)
+
+    def _set_extra_lines(self, n: int) -> None:
+        for line in self.extra_lines:
+            line.remove()
+        self.extra_lines = [self.ax.plot([], [], animated=True)[0] for _ in range(n)]
+        self.extra_pyramids = [MinMaxPyramid() for _ in range(n)]
+        self._set_legend()
+
+    def _set_legend(self) -> None:
+        """
+        Draw the legend of the lines in use, in the background.
+        """
+        handles = [self.line]
+        if self.mov_avg_size > 0:
+            handles.append(self.avg_line)
+        if self.second_line:
+            handles.append(self.line_2)
+        handles += self.extra_lines
+
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+        if len(self.legends) > 0:
+            n = min(len(handles), len(self.legends))
+            self.ax.legend(handles[:n], self.legends[:n])
+
+    def _update_average(self, start: int) -> list:
+        """
+        Extend the moving average from the sample start, each new value only reads its own window.
+
+        :return: The new values of the moving average.
+        """
+        size = self.mov_avg_size
+        if size <= 0:
+            return []
+        first = max(start, size - 1)
+        new_avg = [np.sum(self.data_y[i - size + 1:i + 1]) / size for i in range(first, len(self.data_y))]
+        self.avg_pyramid.append(self.data_x[first:len(self.data_y)], new_avg)
+        return new_avg
+
+    def _extend_ranges(self, new_x: list, new_y: list) -> bool:
+        """
+        Update the ranges of the data, and tell if the limits of the axes have to change.
+        """
+        changed = False
+        if len(new_x) > 0:
+            if self.x_range is None:
+                self.x_range = [new_x[0], new_x[-1]]
+                changed = True
+            elif new_x[-1] > self.x_range[1]:
+                # Leave room for the next samples, so the limits do not change at every update
+                self.x_range[1] = self.x_range[0] + 1.5 * (new_x[-1] - self.x_range[0])
+                changed = True
+
+        if self.auto_y:
+            values = [np.asarray(v, dtype=float) for v in new_y if len(v) > 0]
+            values = np.concatenate(values) if len(values) > 0 else np.zeros(0)
+            values = values[np.isfinite(values)]
+            if len(values) > 0:
+                low, high = np.min(values), np.max(values)
+                if self.y_range is None:
+                    self.y_range = [low, high]
+                    changed = True
+                elif low < self.y_range[0] or high > self.y_range[1]:
+                    margin = 0.1 * (max(high, self.y_range[1]) - min(low, self.y_range[0]))
+                    self.y_range = [min(low - margin, self.y_range[0]), max(high + margin, self.y_range[1])]
+                    changed = True
+        return changed
+
+    def _set_limits(self) -> None:
+        """
+        Apply the ranges to the axes and move the comments texts to the bottom of the plot.
+        """
+        if self.x_range is not None:
+            if self.x_range[1] > self.x_range[0]:
+                self.ax.set_xlim(self.x_range[0], self.x_range[1])
+            else:
+                self.ax.set_xlim(self.x_range[0] - 1, self.x_range[0] + 1)
+
+        if not self.auto_y:
+            self.ax.set_ylim(self.min_y, self.max_y)
+        elif self.y_range is not None:
+            if self.y_range[1] > self.y_range[0]:
+                self.ax.set_ylim(self.y_range[0], self.y_range[1])
+            else:
+                self.ax.set_ylim(self.y_range[0] - 1, self.y_range[0] + 1)
+
+        min_y, max_y = self.ax.get_ylim()
+        y_pos_text = min_y + (max_y - min_y)/50
+        for artist in self.comment_artists[1::2]:
+            artist.set_y(y_pos_text)
@@ -0,0 +1,198 @@
+import csv
+import functools
+import hashlib
+import io
+import types
+import typing
+import microflu
+
+FIELDS = ["port", "action", "volume", "speed", "title", "wait"]
+VALID_PORTS = [str(port) for port in range(1, 13)]
+# Value written back in the GUI field of an invalid command
+RESET_VALUES = {"port": "", "action": "Pick", "volume": "", "speed": "", "title": "", "wait": ""}
+
+
+class ProtocolError(ValueError):
+    """
+    Invalid field of a protocol command, `index` is the line of the command and `field` the name of the field.
+    """
+    def __init__(self, index: int, field: str):
+        super().__init__("Invalid " + field + ", command " + str(index))
+        self.index = index
+        self.field = field
+
+
+class Command(typing.NamedTuple):
+    """
+    A validated pick or dispense command of a protocol.
+    """
+    index: int              # line of the command in the protocol
+    port: int
+    action: str             # "Pick" or "Dispense"
+    volume: float           # uL, as asked
+    speed: float            # uL/min
+    title: str
+    wait: int               # ms, after the command
+    steps: int              # plunger steps really moved, the move is cut at the ends of the syringe
+    position: int           # plunger position after the command, in steps
+    start_time: float       # s, from the start of the protocol
+    duration: float         # s
+    sequence: str           # LSPOne commands
+
+
+class Program(typing.NamedTuple):
+    """
+    A compiled protocol, immutable so a cached program can be shared.
+
+    trajectory is the plunger position in steps before the first command and after each command,
+    volumes the volume picked and dispensed at each port in uL, and warnings the moves cut at the ends of the syringe.
+    The duration counts the plunger moves and the waits, not the valve moves.
+    """
+    commands: typing.Tuple[Command, ...]
+    sequence: str
+    trajectory: typing.Tuple[int, ...]
+    volumes: typing.Mapping[int, typing.Tuple[float, float]]
+    duration: float
+    warnings: typing.Tuple[str, ...]
+    digest: str
+
+    def end_position(self) -> int:
+        return self.trajectory[-1]
+
+
+def check_command(index: int, port, action, volume, speed, title, wait) -> typing.Optional[tuple]:
+    """
+    Check the fields of a command, as read from the GUI or from a protocol file.
+
+    :return: The port, action, volume, speed, title and wait converted, or None if the command is empty.
+    :raise ProtocolError: If a field is invalid.
+    """
+    port, volume, speed = _text(port), _text(volume), _text(speed)
+    if port == "" and volume == "" and speed == "":
+        # Empty commands are ignored
+        return None
+
+    # Port should be an int between 1 and 12
+    if port not in VALID_PORTS:
+        raise ProtocolError(index, "port")
+    if action != "Pick" and action != "Dispense":
+        raise ProtocolError(index, "action")
+    try:
+        volume = float(volume)
+        if not 3 <= volume <= 200:
+            raise ValueError
+    except ValueError:
+        raise ProtocolError(index, "volume")
+    try:
+        speed = float(speed)
+        if not 5 <= speed <= 8000:
+            raise ValueError
+    except ValueError:
+        raise ProtocolError(index, "speed")
+    try:
+        wait = _text(wait)
+        wait = int(wait) if wait != "" else 0
+        if not 0 <= wait <= 86400000:
+            raise ValueError
+    except ValueError:
+        raise ProtocolError(index, "wait")
+    return int(port), action, volume, speed, _text(title), wait
+
+
+def compile_rows(rows: typing.Iterable[typing.Sequence], start_position: int = 0, digest: str = "") -> Program:
+    """
+    Compile the commands of a protocol, each row being (port, action, volume, speed, title, wait).
+
+    The plunger is simulated from start_position instead of following the global position of microflu,
+    so compiling does not change the state of the pump.
+
+    :param rows: The commands, empty ones are skipped.
+    :param start_position: The plunger position before the protocol, in steps.
+    :param digest: The hash of the protocol file, kept in the program.
+
+    :raise ProtocolError: At the first invalid command.
+    """
+    commands = []
+    trajectory = [start_position]
+    volumes: typing.Dict[int, typing.List[float]] = {}
+    warnings = []
+    position = start_position
+    elapsed = 0.0
+    for index, row in enumerate(rows):
+        checked = check_command(index, *(list(row) + [""] * (len(FIELDS) - len(row))))
+        if checked is None:
+            continue
+        port, action, volume, speed, title, wait = checked
+
+        steps = microflu.uL_volume_to_step(volume)
+        if action == "Pick":
+            moved = min(steps, microflu.max_position - position)
+            position += moved
+            move = "P" + str(moved)
+        else:
+            moved = min(steps, position)
+            position -= moved
+            move = "D" + str(moved)
+        if moved != steps:
+            warnings.append("Volume is overshooting, command " + str(index) + " moves " + str(moved) + " steps instead of " + str(steps))
+
+        sequence = (microflu.change_to_valve_fastest(port)
+                    + microflu.wait(microflu.wait_medium)
+                    + microflu.peak_speed_uL_min(speed)
+                    + microflu.wait(microflu.wait_medium)
+                    + "?801"
+                    + move)
+        if wait > 0:
+            sequence += microflu.wait(wait)
+
+        duration = (2 * microflu.wait_medium + wait) / 1000 + moved / pulses_per_second(speed)
+        commands.append(Command(index, port, action, volume, speed, title, wait, moved, position, elapsed, duration, sequence))
+        trajectory.append(position)
+        picked_dispensed = volumes.setdefault(port, [0.0, 0.0])
+        picked_dispensed[0 if action == "Pick" else 1] += step_to_uL(moved)
+        elapsed += duration
+
+    return Program(
+        commands=tuple(commands),
+        sequence="".join(command.sequence for command in commands),
+        trajectory=tuple(trajectory),
+        volumes=types.MappingProxyType({port: tuple(value) for port, value in volumes.items()}),
+        duration=elapsed,
+        warnings=tuple(warnings),
+        digest=digest,
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def compile_csv(content: bytes, start_position: int = 0) -> Program:
+    """
+    Compile the content of a protocol file, the program is cached so a protocol sent again is not compiled again.
+    """
+    reader = csv.DictReader(io.StringIO(content.decode("utf-8-sig")))
+    rows = [[row.get(name) for name in FIELDS] for row in reader]
+    return compile_rows(rows, start_position, hashlib.sha1(content).hexdigest())
+
+
+def load_protocol(file_path: str, start_position: int = 0) -> Program:
+    """
+    Read and compile a protocol file (see the protocols folder).
+
+    :raise ProtocolError: At the first invalid command.
+    """
+    with open(file_path, "rb") as f:
+        content = f.read()
+    return compile_csv(content, start_position)
+
+
+def pulses_per_second(speed: float) -> int:
+    # Same conversion as microflu.peak_speed_uL_min, for Matilda
+    return min(max(round(1/5 * speed), 1), 1600)
+
+
+def step_to_uL(steps: int) -> float:
+    return steps * microflu.volume_per_step * microflu.calibration_factor / 1000
+
+
+def _text(value) -> str:
+    # The fields are strings from the GUI and the csv module, None for a missing column
+    return "" if value is None else str(value).strip()
@@ -0,0 +1,224 @@
+"""
+Several LSPOne pumps driven by one computer, to run a protocol on several chips at the same time.
+
+Each pump has its own connection, plunger position and scheduler (see scheduler.py), so the protocols run
+independently. The pool is polled without blocking, from the GUI loop or from the command line.
+
+Usage, protocol k on the k-th pump (sorted by serial device):
+    python pump_pool.py protocols/fill_sample_tubes_PBS.csv protocols/fill_sample_tubes_ddH2O.csv
+"""
+import argparse
+import concurrent.futures
+import time
+import typing
+import serial
+import microflu
+import optimizer
+import protocol
+import scheduler
+import serial_io
+import timing
+
+STATUS_COLUMNS = ["device", "state", "commands", "time left [s]", "plunger [uL]", "error"]
+
+
+class Pump:
+    """
+    One LSPOne of the pool, with its plunger position instead of the global one of microflu.
+    """
+    def __init__(self, device: str, transport: serial_io.SerialTransport):
+        self.device = device
+        self.transport = transport
+        self.position: int = 0  # plunger position after the last chunk finished, in steps
+        self.scheduler = scheduler.PumpScheduler(on_position=self._set_position)
+
+    def connected(self) -> bool:
+        return self.transport.error is None
+
+    def run(self, rows: typing.Iterable[typing.Sequence], dead_volumes: typing.Optional[typing.Dict[int, float]] = None) -> bool:
+        """
+        Compile, optimize and start a protocol, each row being (port, action, volume, speed, title, wait).
+
+        :return: False if the pump is busy or if the first chunk could not be written.
+        :raise protocol.ProtocolError: If a command is invalid.
+        """
+        program, _ = optimizer.optimize(protocol.compile_rows(rows, self.position))
+        return self.start(program, dead_volumes)
+
+    def run_file(self, file_path: str, dead_volumes: typing.Optional[typing.Dict[int, float]] = None) -> bool:
+        """
+        Same as run() for a protocol file.
+        """
+        program, _ = optimizer.optimize(protocol.load_protocol(file_path, self.position))
+        return self.start(program, dead_volumes)
+
+    def start(self, program: protocol.Program, dead_volumes: typing.Optional[typing.Dict[int, float]] = None) -> bool:
+        if self.scheduler.active():
+            print("A protocol is already running on pump " + self.device)
+            return False
+        if program.trajectory[0] != self.position:
+            print("The protocol was compiled for another plunger position than the one of pump " + self.device)
+            return False
+        return self.scheduler.start(self.transport, program, timing.timeline(program, dead_volumes if dead_volumes is not None else {}))
+
+    def abort(self) -> bool:
+        return self.scheduler.abort()
+
+    def poll(self) -> typing.List[typing.Tuple[int, float]]:
+        """
+        Follow the protocol from the messages received and send its next chunk when the pump is ready.
+
+        :return: The commands that started as (index, time.monotonic() of the answer).
+        """
+        started = []
+        for message in self.transport.messages():
+            index = self.scheduler.on_message(message.data)
+            if index >= 0:
+                started.append((index, message.timestamp))
+        self.scheduler.update()
+        return started
+
+    def _set_position(self, position: int) -> None:
+        self.position = position
+
+    def status(self) -> dict:
+        done, total, time_left = self.scheduler.progress()
+        if not self.connected():
+            state = "disconnected"
+        elif self.scheduler.error != "":
+            state = "error"
+        elif self.scheduler.running():
+            state = "paused" if self.scheduler.paused else "running"
+        elif "aborted" in self.scheduler.states:
+            state = "aborted"
+        elif "pending" in self.scheduler.states:
+            state = "paused"
+        else:
+            state = "idle"
+        return {
+            "device": self.device,
+            "state": state,
+            "commands": str(done) + "/" + str(total),
+            "time left [s]": round(time_left),
+            "plunger [uL]": round(protocol.step_to_uL(self.scheduler.program.trajectory[done] if self.scheduler.running() else self.position), 1),
+            "error": self.scheduler.error if self.connected() else str(self.transport.error),
+        }
+
+
+class PumpPool:
+    """
+    All the LSPOne pumps connected, one Pump per serial device.
+    """
+    def __init__(self):
+        self.pumps: typing.Dict[str, Pump] = {}
+
+    def __len__(self) -> int:
+        return len(self.pumps)
+
+    def __getitem__(self, device: str) -> Pump:
+        return self.pumps[device]
+
+    def devices(self) -> typing.List[str]:
+        return sorted(self.pumps)
+
+    def discover(self) -> typing.List[str]:
+        """
+        Connect the pumps not connected yet. They are initialized in parallel, as the initialization takes about 20 s.
+
+        :return: The devices of the pumps connected.
+        """
+        new_devices = [device for device in microflu.find_pumps() if device not in self.pumps]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(new_devices), 1)) as executor:
+            ports = list(executor.map(_open_pump, new_devices))
+        connected = []
+        for device, port in zip(new_devices, ports):
+            if port is not None:
+                self.pumps[device] = Pump(device, serial_io.SerialTransport(port, "pump " + device))
+                connected.append(device)
+        return connected
+
+    def poll(self) -> typing.List[typing.Tuple[str, int, float]]:
+        """
+        Poll all the pumps.
+
+        :return: The commands that started as (device, index, time.monotonic() of the answer).
+        """
+        started = []
+        for device, pump in self.pumps.items():
+            if pump.connected():
+                started += [(device, index, timestamp) for index, timestamp in pump.poll()]
+        return started
+
+    def running(self) -> bool:
+        return any(pump.scheduler.running() for pump in self.pumps.values())
+
+    def abort(self) -> None:
+        for pump in self.pumps.values():
+            pump.abort()
+
+    def status(self) -> typing.List[dict]:
+        return [self.pumps[device].status() for device in self.devices()]
+
+    def status_text(self) -> str:
+        """
+        Table of the status of the pumps, with the number of protocols running and the time until all of them are done.
+        """
+        statuses = self.status()
+        widths = [max([len(name)] + [len(str(status[name])) for status in statuses]) for name in STATUS_COLUMNS]
+        lines = ["  ".join(name.ljust(width) for name, width in zip(STATUS_COLUMNS, widths))]
+        for status in statuses:
+            lines.append("  ".join(str(status[name]).ljust(width) for name, width in zip(STATUS_COLUMNS, widths)))
+        running = sum(status["state"] == "running" for status in statuses)
+        time_left = max([status["time left [s]"] for status in statuses], default=0)
+        lines.append(str(running) + "/" + str(len(statuses)) + " pumps running, all done in " + str(time_left) + " s")
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        for pump in self.pumps.values():
+            pump.transport.close()
+
+
+def _open_pump(device: str) -> typing.Optional[serial.Serial]:
+    try:
+        port = serial.Serial(device, 9600, timeout=1)
+        if not microflu.initialize_LSPOne(port):
+            port.close()
+            return None
+        return port
+    except Exception as e:
+        print("Pump " + device + " not connected: " + str(e))
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a protocol on each pump connected.")
+    parser.add_argument("protocols", nargs="+", help="protocol csv files, the k-th one runs on the k-th pump")
+    parser.add_argument("--tubing", default="tubing.csv", help="tubing of each port (default: tubing.csv)")
+    parser.add_argument("--status-period", type=float, default=10, help="period of the status display, in seconds (default: 10)")
+    args = parser.parse_args()
+
+    pool = PumpPool()
+    pool.discover()
+    if len(pool) < len(args.protocols):
+        print(str(len(args.protocols)) + " protocols for " + str(len(pool)) + " pumps, the last protocols are not run")
+    dead_volumes = timing.load_tubing(args.tubing)
+    for device, file_path in zip(pool.devices(), args.protocols):
+        try:
+            pool[device].run_file(file_path, dead_volumes)
+        except protocol.ProtocolError as e:
+            print(file_path + ": " + str(e))
+
+    try:
+        last_status = 0.0
+        while pool.running():
+            for device, index, _ in pool.poll():
+                print(device + ": command " + str(index) + " started")
+            if time.monotonic() - last_status > args.status_period:
+                print(pool.status_text())
+                last_status = time.monotonic()
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        print("Aborting all the protocols")
+        pool.abort()
+    print(pool.status_text())
+    pool.close()
@@ -0,0 +1,192 @@
+import csv
+import json
+import os
+import queue
+import threading
+import time
+import typing
+import numpy as np
+
+
+class RunRecorder(threading.Thread):
+    """
+    Background writer streaming the samples of a run to disk while it is acquired.
+
+    The run is a folder with append-only files:
+    - samples_XXXX.bin: raw float64 records, one value per column, a new chunk is started when the columns change
+      or when the chunk is full
+    - index.json: the columns of each chunk, rewritten atomically when a chunk is started
+    - comments.csv: the comments, as (sample index, text)
+
+    The files are flushed and synced every fsync_period seconds, so a crash loses at most the last seconds
+    and the partial run can be read back with load_run().
+    If writing fails, the thread stops and keeps the exception in `error`.
+    The folder must not exist yet, FileExistsError is raised otherwise.
+    """
+    def __init__(self, directory: str, columns: typing.List[str], fsync_period: float = 1, chunk_size: int = 65536):
+        super().__init__(name="recorder", daemon=True)
+        self.directory = directory
+        self.fsync_period = fsync_period
+        self.chunk_size = chunk_size
+        self.n = 0  # number of samples recorded, used to index the comments
+        self.error: typing.Optional[Exception] = None
+        self._columns = list(columns)
+        self._queue: queue.Queue = queue.Queue()
+        self._chunks: typing.List[dict] = []
+        self._chunk_file = None
+        self._chunk_count = 0
+        self._comments_file = None
+        # A run is never appended to an existing one, its samples and comment indices would be mixed
+        os.makedirs(directory, exist_ok=False)
+
+    def record(self, **values: float) -> None:
+        """
+        Queue one sample, every column has to be given.
+        """
+        self._queue.put(("sample", np.array([values[name] for name in self._columns], dtype=np.float64)))
+        self.n += 1
+
+    def extend(self, **values) -> None:
+        """
+        Queue several samples, every column has to be given with the same number of values.
+        """
+        block = np.column_stack([np.asarray(values[name], dtype=np.float64) for name in self._columns])
+        self._queue.put(("sample", block))
+        self.n += len(block)
+
+    def set_columns(self, columns: typing.List[str]) -> None:
+        """
+        Change the columns of the next samples, they are written in a new chunk.
+        """
+        self._columns = list(columns)
+        self._queue.put(("columns", list(columns)))
+
+    def add_comment(self, text: str, index: int = -1) -> None:
+        """
+        Attach a comment to a sample, the last one by default.
+        """
+        if index < 0:
+            index += self.n
+        self._queue.put(("comment", (index, text)))
+
+    def flush(self) -> threading.Event:
+        """
+        Ask the writer to flush and sync the files as soon as the queued samples are written.
+
+        :return: An event set once the files are synced, to read the run from another thread.
+        """
+        flushed = threading.Event()
+        self._queue.put(("flush", flushed))
+        return flushed
+
+    def stop(self, timeout: float = 5) -> None:
+        """
+        Write the queued samples, close the files and wait for the thread to finish.
+
+        :param timeout: The maximum time to wait for the thread, in seconds.
+        :type timeout: float
+        """
+        self._queue.put(("stop", None))
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        columns = list(self._columns)
+        last_sync = time.monotonic()
+        try:
+            self._comments_file = open(os.path.join(self.directory, "comments.csv"), "a", newline="")
+            comments_writer = csv.writer(self._comments_file)
+            self._new_chunk(columns)
+            while True:
+                try:
+                    kind, item = self._queue.get(timeout=self.fsync_period)
+                except queue.Empty:
+                    kind, item = "timeout", None
+
+                if kind == "sample":
+                    if self._chunk_count >= self.chunk_size:
+                        self._new_chunk(columns)
+                    self._chunk_file.write(item.tobytes())
+                    self._chunk_count += item.size // max(len(columns), 1)
+                elif kind == "columns":
+                    columns = item
+                    self._new_chunk(columns)
+                elif kind == "comment":
+                    comments_writer.writerow(item)
+
+                if kind in ("flush", "stop") or time.monotonic() - last_sync > self.fsync_period:
+                    self._sync()
+                    last_sync = time.monotonic()
+                if kind == "flush":
+                    item.set()
+                if kind == "stop":
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            for file in (self._chunk_file, self._comments_file):
+                if file is not None:
+                    file.close()
+
+    def _new_chunk(self, columns: typing.List[str]) -> None:
+        if self._chunk_file is not None:
+            self._sync()
+            self._chunk_file.close()
+        name = "samples_" + str(len(self._chunks)).zfill(4) + ".bin"
+        self._chunks.append({"file": name, "columns": columns})
+        self._chunk_file = open(os.path.join(self.directory, name), "ab")
+        self._chunk_count = 0
+
+        # Replace the index in one step, so it is never read half written
+        index_path = os.path.join(self.directory, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"dtype": "float64", "chunks": self._chunks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + ".tmp", index_path)
+
+    def _sync(self) -> None:
+        for file in (self._chunk_file, self._comments_file):
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def load_run(directory: str) -> typing.Tuple[typing.Dict[str, np.ndarray], typing.List[typing.Tuple[int, str]]]:
+    """
+    Read a run written by RunRecorder, also if the recording was interrupted.
+
+    :param directory: The folder of the run.
+    :type directory: str
+
+    :return: The columns, NaN for the samples recorded before a column existed, and the comments as (sample index, text).
+    """
+    with open(os.path.join(directory, "index.json")) as f:
+        index = json.load(f)
+
+    chunks = []
+    names: typing.List[str] = []
+    for chunk in index["chunks"]:
+        data = np.fromfile(os.path.join(directory, chunk["file"]), dtype=index["dtype"])
+        n_columns = len(chunk["columns"])
+        # A crash can leave a partially written record at the end
+        data = data[:len(data) - len(data) % n_columns].reshape(-1, n_columns) if n_columns > 0 else np.zeros((0, 0))
+        chunks.append((chunk["columns"], data))
+        names += [name for name in chunk["columns"] if name not in names]
+
+    n = sum(len(data) for _, data in chunks)
+    columns = {name: np.full(n, np.nan) for name in names}
+    start = 0
+    for chunk_columns, data in chunks:
+        for k, name in enumerate(chunk_columns):
+            columns[name][start:start + len(data)] = data[:, k]
+        start += len(data)
+
+    comments: typing.List[typing.Tuple[int, str]] = []
+    comments_path = os.path.join(directory, "comments.csv")
+    if os.path.exists(comments_path):
+        with open(comments_path, newline="") as f:
+            for row in csv.reader(f):
+                # Skip a comment line cut by a crash
+                if len(row) == 2 and row[0].isdigit() and int(row[0]) < n:
+                    comments.append((int(row[0]), row[1]))
+    return columns, comments
@@ -0,0 +1,238 @@
+import time
+import typing
+import microflu
+import optimizer
+import protocol
+import timing
+
+
+class PumpScheduler:
+    """
+    Stream a compiled protocol (see protocol.py) to the pump in chunks instead of one sequence,
+    so the length of a protocol is not limited by the buffer of the pump.
+
+    A chunk holds as many commands as fit in max_sequence_length characters and max_chunk_duration seconds.
+    The pump answers microflu.command_done_message when the plunger of a command starts to move, so each command
+    is "pending", "sent", "running" (its answer is received), "done" (the next one started) or "aborted".
+    The end of the commands is expected from the timeline of the program (see timing.py).
+    Once the last command of a chunk should be finished, the pump status is queried every poll_period seconds
+    and the next chunk, encoded in advance, is sent as soon as the pump is ready.
+
+    The scheduler does not block: on_message() is given the messages of the pump and update() is called
+    from the GUI loop. A pause takes effect at the end of the current chunk, so within max_chunk_duration;
+    abort() stops the pump at once. A paused program is still active, only its completion or abort() ends it.
+    The plunger position is given to on_position each time it is known, at the end of a chunk or on abort.
+    """
+    def __init__(self, max_sequence_length: int = 500, max_chunk_duration: float = 60, poll_period: float = 0.5, on_position: typing.Optional[typing.Callable[[int], None]] = None):
+        self.max_sequence_length = max_sequence_length
+        self.max_chunk_duration = max_chunk_duration
+        self.poll_period = poll_period
+        self.on_position = on_position
+        self.program: typing.Optional[protocol.Program] = None
+        self.timeline: typing.List[timing.Step] = []
+        self.states: typing.List[str] = []
+        self.error: str = ""
+        self.paused = False
+        self._pump = None
+        self._chunks: typing.List[typing.Tuple[int, int, str]] = []  # first command, stop command, sequence
+        self._chunk = -1            # chunk on the pump
+        self._expected_end = 0.0    # time.monotonic() when the chunk on the pump should be finished
+        self._last_poll = 0.0
+
+    def start(self, pump, program: protocol.Program, timeline: typing.Optional[typing.List[timing.Step]] = None) -> bool:
+        """
+        Send the first chunk of a program.
+
+        :param pump: The serial port or transport of the pump.
+        :param program: The compiled protocol.
+        :param timeline: The timeline of the program, computed without the tubing if not given.
+
+        :return: True if the first chunk was written, False otherwise.
+        """
+        self.program = program
+        self.timeline = timeline if timeline is not None else timing.timeline(program, {})
+        self.states = ["pending"] * len(program.commands)
+        self.error = ""
+        self.paused = False
+        self._pump = pump
+        self._chunks = split_program(program, self.timeline, self.max_sequence_length, self.max_chunk_duration)
+        self._chunk = -1
+        return self._send_next_chunk()
+
+    def running(self) -> bool:
+        """
+        If a chunk is on the pump.
+        """
+        return self._chunk >= 0
+
+    def active(self) -> bool:
+        """
+        If a program is running or paused, no other command should be sent to the pump then.
+        """
+        return self.running() or "pending" in self.states
+
+    def position(self) -> int:
+        """
+        Plunger position after the last command done, in steps.
+        """
+        return self.program.trajectory[self.states.count("done")]
+
+    def pause(self) -> None:
+        """
+        Do not send the next chunk, the commands already on the pump are finished.
+        """
+        self.paused = True
+
+    def resume(self) -> bool:
+        """
+        :return: False if the next chunk could not be written.
+        """
+        self.paused = False
+        if self.program is not None and self._chunk < 0 and "pending" in self.states:
+            return self._send_next_chunk()
+        return True
+
+    def abort(self) -> bool:
+        """
+        Stop the pump at once and forget the commands not finished.
+
+        :return: True if the stop command was written, False otherwise.
+        """
+        success = True
+        if self.running():
+            success = microflu.halt(self._pump)
+        if self.program is not None and self.active():
+            # The command running was stopped midway, the plunger position is only known up to it
+            self._set_position(self.position())
+        self.states = ["aborted" if state != "done" else state for state in self.states]
+        self._chunk = -1
+        return success
+
+    def on_message(self, data: bytes) -> int:
+        """
+        Follow the commands from a message of the pump.
+
+        :return: The index of the command that started, -1 if the message is not a command start.
+        """
+        if not self.running():
+            return -1
+
+        if data == microflu.command_done_message:
+            first, stop, _ = self._chunks[self._chunk]
+            for k in range(first, stop):
+                if self.states[k] == "running":
+                    self.states[k] = "done"
+                elif self.states[k] == "sent":
+                    self.states[k] = "running"
+                    # The answer comes when the plunger starts
+                    self._expected_end = time.monotonic() + self.timeline[stop - 1].end - self.timeline[k].plunger_start
+                    return k
+            return -1
+
+        status = parse_status(data)
+        if status is not None and time.monotonic() >= self._expected_end:
+            ready, error = status
+            if error != 0:
+                self.error = "Pump error " + str(error)
+                print(self.error + ", protocol aborted")
+                self.abort()
+            elif ready:
+                self._finish_chunk()
+        return -1
+
+    def update(self) -> bool:
+        """
+        Query the pump status once the current chunk should be finished.
+
+        :return: False if writing to the pump failed.
+        """
+        now = time.monotonic()
+        if self.running() and now >= self._expected_end and now - self._last_poll >= self.poll_period:
+            self._last_poll = now
+            return microflu.query_status(self._pump)
+        return True
+
+    def progress(self) -> typing.Tuple[int, int, float]:
+        """
+        :return: The number of commands done, the number of commands and the estimated time left, in seconds.
+        """
+        if self.program is None:
+            return 0, 0, 0
+        done = self.states.count("done")
+        left = sum(step.end - step.start for step, state in zip(self.timeline, self.states) if state in ("pending", "sent", "running"))
+        return done, len(self.states), left
+
+    def _finish_chunk(self) -> None:
+        first, stop, _ = self._chunks[self._chunk]
+        for k in range(first, stop):
+            self.states[k] = "done"
+        self._set_position(self.position())
+        if not self.paused:
+            self._send_next_chunk()
+        else:
+            self._chunk = -1
+
+    def _set_position(self, position: int) -> None:
+        if self.on_position is not None:
+            self.on_position(position)
+
+    def _send_next_chunk(self) -> bool:
+        if "pending" not in self.states:
+            self._chunk = -1
+            return True
+        index = self.states.index("pending")
+        self._chunk = next(k for k, (first, _, _) in enumerate(self._chunks) if first == index)
+        first, stop, sequence = self._chunks[self._chunk]
+        for k in range(first, stop):
+            self.states[k] = "sent"
+        self._expected_end = time.monotonic() + self.timeline[stop - 1].end - self.timeline[first].start
+        return microflu.write_sequence_to_pump(self._pump, sequence)
+
+
+def split_program(program: protocol.Program, timeline: typing.List[timing.Step], max_sequence_length: int, max_chunk_duration: float) -> typing.List[typing.Tuple[int, int, str]]:
+    """
+    Split the commands of a program in chunks, a chunk has at least one command.
+    The duration of a chunk is taken from the timeline of the program, as the end of the chunk expected by the scheduler.
+
+    :return: The first command, the stop command and the sequence of each chunk.
+    """
+    chunks = []
+    first = 0
+    length = 0
+    duration = 0.0
+    for k, (command, step) in enumerate(zip(program.commands, timeline)):
+        if k > first and (length + len(command.sequence) > max_sequence_length or duration + step.end - step.start > max_chunk_duration):
+            chunks.append((first, k, _chunk_sequence(program.commands[first:k])))
+            first, length, duration = k, 0, 0.0
+        length += len(command.sequence if k > first else _chunk_sequence([command]))
+        duration += step.end - step.start
+    if first < len(program.commands):
+        chunks.append((first, len(program.commands), _chunk_sequence(program.commands[first:])))
+    return chunks
+
+
+def _chunk_sequence(commands: typing.Sequence[protocol.Command]) -> str:
+    # The optimizer only sets the valve and the speed when they change, a chunk sets them again as the pump
+    # may have been used between two chunks
+    first = commands[0]
+    names = [name for name, _ in optimizer.tokenize(first.sequence)]
+    prefix = ""
+    if "B" not in names and "O" not in names:
+        prefix += microflu.change_to_valve_fastest(first.port) + microflu.wait(microflu.wait_medium)
+    if "V" not in names:
+        prefix += microflu.peak_speed_uL_min(first.speed)
+    return prefix + "".join(command.sequence for command in commands)
+
+
+def parse_status(data: bytes) -> typing.Optional[typing.Tuple[bool, int]]:
+    """
+    Read the answer of the pump to the status query, b"/0" + status byte + ETX.
+
+    :return: If the pump is ready and its error code, or None if the message is not a status answer.
+    """
+    data = data.strip()
+    if len(data) != 4 or not data.startswith(b"/0") or data[3:] != b"\x03":
+        return None
+    status = data[2]
+    # Bit 5 of the status byte is set when the pump is ready, the low 4 bits are the error code
+    return bool(status & 0x20), status & 0x0F
@@ -0,0 +1,138 @@
+import concurrent.futures
+import queue
+import threading
+import time
+import typing
+import serial
+
+
+class SerialMessage(typing.NamedTuple):
+    timestamp: float    # time.monotonic() when the end of the message was read
+    data: bytes         # with its terminator
+
+
+class SerialTransport:
+    """
+    Non-blocking access to a serial port (the pump or the Arduino), with a reader and a writer thread.
+
+    The reader frames the bytes received into messages ending with `terminator` (the pump answers
+    b'/0`12\\x03\\r\\n' when a command is done) and puts them, timestamped, in a queue emptied by messages().
+    Bytes left without terminator for frame_timeout seconds are sent as a message too, the Arduino does not end its messages.
+    write() only queues the bytes and returns a future, set to True once they are written.
+
+    The transport has the write() method of serial.Serial, so the functions of microflu and arduino_control
+    can be given a transport instead of the port: they return as soon as the command is queued.
+    If the port fails, both threads stop, the exception is kept in `error` and the pending futures get it.
+    """
+    def __init__(self, port: serial.Serial, name: str = "serial", terminator: bytes = b"\n", frame_timeout: float = 0.2, read_timeout: float = 0.05):
+        self.port = port
+        self.name = name
+        self.terminator = terminator
+        self.frame_timeout = frame_timeout
+        self.error: typing.Optional[Exception] = None
+        # The reader waits at most read_timeout for new bytes, so it sees the stop request quickly
+        self.port.timeout = read_timeout
+        self._messages: queue.Queue = queue.Queue()
+        self._writes: queue.Queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, name=name + "-reader", daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, name=name + "-writer", daemon=True)
+        self._reader.start()
+        self._writer.start()
+
+    def is_open(self) -> bool:
+        return self.error is None and not self._stop_event.is_set()
+
+    def write(self, data: bytes) -> concurrent.futures.Future:
+        """
+        Queue bytes to write.
+
+        :return: A future set to True when the bytes are written, or to the exception if writing failed.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if not self.is_open():
+            future.set_exception(self.error if self.error is not None else IOError("Serial port " + self.name + " is closed"))
+        else:
+            self._writes.put((data, future))
+        return future
+
+    def messages(self) -> typing.List[SerialMessage]:
+        """
+        Remove and return the messages received since the last call, without waiting.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def close(self, timeout: float = 2) -> None:
+        """
+        Write the queued bytes, stop the threads and close the port.
+
+        :param timeout: The maximum time to wait for each thread, in seconds.
+        :type timeout: float
+        """
+        self._stop_event.set()
+        self._writes.put(None)
+        self._writer.join(timeout)
+        self._reader.join(timeout)
+        try:
+            self.port.close()
+        except Exception:
+            pass
+
+    def _read_loop(self) -> None:
+        pending = b""
+        last_byte_time = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                data = self.port.read(max(self.port.in_waiting, 1))
+            except Exception as e:
+                self._fail(e)
+                break
+
+            now = time.monotonic()
+            if len(data) > 0:
+                pending += data
+                last_byte_time = now
+                end = pending.find(self.terminator)
+                while end >= 0:
+                    end += len(self.terminator)
+                    self._messages.put(SerialMessage(now, pending[:end]))
+                    pending = pending[end:]
+                    end = pending.find(self.terminator)
+            elif len(pending) > 0 and now - last_byte_time > self.frame_timeout:
+                self._messages.put(SerialMessage(now, pending))
+                pending = b""
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            data, future = item
+            try:
+                self.port.write(data)
+                future.set_result(True)
+            except Exception as e:
+                future.set_exception(e)
+                self._fail(e)
+                break
+
+        # Fail the writes still queued
+        while True:
+            try:
+                item = self._writes.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(self.error if self.error is not None else IOError("Serial port " + self.name + " is closed"))
+
+    def _fail(self, error: Exception) -> None:
+        if self.error is None:
+            self.error = error
+        self._stop_event.set()
+        # Wake the writer up so it stops too
+        self._writes.put(None)
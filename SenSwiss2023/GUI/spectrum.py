@@ -0,0 +1,156 @@
+import functools
+import typing
+import numpy as np
+from scipy import ndimage
+from scipy import signal
+
+
+@functools.lru_cache(maxsize=16)
+def savgol_coeffs(window_length: int, polyorder: int) -> np.ndarray:
+    """
+    Savitzky-Golay smoothing coefficients, computed once for each window and order.
+    """
+    coeffs = signal.savgol_coeffs(window_length, polyorder)
+    coeffs.flags.writeable = False
+    return coeffs
+
+
+class SavitzkyGolayFilter:
+    """
+    Savitzky-Golay smoothing applied as a FIR filter with cached coefficients, on batches of spectra (frames x pixels).
+
+    An even window is not centered on the pixel and shifts the spectrum by half a pixel, so the window is made odd.
+    The output is written in a buffer reused from call to call, copy it to keep it after the next call.
+    """
+    def __init__(self, window_length: int = 101, polyorder: int = 2):
+        self._buffer = np.zeros((0, 0))
+        self.set_window(window_length, polyorder)
+
+    def set_window(self, window_length: int, polyorder: int = 2) -> None:
+        self.window_length = max(window_length | 1, polyorder + 1 | 1)
+        self.polyorder = polyorder
+        self.coeffs = savgol_coeffs(self.window_length, polyorder)
+
+    def apply(self, spectra: np.ndarray) -> np.ndarray:
+        """
+        Smooth each spectrum of a batch (frames x pixels) along the pixels, the edges are extended with the
+        nearest value as with mode="nearest" of scipy.signal.savgol_filter.
+        """
+        spectra = np.asarray(spectra, dtype=np.float64)
+        if len(spectra) > self._buffer.shape[0] or spectra.shape[1] != self._buffer.shape[1]:
+            self._buffer = np.zeros((max(len(spectra), self._buffer.shape[0]), spectra.shape[1]))
+        out = self._buffer[:len(spectra)]
+        ndimage.convolve1d(spectra, self.coeffs, axis=1, mode="nearest", output=out)
+        return out
+
+
+class SpectrumProcessor:
+    """
+    Processing of the spectra to follow the absorption peak, on batches of spectra (frames x pixels):
+    - trim the noisy pixels at both ends
+    - smooth with a Savitzky-Golay filter
+    - normalize with the dark and flat fields, once both are set
+    - find the minimum peak in the wavelength range
+    - compute the centroid around the minimum peak, in a window fixed on the first normalized spectrum
+
+    The wavelength range slice and the Savitzky-Golay coefficients are computed when the parameters change,
+    not for every spectrum. The smoothed spectra returned are overwritten by the next call.
+    The minimum peak is the minimum pixel, or the sub-pixel position given by peak_estimator if set (see peaks.py).
+    """
+    def __init__(self, wavelengths: np.ndarray, trim: int = 100, SG_window: int = 101, polyorder: int = 2, wavelength_min: float = 500, wavelength_max: float = 900, centroid_window_size: int = 250, peak_estimator=None):
+        self.trim = trim
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64)[trim:len(wavelengths) - trim]
+        self.dark_field: typing.Optional[np.ndarray] = None
+        self.flat_field: typing.Optional[np.ndarray] = None
+        self.normalize_gain: float = 1
+        # normalized = smoothed * scale + offset, with scale = normalize_gain / (flat - dark) computed once
+        self.scale: typing.Optional[np.ndarray] = None
+        self.offset: typing.Optional[np.ndarray] = None
+        self.centroid_window_size = centroid_window_size
+        self.index_min: int = 0
+        self.window_limits: typing.Optional[typing.Tuple[int, int]] = None
+        self.peak_estimator = peak_estimator
+        self.SG_filter = SavitzkyGolayFilter(SG_window, polyorder)
+        self.set_wavelength_range(wavelength_min, wavelength_max)
+
+    def set_wavelength_range(self, wavelength_min: float, wavelength_max: float) -> None:
+        """
+        Set the range where the minimum peak is searched, bounds excluded.
+        The wavelengths are sorted, so the range is a slice of the spectrum.
+        """
+        start = np.searchsorted(self.wavelengths, wavelength_min, side="right")
+        stop = np.searchsorted(self.wavelengths, wavelength_max, side="left")
+        self.range = slice(start, max(stop, start + 1))
+
+    def set_fields(self, dark_field: typing.Optional[np.ndarray], flat_field: typing.Optional[np.ndarray]) -> None:
+        """
+        Set the dark and flat fields, the spectra are normalized when both are given.
+        """
+        self.dark_field = None if dark_field is None or len(dark_field) == 0 else np.asarray(dark_field, dtype=np.float64)
+        self.flat_field = None if flat_field is None or len(flat_field) == 0 else np.asarray(flat_field, dtype=np.float64)
+        if self.normalizing():
+            self.normalize_gain = np.mean(self.flat_field - self.dark_field)
+            with np.errstate(divide="ignore"):
+                self.scale = self.normalize_gain / (self.flat_field - self.dark_field)
+            self.offset = -self.dark_field * self.scale
+
+    def normalizing(self) -> bool:
+        return self.dark_field is not None and self.flat_field is not None
+
+    def reset_window(self, centroid_window_size: int = -1) -> None:
+        """
+        Fix the centroid window again on the next normalized spectrum, with a new size in pixels if given.
+        """
+        if centroid_window_size > 0:
+            self.centroid_window_size = centroid_window_size
+        self.window_limits = None
+
+    def smooth(self, spectra: np.ndarray) -> np.ndarray:
+        """
+        Trim and smooth raw spectra (frames x pixels).
+        """
+        spectra = np.asarray(spectra)
+        return self.SG_filter.apply(spectra[:, self.trim:spectra.shape[1] - self.trim])
+
+    def normalize(self, smoothed: np.ndarray) -> np.ndarray:
+        if not self.normalizing():
+            return smoothed
+        normalized = smoothed * self.scale
+        normalized += self.offset
+        return normalized
+
+    def process(self, spectra: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Process a batch of raw spectra.
+
+        :param spectra: The raw spectra (frames x pixels).
+        :type spectra: np.ndarray
+
+        :return: The smoothed spectra, the normalized spectra, the minimum peak wavelengths and the centroids.
+            Before the spectra are normalized, the centroid is the minimum peak wavelength.
+        """
+        smoothed = self.smooth(spectra)
+        normalized = self.normalize(smoothed)
+        if len(normalized) == 0:
+            return smoothed, normalized, np.zeros(0), np.zeros(0)
+
+        index_min = self.range.start + np.argmin(normalized[:, self.range], axis=1)
+        if self.peak_estimator is None:
+            min_peaks = self.wavelengths[index_min]
+        else:
+            min_peaks = self.peak_estimator.estimate(normalized, self.wavelengths, index_min)
+        if not self.normalizing():
+            return smoothed, normalized, min_peaks, min_peaks.copy()
+
+        if self.window_limits is None:
+            self.index_min = int(index_min[0])
+            self.window_limits = (max(self.index_min - self.centroid_window_size, 0), min(self.index_min + self.centroid_window_size, len(self.wavelengths)))
+        return smoothed, normalized, min_peaks, self.centroids(normalized)
+
+    def centroids(self, normalized: np.ndarray) -> np.ndarray:
+        """
+        Centroid of the reversed normalized spectra (max - spectrum) in the centroid window.
+        """
+        start, stop = self.window_limits
+        reversed_spectra = np.max(normalized, axis=1, keepdims=True) - normalized[:, start:stop]
+        return reversed_spectra @ self.wavelengths[start:stop] / np.sum(reversed_spectra, axis=1)
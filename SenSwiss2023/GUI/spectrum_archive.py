@@ -0,0 +1,134 @@
+import json
+import os
+import typing
+import numpy as np
+import spectrum
+
+
+class SpectrumArchive:
+    """
+    Archive of all the raw spectra of a run, as a float32 matrix (frames x pixels) on disk.
+
+    The folder contains:
+    - spectra.f32: the raw spectra, appended as they are acquired
+    - times.f64: the time of each spectrum
+    - wavelengths.npy: the wavelength axis of the raw spectra
+    - dark_field.npy, flat_field.npy: the fields used for the normalization, in the trimmed axis, when they are captured
+    - archive.json: the number of pixels and the number of pixels trimmed at each end before processing
+
+    The spectra are read back through a memory map, so a long run is never loaded in RAM.
+    Opening an existing archive only needs the folder, giving the wavelengths creates a new one in a folder that must not exist yet.
+    """
+    def __init__(self, directory: str, wavelengths: typing.Optional[np.ndarray] = None, trim: int = 0):
+        self.directory = directory
+        self._spectra_file = None
+        self._times_file = None
+        if wavelengths is not None:
+            os.makedirs(directory, exist_ok=False)
+            np.save(os.path.join(directory, "wavelengths.npy"), np.asarray(wavelengths, dtype=np.float64))
+            with open(os.path.join(directory, "archive.json"), "w") as f:
+                json.dump({"pixels": len(wavelengths), "trim": trim}, f)
+            self._spectra_file = open(os.path.join(directory, "spectra.f32"), "ab")
+            self._times_file = open(os.path.join(directory, "times.f64"), "ab")
+
+        with open(os.path.join(directory, "archive.json")) as f:
+            header = json.load(f)
+        self.pixels: int = header["pixels"]
+        self.trim: int = header["trim"]
+        self.wavelengths: np.ndarray = np.load(os.path.join(directory, "wavelengths.npy"))
+        self.dark_field = self._load_field("dark_field")
+        self.flat_field = self._load_field("flat_field")
+
+    def __len__(self) -> int:
+        # A crash can leave a partially written spectrum at the end
+        frames = self._file_size("spectra.f32") // (4 * self.pixels)
+        return min(frames, self._file_size("times.f64") // 8)
+
+    def append(self, spectra: np.ndarray, timestamps: np.ndarray) -> None:
+        """
+        Add spectra at the end of the archive.
+
+        :param spectra: The raw spectra (n, pixels).
+        :param timestamps: The time of each spectrum (n,).
+        :type spectra: np.ndarray
+        :type timestamps: np.ndarray
+        """
+        if self._spectra_file is None:
+            raise IOError("Archive " + self.directory + " was opened read only")
+        spectra = np.asarray(spectra, dtype=np.float32).reshape(-1, self.pixels)
+        self._spectra_file.write(spectra.tobytes())
+        self._times_file.write(np.asarray(timestamps, dtype=np.float64).tobytes())
+        self._spectra_file.flush()
+        self._times_file.flush()
+
+    def set_dark_field(self, dark_field: np.ndarray) -> None:
+        self.dark_field = np.asarray(dark_field, dtype=np.float64)
+        np.save(os.path.join(self.directory, "dark_field.npy"), self.dark_field)
+
+    def set_flat_field(self, flat_field: np.ndarray) -> None:
+        self.flat_field = np.asarray(flat_field, dtype=np.float64)
+        np.save(os.path.join(self.directory, "flat_field.npy"), self.flat_field)
+
+    def spectra(self) -> np.ndarray:
+        """
+        Get the spectra archived so far as a read-only memory map (frames x pixels).
+        """
+        n = len(self)
+        if n == 0:
+            return np.zeros((0, self.pixels), dtype=np.float32)
+        return np.memmap(os.path.join(self.directory, "spectra.f32"), dtype=np.float32, mode="r", shape=(n, self.pixels))
+
+    def times(self) -> np.ndarray:
+        n = len(self)
+        if n == 0:
+            return np.zeros(0)
+        return np.memmap(os.path.join(self.directory, "times.f64"), dtype=np.float64, mode="r", shape=(n,))
+
+    def close(self) -> None:
+        for file in (self._spectra_file, self._times_file):
+            if file is not None:
+                file.flush()
+                os.fsync(file.fileno())
+                file.close()
+        self._spectra_file = None
+        self._times_file = None
+
+    def replay(self, SG_window: int, wavelength_min: float, wavelength_max: float, centroid_window_size: int, dark_field: typing.Optional[np.ndarray] = None, flat_field: typing.Optional[np.ndarray] = None, chunk_size: int = 256) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Process the archived spectra again with new parameters, as the GUI does during the acquisition:
+        Savitzky-Golay smoothing, dark and flat field normalization, minimum peak in the wavelength range and
+        centroid around the minimum peak of the first spectrum.
+        The spectra are read by chunks, so the memory used does not depend on the length of the run.
+
+        :param SG_window: The window length of the Savitzky-Golay filter, in pixels.
+        :param wavelength_min: The lower bound of the range where the minimum peak is searched, in nm.
+        :param wavelength_max: The upper bound of the range where the minimum peak is searched, in nm.
+        :param centroid_window_size: The half width of the centroid window, in pixels.
+        :param dark_field: The dark field to use instead of the archived one (optional).
+        :param flat_field: The flat field to use instead of the archived one (optional).
+        :param chunk_size: The number of spectra processed at once.
+
+        :return: The times, the minimum peak wavelengths and the centroids, one value per spectrum.
+        """
+        processor = spectrum.SpectrumProcessor(self.wavelengths, self.trim, SG_window, 2, wavelength_min, wavelength_max, centroid_window_size)
+        processor.set_fields(self.dark_field if dark_field is None else dark_field, self.flat_field if flat_field is None else flat_field)
+
+        spectra = self.spectra()
+        min_peaks = np.zeros(len(spectra))
+        centroids = np.zeros(len(spectra))
+        for start in range(0, len(spectra), chunk_size):
+            _, _, min_peaks[start:start + chunk_size], centroids[start:start + chunk_size] = processor.process(spectra[start:start + chunk_size])
+
+        return np.array(self.times()), min_peaks, centroids
+
+    def _file_size(self, name: str) -> int:
+        file_path = os.path.join(self.directory, name)
+        if os.path.exists(file_path):
+            return os.path.getsize(file_path)
+        return 0
+
+    def _load_field(self, name: str) -> typing.Optional[np.ndarray]:
+        field_path = os.path.join(self.directory, name + ".npy")
+        if os.path.exists(field_path):
+            return np.load(field_path)
+        return None
@@ -0,0 +1,177 @@
+import typing
+import numpy as np
+
+
+class TimeSeriesStore:
+    """
+    Columnar storage of the acquisition histories.
+
+    Each column is a typed NumPy array, preallocated and grown by chunks, so appending a sample does not allocate
+    memory most of the time and a column is read as a view without any conversion. The comments are rare, so they are
+    kept apart in a sparse table of (sample index, text), with the index of the first occurrence of each text (marker).
+
+    For the columns in summed_columns, the prefix sums are updated with each sample, so the mean over any window of
+    samples, and the shift between two markers, is computed in constant time whatever the length of the history.
+    """
+    def __init__(self, columns: typing.List[str], dtype=np.float64, chunk_size: int = 4096, summed_columns: typing.List[str] = []):
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.n = 0
+        self._capacity = chunk_size
+        self._columns: typing.Dict[str, np.ndarray] = {}
+        for name in columns:
+            self.add_column(name)
+        self.comments: typing.List[typing.Tuple[int, str]] = []
+        self.markers: typing.Dict[str, int] = {}
+        # Prefix sums, sums[name][k] is the sum of the k first values, relative to the first one for the precision,
+        # and nan_counts[name][k] the number of NaN among them
+        self._sums: typing.Dict[str, np.ndarray] = {name: np.zeros(self._capacity + 1) for name in summed_columns}
+        self._nan_counts: typing.Dict[str, np.ndarray] = {name: np.zeros(self._capacity + 1, dtype=np.int64) for name in summed_columns}
+        self._offsets: typing.Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """
+        Get a column as a read-only view of the samples stored so far.
+        """
+        view = self._columns[name][:self.n]
+        view.flags.writeable = False
+        return view
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._columns
+
+    @property
+    def columns(self) -> typing.List[str]:
+        return list(self._columns.keys())
+
+    def add_column(self, name: str, fill_value: float = np.nan) -> None:
+        """
+        Add a column, the samples already stored get fill_value in it.
+        """
+        if name in self._columns:
+            raise ValueError("Column " + name + " already exists")
+        self._columns[name] = np.full(self._capacity, fill_value, dtype=self.dtype)
+
+    def remove_column(self, name: str) -> None:
+        del self._columns[name]
+        self._sums.pop(name, None)
+        self._nan_counts.pop(name, None)
+
+    def append(self, **values: float) -> None:
+        """
+        Add one sample, every column has to be given.
+        """
+        self._reserve(self.n + 1)
+        for name, column in self._columns.items():
+            column[self.n] = values[name]
+        self._update_sums(self.n, self.n + 1)
+        self.n += 1
+
+    def extend(self, **values) -> None:
+        """
+        Add several samples, every column has to be given with the same number of values.
+        """
+        count = len(next(iter(values.values()))) if len(values) > 0 else 0
+        self._reserve(self.n + count)
+        for name, column in self._columns.items():
+            column[self.n:self.n + count] = values[name]
+        self._update_sums(self.n, self.n + count)
+        self.n += count
+
+    def add_comment(self, text: str, index: int = -1) -> None:
+        """
+        Attach a comment to a sample, the last one by default.
+        """
+        if index < 0:
+            index += self.n
+        if index < 0 or index >= self.n:
+            raise IndexError("No sample " + str(index) + " to comment")
+        self.comments.append((index, text))
+        if text not in self.markers or index < self.markers[text]:
+            self.markers[text] = index
+
+    def comment_list(self) -> typing.List[str]:
+        """
+        Get the comments as a list with one string per sample, "" for no comment.
+        """
+        comments = [""] * self.n
+        for index, text in self.comments:
+            comments[index] = text
+        return comments
+
+    def clear(self) -> None:
+        """
+        Forget all the samples and comments, the memory is kept.
+        """
+        self.n = 0
+        self.comments = []
+        self.markers = {}
+        self._offsets = {}
+
+    def window_mean(self, name: str, end: int, size: int) -> float:
+        """
+        Mean of a summed column over the size samples before the sample end (excluded), in constant time.
+        """
+        start = end - size
+        if size < 1 or start < 0 or end > self.n:
+            raise IndexError("No window of " + str(size) + " samples before sample " + str(end))
+        if self._nan_counts[name][end] - self._nan_counts[name][start] > 0:
+            return np.nan
+        return (self._sums[name][end] - self._sums[name][start]) / size + self._offsets.get(name, 0)
+
+    def shift(self, name: str, start_marker: str, stop_marker: str, size: int) -> float:
+        """
+        Shift of a summed column between two markers, as compute_shift: difference of the means over the size samples
+        before each marker. Return 0 if it can not be computed, as compute_shift.
+        """
+        for marker in (start_marker, stop_marker):
+            if marker not in self.markers:
+                print("Error searching for " + marker + " in comments")
+                return 0
+        try:
+            return self.window_mean(name, self.markers[stop_marker], size) - self.window_mean(name, self.markers[start_marker], size)
+        except IndexError:
+            print("Error computing shift, not enough samples before the markers")
+            return 0
+
+    def shifts(self, name: str, size: int) -> typing.Dict[typing.Tuple[str, str], float]:
+        """
+        Shifts between every pair of markers, the first marker of a pair being before the second one.
+        The pairs with not enough samples before a marker are left out.
+        """
+        means = {}
+        for marker, index in self.markers.items():
+            if index >= size:
+                means[marker] = self.window_mean(name, index, size)
+        ordered = sorted(means, key=lambda marker: self.markers[marker])
+        return {(first, second): means[second] - means[first] for i, first in enumerate(ordered) for second in ordered[i+1:]}
+
+    def _reserve(self, size: int) -> None:
+        if size <= self._capacity:
+            return
+        # Grow by chunks, doubling once the store is large so the copies stay amortized
+        capacity = max(size, self._capacity + max(self.chunk_size, self._capacity))
+        capacity = self.chunk_size * ((capacity + self.chunk_size - 1) // self.chunk_size)
+        for name, column in self._columns.items():
+            grown = np.full(capacity, np.nan, dtype=self.dtype)
+            grown[:self.n] = column[:self.n]
+            self._columns[name] = grown
+        for prefix in (self._sums, self._nan_counts):
+            for name, column in prefix.items():
+                grown = np.zeros(capacity + 1, dtype=column.dtype)
+                grown[:self.n + 1] = column[:self.n + 1]
+                prefix[name] = grown
+        self._capacity = capacity
+
+    def _update_sums(self, start: int, stop: int) -> None:
+        for name in self._sums:
+            values = self._columns[name][start:stop]
+            finite = np.isfinite(values)
+            if name not in self._offsets and np.any(finite):
+                self._offsets[name] = float(values[finite][0])
+            relative = np.where(finite, values - self._offsets.get(name, 0), 0)
+            self._sums[name][start + 1:stop + 1] = self._sums[name][start] + np.cumsum(relative)
+            self._nan_counts[name][start + 1:stop + 1] = self._nan_counts[name][start] + np.cumsum(~finite)
@@ -0,0 +1,184 @@
+"""
+Timing model of the pump, to know how long a protocol takes and when each liquid reaches the chip.
+
+The time of each command is the sum of:
+- the valve rotation, a fixed time plus a time per port passed, the valve taking the shortest way (B command)
+- the waits (M commands)
+- the plunger travel, steps / pulses per second of the speed set (V command)
+The liquid dispensed through a port reaches the chip once the tubing of the port, whose length and diameter are read
+from tubing.csv, has been pushed through.
+
+Usage:
+    python timing.py protocols/Glycerol_test.csv --output timeline.csv --plot timeline.png --changeover 600
+"""
+import argparse
+import csv
+import math
+import typing
+import matplotlib.pyplot as plt
+import optimizer
+import protocol
+
+n_ports: int = 12
+# Valve rotation, to be measured on the pump
+valve_switch_time: float = 0.1      # s
+valve_port_time: float = 0.05       # s per port passed
+
+TIMELINE_COLUMNS = ["index", "port", "action", "volume [uL]", "title", "start [s]", "valve [s]", "waits [s]", "plunger [s]", "end [s]", "arrival [s]"]
+
+
+class Step(typing.NamedTuple):
+    """
+    Timing of a command, the times are in seconds from the start of the protocol.
+    """
+    index: int
+    port: int
+    action: str
+    volume: float
+    title: str
+    start: float
+    valve_time: float
+    wait_time: float
+    plunger_time: float
+    end: float
+    plunger_start: float            # the pump answers the ?801 query when the plunger starts
+    arrival: typing.Optional[float] # the liquid of a dispense reaches the end of the port tubing, None for a pick
+
+
+def load_tubing(file_path: str = "tubing.csv") -> typing.Dict[int, float]:
+    """
+    Read the tubing of each port.
+
+    :param file_path: A csv file with the columns port, length_mm and diameter_mm.
+    :type file_path: str
+
+    :return: The dead volume of each port, in uL.
+    """
+    dead_volumes = {}
+    with open(file_path, newline="") as f:
+        for row in csv.DictReader(f):
+            # 1 mm^3 = 1 uL
+            dead_volumes[int(row["port"])] = math.pi * (float(row["diameter_mm"]) / 2) ** 2 * float(row["length_mm"])
+    return dead_volumes
+
+
+def valve_time(start: typing.Optional[int], stop: int) -> float:
+    """
+    Time to turn the valve from port start to port stop, the longest rotation if start is not known.
+    """
+    if start == stop:
+        return 0
+    distance = n_ports // 2 if start is None else min(abs(stop - start), n_ports - abs(stop - start))
+    return valve_switch_time + valve_port_time * distance
+
+
+def timeline(program: protocol.Program, dead_volumes: typing.Dict[int, float], start_valve: typing.Optional[int] = None) -> typing.List[Step]:
+    """
+    Time each command of a compiled protocol, optimized or not, from its pump sequence.
+
+    :param program: The compiled protocol.
+    :param dead_volumes: The dead volume of each port in uL (see load_tubing), 0 for a port not given.
+    :param start_valve: The port of the valve before the protocol, None if not known.
+    """
+    steps = []
+    valve = start_valve
+    pulses = 1
+    elapsed = 0.0
+    for command in program.commands:
+        valve_s, wait_s, plunger_s = 0.0, 0.0, 0.0
+        plunger_start = elapsed
+        for name, value in optimizer.tokenize(command.sequence):
+            if name in ("B", "O"):
+                valve_s += valve_time(valve, int(value))
+                valve = int(value)
+            elif name == "M":
+                wait_s += int(value) / 1000
+            elif name == "V":
+                pulses = int(value)
+            elif name in ("P", "D"):
+                plunger_start = elapsed + valve_s + wait_s + plunger_s
+                plunger_s += int(value) / pulses
+
+        arrival = None
+        if command.action == "Dispense":
+            # With less than the dead volume of the port dispensed, the liquid stays in the tubing until a next dispense
+            # pushes it, the arrival is then taken at the end of this dispense
+            flow = pulses * 5 / 60  # uL/s, inverse of microflu.peak_speed_uL_min
+            arrival = plunger_start + min(dead_volumes.get(command.port, 0) / flow, plunger_s)
+        end = elapsed + valve_s + wait_s + plunger_s
+        steps.append(Step(command.index, command.port, command.action, protocol.step_to_uL(command.steps), command.title,
+                          elapsed, valve_s, wait_s, plunger_s, end, plunger_start, arrival))
+        elapsed = end
+    return steps
+
+
+def marker_delay(step: Step) -> float:
+    """
+    Time between the answer of the pump to a command and the arrival of its liquid on the chip, in seconds.
+    """
+    return (step.arrival if step.arrival is not None else step.plunger_start) - step.plunger_start
+
+
+def throughput(duration: float, changeover: float = 0) -> float:
+    """
+    Number of chips processed per hour by a station running a protocol of this duration, with changeover seconds between chips.
+    """
+    return 3600 / (duration + changeover) if duration + changeover > 0 else 0
+
+
+def write_timeline(file_path: str, steps: typing.List[Step]) -> None:
+    with open(file_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(TIMELINE_COLUMNS)
+        for step in steps:
+            writer.writerow([step.index, step.port, step.action, "%.2f" % step.volume, step.title, "%.2f" % step.start, "%.2f" % step.valve_time,
+                             "%.2f" % step.wait_time, "%.2f" % step.plunger_time, "%.2f" % step.end, "" if step.arrival is None else "%.2f" % step.arrival])
+
+
+def plot_timeline(file_path: str, steps: typing.List[Step], title: str = "") -> None:
+    """
+    Save the Gantt chart of the timeline, a line per command with the valve rotation, the waits and the plunger travel,
+    and the arrival of the liquid on the chip.
+    """
+    fig, ax = plt.subplots(figsize=(10, 0.3 * len(steps) + 1.5))
+    for k, step in enumerate(steps):
+        ax.broken_barh([(step.start, step.valve_time), (step.start + step.valve_time, step.wait_time), (step.start + step.valve_time + step.wait_time, step.plunger_time)],
+                       (k - 0.4, 0.8), facecolors=("tab:gray", "tab:orange", "tab:blue" if step.action == "Pick" else "tab:green"))
+        if step.arrival is not None and step.title != "":
+            ax.plot(step.arrival, k, "k|", markersize=12)
+            ax.text(step.arrival, k, " " + step.title, va="center", fontsize=8)
+    ax.set_yticks(range(len(steps)))
+    ax.set_yticklabels([step.action + " " + str(step.port) for step in steps])
+    ax.invert_yaxis()
+    ax.set_xlabel("Time [s]")
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(file_path)
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Timeline and throughput of a pump protocol.")
+    parser.add_argument("protocol", help="protocol csv file")
+    parser.add_argument("--tubing", default="tubing.csv", help="tubing of each port (default: tubing.csv)")
+    parser.add_argument("--output", default="", help="timeline csv file to write")
+    parser.add_argument("--plot", default="", help="Gantt chart image to save")
+    parser.add_argument("--changeover", type=float, default=0, help="time to change the chip between two runs, in seconds (default: 0)")
+    parser.add_argument("--no-optimize", action="store_true", help="time the protocol as written, without the optimizer")
+    args = parser.parse_args()
+
+    program = protocol.load_protocol(args.protocol)
+    if not args.no_optimize:
+        program, _ = optimizer.optimize(program)
+    steps = timeline(program, load_tubing(args.tubing))
+
+    print("index  port  action     volume [uL]  start [s]  end [s]  arrival [s]  title")
+    for step in steps:
+        print(str(step.index).rjust(5) + str(step.port).rjust(6) + "  " + step.action.ljust(9) + ("%.1f" % step.volume).rjust(12) + ("%.1f" % step.start).rjust(11)
+              + ("%.1f" % step.end).rjust(9) + ("" if step.arrival is None else "%.1f" % step.arrival).rjust(13) + "  " + step.title)
+    duration = steps[-1].end if len(steps) > 0 else 0
+    print("Duration: %.1f s, %.2f chips per hour" % (duration, throughput(duration, args.changeover)))
+    if args.output != "":
+        write_timeline(args.output, steps)
+    if args.plot != "":
+        plot_timeline(args.plot, steps, args.protocol)